@@ -25,6 +25,7 @@ from tools.learning_utils import inference_on_list
 from tools.graph_utils import bfs_expand, graph_from_node, fetch_graph
 from tools.clustering import *
 from tools.rna_ged_nx import ged
+from prepare_data.shards import Shards
 
 
 import seaborn as sns
@@ -576,11 +577,15 @@ class MGraphAll(MGraph):
                  optimize=True,
                  max_graphs=None,
                  nc_only=False,
-                 bb_only=False):
+                 bb_only=False,
+                 shards=None):
 
         # General
         self.run = run
         self.graph_dir = graph_dir
+        # Packed graphs (prepare_data/shards.py) are streamed in the order they are stored in
+        self.shards = Shards(shards) if shards is not None else None
+        graph_list = self.shards.names if self.shards is not None else os.listdir(self.graph_dir)
 
         # Nodes parameters
         self.n_components = n_components
@@ -595,9 +600,10 @@ class MGraphAll(MGraph):
         # BUILD MNODES
         model_output = inference_on_list(self.run,
                                          self.graph_dir,
-                                         os.listdir(self.graph_dir),
+                                         graph_list,
                                          max_graphs=max_graphs,
-                                         nc_only=nc_only
+                                         nc_only=nc_only,
+                                         shards=shards
                                          )
 
         Z = model_output['Z']
@@ -657,9 +663,12 @@ class MGraphAll(MGraph):
             self.graph.nodes[clust]['node_ids'].add(index)
 
         # BUILD MEDGES
-        for graph_name in os.listdir(self.graph_dir)[:max_graphs]:
-            graph_path = os.path.join(self.graph_dir, graph_name)
-            g = fetch_graph(graph_path)
+        if self.shards is not None:
+            graphs = ((name, data['graph'] if name.endswith('.p') else data)
+                      for name, data in self.shards.stream(graph_list[:max_graphs]))
+        else:
+            graphs = ((name, fetch_graph(os.path.join(self.graph_dir, name))) for name in graph_list[:max_graphs])
+        for graph_name, g in graphs:
             g = g.to_undirected()
             for start_node, end_node in g.edges():
                 # Get edges id
@@ -0,0 +1,95 @@
+"""
+Binary DGL graphs of an annotated dataset.
+
+Loading an item otherwise unpickles a networkx graph and converts it to DGL at every epoch. We convert every graph
+once, with its edge types as integers in edata['one_hot'], and save them all with dgl.data.utils.save_graphs in
+data/dgl/<annot_id>.bin. The index data/dgl/<annot_id>_index.p holds the graph names, the edge map and the node order of
+each graph (sorted nodes, the order of the embeddings and of K).
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import pickle
+
+import networkx as nx
+from dgl.data.utils import save_graphs, load_graphs
+from tqdm import tqdm
+
+from tools.node_sim import EDGE_MAP
+from tools.graph_utils import nx_to_dgl
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--annot_id", default='samples', type=str, help="Annotated data ID.")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def dgl_cache_path(annot_id):
+    return os.path.join(script_dir, '..', 'data', 'dgl', annot_id)
+
+
+def load_nx(g_path):
+    if g_path.endswith('.p'):
+        return pickle.load(open(g_path, 'rb'))['graph']
+    return nx.read_gpickle(g_path)
+
+
+def build_dgl_cache(annot_path, dump_path, edge_map=EDGE_MAP):
+    """
+    Convert all the graphs of an annotated dataset.
+    Dumps dump_path + '.bin' and dump_path + '_index.p'
+    :param annot_path: directory of annotated graphs
+    :param dump_path: path prefix of the dumped files
+    :param edge_map: edge label to edge type
+    :return: the number of graphs
+    """
+    graphlist = sorted(os.listdir(annot_path))
+    graphs = []
+    nodes = {}
+    for g in tqdm(graphlist):
+        g_dgl, nodes[g] = nx_to_dgl(load_nx(os.path.join(annot_path, g)), edge_map)
+        graphs.append(g_dgl)
+    save_graphs(dump_path + '.bin', graphs)
+    pickle.dump({'graphs': graphlist,
+                 'edge_map': edge_map,
+                 'nodes': nodes},
+                open(dump_path + '_index.p', 'wb'))
+    return len(graphs)
+
+
+def load_dgl_cache(dump_path, edge_map=None):
+    """
+    Load all the graphs converted by build_dgl_cache.
+    :param dump_path: path prefix of the converted graphs
+    :param edge_map: if given, check that the graphs were converted with the same edge map
+    :return: a {graph name: DGLGraph} dict and the index
+    """
+    index = pickle.load(open(dump_path + '_index.p', 'rb'))
+    if edge_map is not None and index['edge_map'] != edge_map:
+        raise ValueError(f"The graphs of {dump_path} were converted with another edge map, rebuild them with "
+                         f"prepare_data/dgl_cache.py")
+    graphs, _ = load_graphs(dump_path + '.bin')
+    return dict(zip(index['graphs'], graphs)), index
+
+
+def caller(annot_id='samples'):
+    dump_dir = os.path.join(script_dir, '..', 'data', 'dgl')
+    try:
+        os.mkdir(dump_dir)
+    except FileExistsError:
+        pass
+    n = build_dgl_cache(os.path.join(script_dir, '..', 'data', 'annotated', annot_id), dgl_cache_path(annot_id))
+    print(f">>> dumped {n} DGL graphs in {dgl_cache_path(annot_id)}.bin")
+    pass
+
+
+if __name__ == '__main__':
+    args = cline()
+    caller(**vars(args))
@@ -0,0 +1,131 @@
+"""
+Precompute the GED similarity between all pairs of graphlets of a hash table.
+
+The graphlet kernels (graphlet, R_graphlets) otherwise compute GEDs lazily during the first epochs.
+The result is a dense float32 .npy indexed by graphlet ids (see tools.graphlet_hash.hash_ids_from_table),
+holding the same exp(-beta * GED) similarity as GED_hashtable_hashed.
+Rows are checkpointed as they are done so an interrupted build resumes where it stopped.
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import pickle
+import multiprocessing as mlt
+
+import numpy as np
+from tqdm import tqdm
+
+from tools.graphlet_hash import hash_ids_from_table
+from tools.rna_ged_nx import ged
+
+# Set in each worker by the pool initializer
+_graphs = None
+_timeout = None
+_beta = None
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--annot_id", default='samples', type=str,
+                        help="Annotated data ID, the hash table is data/hashing/<annot_id>.p")
+    parser.add_argument("-t", "--timeout", default=60, type=int, help="GED timeout for each pair.")
+    parser.add_argument("-np", "--processes", default=None, type=int, help="Size of the process pool.")
+    parser.add_argument("-c", "--checkpoint", default=100, type=int, help="Number of rows between checkpoints.")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def ged_matrix_paths(hash_path):
+    """
+    :param hash_path: path to the pickled (hasher, hash_table)
+    :return: path of the matrix and of its progress file
+    """
+    root = os.path.splitext(hash_path)[0]
+    return root + '_ged.npy', root + '_ged_done.npy'
+
+
+def _init_worker(graphs, timeout, beta):
+    global _graphs, _timeout, _beta
+    _graphs = graphs
+    _timeout = timeout
+    _beta = beta
+
+
+def _compute_row(i):
+    """
+    GED similarities between graphlet i and graphlets i..n
+    """
+    values = [np.exp(-_beta * ged(_graphs[i], H, timeout=_timeout)) for H in _graphs[i + 1:]]
+    return i, np.array([1.] + values, dtype=np.float32)
+
+
+def build_ged_matrix(hash_path, processes=None, timeout=60, beta=.50, checkpoint=100):
+    """
+    Compute the all pairs GED similarity matrix of a graphlet hash table, resuming a previous build if there is one.
+    :param hash_path: path to the pickled (hasher, hash_table)
+    :param processes: size of the process pool, None for all cores
+    :param timeout: GED timeout for each pair
+    :param beta: similarity is exp(-beta * GED), as in GED_hashtable_hashed
+    :param checkpoint: number of rows between checkpoints
+    :return: the path of the matrix
+    """
+    matrix_path, done_path = ged_matrix_paths(hash_path)
+    hash_ids = hash_ids_from_table(hash_path)
+    _, hash_table = pickle.load(open(hash_path, 'rb'))
+    graphs = [None] * len(hash_ids)
+    for h, i in hash_ids.items():
+        graphs[i] = hash_table[h]['graph']
+    n = len(graphs)
+
+    if os.path.exists(matrix_path) and os.path.exists(done_path):
+        matrix = np.load(matrix_path, mmap_mode='r+')
+        done = np.load(done_path)
+        assert matrix.shape == (n, n), f"{matrix_path} does not match the hash table, remove it to rebuild"
+    else:
+        matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=(n, n))
+        done = np.zeros(n, dtype=bool)
+    todo = np.flatnonzero(~done)
+    print(f">>> {n} graphlets, {len(todo)} rows left to compute.")
+
+    def save_progress():
+        matrix.flush()
+        np.save(done_path, done)
+
+    pool = mlt.Pool(processes=processes, initializer=_init_worker, initargs=(graphs, timeout, beta))
+    for k, (i, values) in enumerate(tqdm(pool.imap_unordered(_compute_row, todo), total=len(todo))):
+        matrix[i, i:] = values
+        matrix[i:, i] = values
+        done[i] = True
+        if (k + 1) % checkpoint == 0:
+            save_progress()
+    pool.close()
+    pool.join()
+    save_progress()
+    return matrix_path
+
+
+def load_ged_matrix(hash_path):
+    """
+    Load a complete matrix built with build_ged_matrix, memory mapped
+    :param hash_path: path to the pickled (hasher, hash_table)
+    :return: the matrix and the graphlet ids
+    """
+    matrix_path, done_path = ged_matrix_paths(hash_path)
+    if not np.load(done_path).all():
+        raise ValueError(f"{matrix_path} is not complete, resume it with prepare_data/ged_matrix.py")
+    return np.load(matrix_path, mmap_mode='r'), hash_ids_from_table(hash_path)
+
+
+if __name__ == '__main__':
+    args = cline()
+    hash_path = os.path.join(script_dir, '..', 'data', 'hashing', args.annot_id + '.p')
+    matrix_path = build_ged_matrix(hash_path,
+                                   processes=args.processes,
+                                   timeout=args.timeout,
+                                   checkpoint=args.checkpoint)
+    print(f">>> dumped GED matrix in {matrix_path}")
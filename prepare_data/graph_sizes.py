@@ -0,0 +1,98 @@
+"""
+Number of nodes of each graph of an annotated dataset.
+
+Batching by a node budget needs the size of every graph before any of them is loaded. We go through the annotated
+dataset once and dump a {graph name: number of nodes} dict in data/sizes/<annot_id>.p. Without it, sizes are read from
+the DGL cache or the ring store when training uses them.
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import pickle
+
+import networkx as nx
+from tqdm import tqdm
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--annot_id", default='samples', type=str, help="Annotated data ID.")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def size_index_path(annot_id):
+    return os.path.join(script_dir, '..', 'data', 'sizes', annot_id + '.p')
+
+
+def graph_size(g_path):
+    if g_path.endswith('.p'):
+        graph = pickle.load(open(g_path, 'rb'))['graph']
+    else:
+        graph = nx.read_gpickle(g_path)
+    return graph.number_of_nodes()
+
+
+def build_size_index(annot_path, graphs=None):
+    """
+    :param annot_path: directory of annotated graphs
+    :param graphs: the graphs to measure, all the graphs of the directory by default
+    :return: a {graph name: number of nodes} dict
+    """
+    if graphs is None:
+        graphs = sorted(os.listdir(annot_path))
+    return {g: graph_size(os.path.join(annot_path, g)) for g in tqdm(graphs)}
+
+
+def load_sizes(annot_path, graphs, index_path=None, dgl_graphs=None, ring_store=None, shards=None):
+    """
+    Sizes of some graphs of an annotated dataset, from the index when there is one.
+    Without an index, they are read from the graphs converted to DGL or the ring store when they are loaded,
+    from the shards, or from the annotated files as a last resort.
+    :param annot_path: directory of annotated graphs
+    :param graphs: list of graph names
+    :param index_path: path of an index built by build_size_index
+    :param dgl_graphs: the {graph name: DGLGraph} of prepare_data/dgl_cache.py
+    :param ring_store: a RingStore of prepare_data/ring_store.py
+    :param shards: the Shards of prepare_data/shards.py
+    :return: the list of the number of nodes of each graph
+    """
+    if index_path is not None and os.path.exists(index_path):
+        sizes = pickle.load(open(index_path, 'rb'))
+        missing = [g for g in graphs if g not in sizes]
+        if missing:
+            raise ValueError(f"{len(missing)} graphs of {annot_path} are not in {index_path}, rebuild it with "
+                             f"prepare_data/graph_sizes.py")
+    elif dgl_graphs is not None:
+        sizes = {g: dgl_graphs[g].number_of_nodes() for g in graphs}
+    elif ring_store is not None and all(g in ring_store for g in graphs):
+        sizes = {g: len(ring_store.nodes[g]) for g in graphs}
+    elif shards is not None:
+        print(f">>> no size index for {annot_path}, reading every graph from the shards to get its size.")
+        sizes = {g: annot['graph'].number_of_nodes() for g, annot in tqdm(shards.stream(graphs), total=len(graphs))}
+    else:
+        print(f">>> no size index for {annot_path}, loading every graph to get its size.")
+        sizes = build_size_index(annot_path, graphs)
+    return [sizes[g] for g in graphs]
+
+
+def caller(annot_id='samples'):
+    dump_dir = os.path.join(script_dir, '..', 'data', 'sizes')
+    try:
+        os.mkdir(dump_dir)
+    except FileExistsError:
+        pass
+    sizes = build_size_index(os.path.join(script_dir, '..', 'data', 'annotated', annot_id))
+    pickle.dump(sizes, open(size_index_path(annot_id), 'wb'))
+    print(f">>> dumped the sizes of {len(sizes)} graphs in {size_index_path(annot_id)}")
+    pass
+
+
+if __name__ == '__main__':
+    args = cline()
+    caller(**vars(args))
@@ -0,0 +1,186 @@
+"""
+Landmark rings for Nyström style kernel targets.
+
+Instead of comparing all pairs of nodes of a batch, each node is compared to a fixed set of m landmark rings.
+The landmarks are chosen among the ring signatures of an annotated dataset by greedy k-center: starting from the most
+frequent signature, we repeatedly add the signature that is the least similar to all the landmarks so far.
+This computes the similarity of every signature to every landmark, which we dump as a float32 (n_signatures, m) .npy
+along with the landmark to landmark similarities and the signature ids of the nodes of each graph, like
+prepare_data/signatures.py does. Training then only reads the rows of the nodes of a batch.
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import pickle
+import multiprocessing as mlt
+
+import numpy as np
+from tqdm import tqdm
+
+from tools.node_sim import SimFunctionNode
+from prepare_data.signatures import collect_signatures, table_config, table_name
+
+# Set in each worker by the pool initializer, to avoid pickling the rings for every landmark
+_node_sim = None
+_rings = None
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--annot_id", default='samples', type=str, help="Annotated data ID.")
+    parser.add_argument("-m", "--num_landmarks", default=256, type=int, help="Number of landmarks.")
+    parser.add_argument('-sf', '--sim_function', type=str, default="R_iso", help='Node similarity function.')
+    parser.add_argument("-kd", "--kernel_depth", type=int, default=3, help="Number of hops to use in kernel.")
+    parser.add_argument("--decay", type=float, default=0.8, help="decay for the kernel")
+    parser.add_argument("--idf", default=False, action='store_true', help="To use or not idf")
+    parser.add_argument('-norm', '--normalization', type=str, default='sqrt',
+                        help='Normalization function (Supported Options None, sqrt, log)')
+    parser.add_argument("-p", "--parallel", default=False, action='store_true', help='Multiprocess the comparisons.')
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def landmarks_name(annot_id, node_sim, num_landmarks):
+    return f"{table_name(annot_id, node_sim)}_landmarks{num_landmarks}"
+
+
+def landmarks_path(name):
+    return os.path.join(script_dir, '..', 'data', 'signatures', name)
+
+
+def _init_worker(node_sim, rings):
+    global _node_sim, _rings
+    _node_sim = node_sim
+    _rings = rings
+
+
+def _compare_chunk(args):
+    """
+    Similarities between the landmark and a chunk of rings, all computed together by compare_pairs
+    """
+    landmark, start, stop = args
+    rings = _rings[start:stop] + [_rings[landmark]]
+    pairs = np.stack([np.arange(len(rings) - 1), np.full(len(rings) - 1, len(rings) - 1)], axis=1)
+    return _node_sim.compare_pairs(rings, pairs)
+
+
+def landmark_column(node_sim, rings, landmark, pool=None, counts=None, chunksize=1000):
+    """
+    :param counts: for R_1, the counts and weights of rings_to_counts of all rings, computed once by the caller
+    :return: the similarities of all rings to rings[landmark]
+    """
+    if node_sim.method == 'R_1':
+        counts, weights = node_sim.rings_to_counts(rings) if counts is None else counts
+        return node_sim.R_1_counts_block(counts, counts[[landmark]], weights)[:, 0]
+    chunks = [(landmark, start, start + chunksize) for start in range(0, len(rings), chunksize)]
+    if pool is None:
+        _init_worker(node_sim, rings)
+        values = map(_compare_chunk, chunks)
+    else:
+        values = pool.imap(_compare_chunk, chunks)
+    return np.concatenate(list(values))
+
+
+def select_landmarks(node_sim, rings, frequencies, num_landmarks, parallel=False):
+    """
+    Greedy k-center over ring signatures, with 1 - similarity as the distance.
+    :param node_sim: the SimFunctionNode to use
+    :param rings: one ring per signature
+    :param frequencies: number of nodes of each signature, we start from the most frequent one
+    :param num_landmarks: number of landmarks
+    :param parallel: compute the comparisons with a process pool
+    :return: the landmark indices in rings and the (n_rings, num_landmarks) similarities
+    """
+    num_landmarks = min(num_landmarks, len(rings))
+    counts = node_sim.rings_to_counts(rings) if node_sim.method == 'R_1' else None
+    pool = mlt.Pool(initializer=_init_worker, initargs=(node_sim, rings)) if parallel and counts is None else None
+    landmarks = []
+    sims = np.zeros((len(rings), num_landmarks), dtype=np.float32)
+    closest = np.full(len(rings), -np.inf)
+    for k in tqdm(range(num_landmarks)):
+        landmark = int(np.argmax(frequencies)) if k == 0 else int(np.argmin(closest))
+        landmarks.append(landmark)
+        sims[:, k] = landmark_column(node_sim, rings, landmark, pool=pool, counts=counts)
+        closest = np.maximum(closest, sims[:, k])
+        # never pick a landmark twice, even when some rings are identical to it under the kernel
+        closest[landmarks] = np.inf
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return landmarks, sims
+
+
+def build_landmarks(annot_path, node_sim, num_landmarks, dump_path, parallel=False):
+    """
+    Choose the landmarks of an annotated dataset for one kernel configuration.
+    Dumps dump_path + '.npy' (the signature to landmark similarities) and dump_path + '_index.p'
+    :param annot_path: directory of annotated graphs
+    :param node_sim: the SimFunctionNode to use
+    :param num_landmarks: number of landmarks
+    :param dump_path: path prefix of the dumped files
+    :param parallel: compute the comparisons with a process pool
+    :return: the smallest similarity of a signature to its closest landmark
+    """
+    print(">>> collecting signatures.")
+    signature_index, rings, graph_ids = collect_signatures(annot_path, node_sim)
+    frequencies = np.bincount(np.concatenate(list(graph_ids.values())), minlength=len(rings))
+    print(f">>> found {len(rings)} signatures for {frequencies.sum()} nodes.")
+
+    landmarks, sims = select_landmarks(node_sim, rings, frequencies, num_landmarks, parallel=parallel)
+    np.save(dump_path + '.npy', sims)
+    pickle.dump({'config': table_config(node_sim),
+                 'signatures': signature_index,
+                 'graph_ids': graph_ids,
+                 'landmarks': [rings[landmark] for landmark in landmarks],
+                 'landmark_K': sims[landmarks]},
+                open(dump_path + '_index.p', 'wb'))
+    return sims.max(axis=1).min()
+
+
+def load_landmarks(landmarks_path, node_sim=None):
+    """
+    Load landmarks built with build_landmarks, memory mapped.
+    :param landmarks_path: path prefix of the landmarks
+    :param node_sim: if given, check that the landmarks were built with the same configuration
+    :return: the (n_signatures, num_landmarks) similarities and the index
+    """
+    index = pickle.load(open(landmarks_path + '_index.p', 'rb'))
+    if node_sim is not None and index['config'] != table_config(node_sim):
+        raise ValueError(f"The landmarks {landmarks_path} were built with {index['config']}, "
+                         f"not {table_config(node_sim)}")
+    sims = np.load(landmarks_path + '.npy', mmap_mode='r')
+    return sims, index
+
+
+def caller(annot_id='samples', num_landmarks=256, sim_function='R_iso', kernel_depth=3, decay=0.8, idf=False,
+           normalization='sqrt', parallel=False):
+    node_sim = SimFunctionNode(method=sim_function,
+                               depth=kernel_depth,
+                               decay=decay,
+                               idf=idf,
+                               normalization=normalization,
+                               hash_init=annot_id)
+    dump_dir = os.path.join(script_dir, '..', 'data', 'signatures')
+    try:
+        os.mkdir(dump_dir)
+    except FileExistsError:
+        pass
+    dump_path = landmarks_path(landmarks_name(annot_id, node_sim, num_landmarks))
+    coverage = build_landmarks(annot_path=os.path.join(script_dir, '..', 'data', 'annotated', annot_id),
+                               node_sim=node_sim,
+                               num_landmarks=num_landmarks,
+                               dump_path=dump_path,
+                               parallel=parallel)
+    print(f">>> every signature has a landmark with a similarity of at least {coverage:.3f}")
+    print(f">>> dumped landmarks in {dump_path}")
+    pass
+
+
+if __name__ == '__main__':
+    args = cline()
+    caller(**vars(args))
@@ -0,0 +1,133 @@
+"""
+Columnar store of the rings of an annotated dataset.
+
+Annotated files hold the rings of every node as nested lists of labels for the three levels, to depth 5. Training
+only reads one level to the kernel depth. For one level, we encode every item of every ring as an integer code (edge
+label or graphlet hash, see the vocabulary) in the smallest integer type that fits and lay all of them out in a flat
+array, node after node and hop after hop, in data/ring_store/<annot_id>_<level>/codes.npy. starts.npy holds where the
+rings of each node start and lengths.npy the number of items of each of their hops, so that the rings of a graph are
+slices of memory mapped arrays. index.p holds the vocabulary and the graph names, with the nodes of each graph in
+sorted order.
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import pickle
+
+import numpy as np
+from tqdm import tqdm
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--annot_id", default='samples', type=str, help="Annotated data ID.")
+    parser.add_argument("-l", "--levels", nargs='+', default=['edge', 'graphlet'], help="Ring levels to store.")
+    parser.add_argument("-d", "--depth", default=5, type=int, help="Number of hops to store.")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def ring_store_path(annot_id, level):
+    return os.path.join(script_dir, '..', 'data', 'ring_store', f"{annot_id}_{level}")
+
+
+def build_ring_store(annot_path, store_dir, level='edge', depth=5):
+    """
+    Encode the rings of one level of an annotated dataset.
+    :param annot_path: directory of annotated graphs
+    :param store_dir: directory of the store
+    :param level: 'edge' or 'graphlet'
+    :param depth: rings are stored up to this hop (included)
+    :return: the number of nodes
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    n_hops = depth + 1
+    vocab = {None: -1}
+    codes = []
+    lengths = []
+    graphs = sorted(os.listdir(annot_path))
+    nodes = {}
+    for g in tqdm(graphs):
+        rings = pickle.load(open(os.path.join(annot_path, g), 'rb'))['rings'][level]
+        nodes[g] = sorted(rings)
+        for node in nodes[g]:
+            ring = rings[node][:n_hops]
+            for hop in ring:
+                codes.extend(vocab.setdefault(item, len(vocab) - 1) for item in hop)
+            lengths.append([len(hop) for hop in ring] + [0] * (n_hops - len(ring)))
+
+    lengths = np.array(lengths, dtype=np.uint16).reshape(-1, n_hops)
+    starts = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths.sum(axis=1), out=starts[1:])
+    code_type = np.int8 if len(vocab) < 2 ** 7 else np.int16 if len(vocab) < 2 ** 15 else np.int32
+    np.save(os.path.join(store_dir, 'codes.npy'), np.array(codes, dtype=code_type))
+    np.save(os.path.join(store_dir, 'starts.npy'), starts)
+    np.save(os.path.join(store_dir, 'lengths.npy'), lengths)
+    n_nodes = np.cumsum([0] + [len(nodes[g]) for g in graphs])
+    pickle.dump({'level': level,
+                 'depth': depth,
+                 'vocab': [item for item, code in sorted(vocab.items(), key=lambda kv: kv[1]) if code >= 0],
+                 'graphs': {g: (int(n_nodes[i]), int(n_nodes[i + 1])) for i, g in enumerate(graphs)},
+                 'nodes': nodes},
+                open(os.path.join(store_dir, 'index.p'), 'wb'))
+    return int(n_nodes[-1])
+
+
+class RingStore:
+    """
+    Rings of a graph, decoded from a store built by build_ring_store, as a {node: ring} dict like the annotated files.
+    """
+
+    def __init__(self, store_dir, depth=None):
+        """
+        :param store_dir: directory of the store
+        :param depth: only decode the rings up to this hop (included), all the stored hops by default
+        """
+        index = pickle.load(open(os.path.join(store_dir, 'index.p'), 'rb'))
+        self.level = index['level']
+        self.n_hops = index['depth'] + 1
+        if depth is not None and depth > index['depth']:
+            raise ValueError(f"{store_dir} only holds rings to depth {index['depth']}, not {depth}")
+        self.depth = index['depth'] if depth is None else depth
+        # code -1 stands for the None at the root of edge rings
+        self.vocab = np.array(index['vocab'] + [None], dtype=object)
+        self.graphs = index['graphs']
+        self.nodes = index['nodes']
+        self.codes = np.load(os.path.join(store_dir, 'codes.npy'), mmap_mode='r')
+        self.starts = np.load(os.path.join(store_dir, 'starts.npy'), mmap_mode='r')
+        self.lengths = np.load(os.path.join(store_dir, 'lengths.npy'), mmap_mode='r')
+
+    def __contains__(self, name):
+        return name in self.graphs
+
+    def rings(self, name):
+        start, stop = self.graphs[name]
+        starts = np.asarray(self.starts[start:stop + 1])
+        items = self.vocab[self.codes[starts[0]:starts[-1]]].tolist()
+        # where each kept hop starts and stops in items
+        hops = np.zeros((stop - start, self.depth + 2), dtype=np.int64)
+        hops[:, 0] = starts[:-1] - starts[0]
+        hops[:, 1:] = hops[:, :1] + np.cumsum(self.lengths[start:stop, :self.depth + 1], axis=1, dtype=np.int64)
+        hops = hops.tolist()
+        rings = {}
+        for node, bounds in zip(self.nodes[name], hops):
+            rings[node] = [items[bounds[k]:bounds[k + 1]] for k in range(self.depth + 1)]
+        return rings
+
+
+def caller(annot_id='samples', levels=('edge', 'graphlet'), depth=5):
+    annot_path = os.path.join(script_dir, '..', 'data', 'annotated', annot_id)
+    for level in levels:
+        n = build_ring_store(annot_path, ring_store_path(annot_id, level), level=level, depth=depth)
+        print(f">>> stored the {level} rings of {n} nodes in {ring_store_path(annot_id, level)}")
+    pass
+
+
+if __name__ == '__main__':
+    args = cline()
+    caller(**vars(args))
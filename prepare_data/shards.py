@@ -0,0 +1,137 @@
+"""
+Packed annotated datasets.
+
+An annotated dataset is thousands of small pickles, so reading it is dominated by opening files. We concatenate the
+files as they are into a few large shards (data/shards/<annot_id>/shard_<i>.bin) and keep the shard, offset and length
+of each of them in data/shards/<annot_id>/index.p. Items are then read with a single positioned read, and a list of
+graphs can be streamed in the order they are stored in.
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import pickle
+
+from tqdm import tqdm
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--annot_id", default='samples', type=str, help="Annotated data ID.")
+    parser.add_argument("-s", "--shard_size", default=256, type=int, help="Size of the shards in MB.")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def shards_path(annot_id):
+    return os.path.join(script_dir, '..', 'data', 'shards', annot_id)
+
+
+def pack_shards(annot_path, shard_dir, shard_size=256 * 2 ** 20):
+    """
+    Concatenate the files of an annotated dataset into shards.
+    :param annot_path: directory of annotated graphs
+    :param shard_dir: directory of the shards and their index
+    :param shard_size: a new shard is started when the current one is larger than this, in bytes
+    :return: the number of shards
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    positions = {}
+    shard_files = []
+    shard = None
+    for g in tqdm(sorted(os.listdir(annot_path))):
+        if shard is None or shard.tell() >= shard_size:
+            if shard is not None:
+                shard.close()
+            shard_files.append(f"shard_{len(shard_files)}.bin")
+            shard = open(os.path.join(shard_dir, shard_files[-1]), 'wb')
+        with open(os.path.join(annot_path, g), 'rb') as f:
+            content = f.read()
+        positions[g] = (len(shard_files) - 1, shard.tell(), len(content))
+        shard.write(content)
+    if shard is not None:
+        shard.close()
+    pickle.dump({'shard_files': shard_files, 'positions': positions}, open(os.path.join(shard_dir, 'index.p'), 'wb'))
+    return len(shard_files)
+
+
+class Shards:
+    """
+    Read access to the files packed by pack_shards, by name.
+    Reads are positioned (os.pread) so that forked DataLoader workers can share the open shards.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        index = pickle.load(open(os.path.join(shard_dir, 'index.p'), 'rb'))
+        self.shard_files = index['shard_files']
+        self.positions = index['positions']
+        self.names = sorted(self.positions)
+        self.fds = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def __getstate__(self):
+        # Open files are not sent to other processes, they reopen the shards
+        return dict(self.__dict__, fds={})
+
+    def read(self, name):
+        """
+        :return: the content of the file name
+        """
+        shard, offset, length = self.positions[name]
+        if shard not in self.fds:
+            self.fds[shard] = os.open(os.path.join(self.shard_dir, self.shard_files[shard]), os.O_RDONLY)
+        return os.pread(self.fds[shard], length, offset)
+
+    def load(self, name):
+        """
+        :return: the unpickled file name, an annotation dict or a graph
+        """
+        return pickle.loads(self.read(name))
+
+    def order(self, names):
+        """
+        :return: names sorted in the order they are stored in
+        """
+        return sorted(names, key=lambda name: self.positions[name][:2])
+
+    def stream(self, names=None):
+        """
+        Unpickle the files sequentially, shard by shard.
+        :param names: the files to read, all of them by default
+        :return: a generator of (name, unpickled file)
+        """
+        names = self.names if names is None else self.order(names)
+        shard, f = None, None
+        for name in names:
+            position = self.positions[name]
+            if position[0] != shard:
+                if f is not None:
+                    f.close()
+                shard = position[0]
+                f = open(os.path.join(self.shard_dir, self.shard_files[shard]), 'rb')
+            f.seek(position[1])
+            yield name, pickle.loads(f.read(position[2]))
+        if f is not None:
+            f.close()
+
+
+def caller(annot_id='samples', shard_size=256):
+    n = pack_shards(os.path.join(script_dir, '..', 'data', 'annotated', annot_id), shards_path(annot_id),
+                    shard_size=shard_size * 2 ** 20)
+    print(f">>> packed {annot_id} in {n} shards in {shards_path(annot_id)}")
+    pass
+
+
+if __name__ == '__main__':
+    args = cline()
+    caller(**vars(args))
@@ -0,0 +1,207 @@
+"""
+Offline similarity table between ring signatures.
+
+Ring signatures (see SimFunctionNode.ring_signature) repeat a lot across an annotated dataset.
+For a given kernel configuration, we list every distinct signature, compute their pairwise similarities once and dump
+them as a float32 .npy to be memory mapped at training time, along with a signature -> id index and the
+signature ids of the nodes of each graph (in sorted node order, like the K matrix).
+The table is filled by blocks of rows, so that building it only needs memory for one block.
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import pickle
+import multiprocessing as mlt
+
+import numpy as np
+from tqdm import tqdm
+
+from tools.node_sim import SimFunctionNode
+
+# Set in each worker by the pool initializer, to avoid pickling the rings for every row
+_node_sim = None
+_rings = None
+
+# Size in bytes of a block of rows of R_1 similarities, and number of rows of a job of the other methods
+R_1_BLOCK_BYTES = 2 ** 26
+ROWS_PER_JOB = 16
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--annot_id", default='samples', type=str, help="Annotated data ID.")
+    parser.add_argument('-sf', '--sim_function', type=str, default="R_iso", help='Node similarity function.')
+    parser.add_argument("-kd", "--kernel_depth", type=int, default=3, help="Number of hops to use in kernel.")
+    parser.add_argument("--decay", type=float, default=0.8, help="decay for the kernel")
+    parser.add_argument("--idf", default=False, action='store_true', help="To use or not idf")
+    parser.add_argument('-norm', '--normalization', type=str, default='sqrt',
+                        help='Normalization function (Supported Options None, sqrt, log)')
+    parser.add_argument("-p", "--parallel", default=False, action='store_true', help='Multiprocess the table.')
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def level_from_simfunc(node_sim):
+    return 'graphlet' if node_sim.method in ['R_graphlets', 'graphlet'] else 'edge'
+
+
+def table_config(node_sim):
+    """
+    The parameters the similarity values depend on.
+    """
+    return {'method': node_sim.method,
+            'depth': node_sim.depth,
+            'decay': node_sim.decay,
+            'idf': node_sim.idf is not None,
+            # None, False or 'None' all mean no normalization
+            'normalization': node_sim.normalization if node_sim.normalization in ['sqrt', 'log'] else None}
+
+
+def table_name(annot_id, node_sim):
+    config = table_config(node_sim)
+    return f"{annot_id}_{config['method']}_d{config['depth']}_decay{config['decay']}" \
+           f"_idf{int(config['idf'])}_{config['normalization']}"
+
+
+def collect_signatures(annot_path, node_sim):
+    """
+    Go through an annotated dataset and list its distinct ring signatures.
+    :param annot_path: directory of annotated graphs
+    :param node_sim: the SimFunctionNode the table is built for
+    :return: the signature -> id index, one ring per signature and the signature ids of each graph
+    """
+    level = level_from_simfunc(node_sim)
+    signature_index = {}
+    rings = []
+    graph_ids = {}
+    for g in tqdm(sorted(os.listdir(annot_path))):
+        annot = pickle.load(open(os.path.join(annot_path, g), 'rb'))
+        ids = []
+        for ring in annot['rings'][level].values():
+            signature = node_sim.ring_signature(ring)
+            try:
+                ids.append(signature_index[signature])
+            except KeyError:
+                signature_index[signature] = len(rings)
+                ids.append(len(rings))
+                rings.append(ring)
+        graph_ids[g] = np.array(ids, dtype=np.int64)
+    return signature_index, rings, graph_ids
+
+
+def _init_worker(node_sim, rings):
+    global _node_sim, _rings
+    _node_sim = node_sim
+    _rings = rings
+
+
+def _compute_rows(rows):
+    """
+    Similarities between signature i and signatures i..n for i in rows, all computed together by compare_pairs
+    :return: a list of (i, similarities)
+    """
+    n = len(_rings)
+    pairs = np.array([(i, j) for i in rows for j in range(i, n)], dtype=np.int64).reshape(-1, 2)
+    values = _node_sim.compare_pairs(_rings, pairs).astype(np.float32)
+    results, start = [], 0
+    for i in rows:
+        row = values[start:start + n - i]
+        row[0] = 1.
+        results.append((i, row))
+        start += n - i
+    return results
+
+
+def build_sim_table(annot_path, node_sim, dump_path, parallel=True):
+    """
+    Build the signature similarity table of an annotated dataset for one kernel configuration.
+    Dumps dump_path + '.npy' (the similarity matrix) and dump_path + '_index.p'
+    :param annot_path: directory of annotated graphs
+    :param node_sim: the SimFunctionNode to use
+    :param dump_path: path prefix of the dumped files
+    :param parallel: compute the rows with a process pool
+    :return: the number of distinct signatures
+    """
+    print(">>> collecting signatures.")
+    signature_index, rings, graph_ids = collect_signatures(annot_path, node_sim)
+    n = len(rings)
+    n_nodes = sum(len(ids) for ids in graph_ids.values())
+    print(f">>> found {n} signatures for {n_nodes} nodes.")
+
+    table = np.lib.format.open_memmap(dump_path + '.npy', mode='w+', dtype=np.float32, shape=(n, n))
+    if node_sim.method == 'R_1':
+        counts, weights = node_sim.rings_to_counts(rings)
+        block_rows = max(1, R_1_BLOCK_BYTES // (8 * max(n, 1)))
+        for start in tqdm(range(0, n, block_rows)):
+            table[start:start + block_rows] = node_sim.R_1_counts_block(counts[start:start + block_rows], counts,
+                                                                        weights)
+            table.flush()
+    else:
+        _init_worker(node_sim, rings)
+        jobs = [range(start, min(start + ROWS_PER_JOB, n)) for start in range(0, n, ROWS_PER_JOB)]
+        if parallel:
+            pool = mlt.Pool(initializer=_init_worker, initargs=(node_sim, rings))
+            results = pool.imap_unordered(_compute_rows, jobs)
+        else:
+            results = map(_compute_rows, jobs)
+        for rows in tqdm(results, total=len(jobs)):
+            for i, values in rows:
+                table[i, i:] = values
+                table[i:, i] = values
+        if parallel:
+            pool.close()
+            pool.join()
+    table.flush()
+
+    pickle.dump({'config': table_config(node_sim),
+                 'signatures': signature_index,
+                 'graph_ids': graph_ids},
+                open(dump_path + '_index.p', 'wb'))
+    return n
+
+
+def load_sim_table(table_path, node_sim=None):
+    """
+    Load a table built with build_sim_table, memory mapped.
+    :param table_path: path prefix of the table
+    :param node_sim: if given, check that the table was built with the same configuration
+    :return: the similarity matrix and the index
+    """
+    index = pickle.load(open(table_path + '_index.p', 'rb'))
+    if node_sim is not None and index['config'] != table_config(node_sim):
+        raise ValueError(f"The similarity table {table_path} was built with {index['config']}, "
+                         f"not {table_config(node_sim)}")
+    table = np.load(table_path + '.npy', mmap_mode='r')
+    return table, index
+
+
+def caller(annot_id='samples', sim_function='R_iso', kernel_depth=3, decay=0.8, idf=False, normalization='sqrt',
+           parallel=False):
+    node_sim = SimFunctionNode(method=sim_function,
+                               depth=kernel_depth,
+                               decay=decay,
+                               idf=idf,
+                               normalization=normalization,
+                               hash_init=annot_id)
+    dump_dir = os.path.join(script_dir, '..', 'data', 'signatures')
+    try:
+        os.mkdir(dump_dir)
+    except FileExistsError:
+        pass
+    dump_path = os.path.join(dump_dir, table_name(annot_id, node_sim))
+    build_sim_table(annot_path=os.path.join(script_dir, '..', 'data', 'annotated', annot_id),
+                    node_sim=node_sim,
+                    dump_path=dump_path,
+                    parallel=parallel)
+    print(f">>> dumped similarity table in {dump_path}")
+    pass
+
+
+if __name__ == '__main__':
+    args = cline()
+    caller(**vars(args))
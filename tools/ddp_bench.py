@@ -0,0 +1,155 @@
+"""
+Scaling benchmark of data parallel training on CPUs (see train_embeddings/distributed.py).
+
+For each number of processes, trains the model of the default .ini (and an optional additional one) for a fixed number
+of steps on an annotated dataset and measures the throughput of all the processes together. Every process takes
+batches of batch_size graphs, so a step of P processes trains on P times more graphs:
+
+python tools/ddp_bench.py -a samples -p 1 2 4 8 -s 50 -o ddp.json
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import json
+import platform
+from time import perf_counter
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from train_embeddings.distributed import setup, cleanup, make_optimizer
+from train_embeddings.loader import loader_from_hparams
+from train_embeddings.model import model_from_hparams
+from train_embeddings.learn import send_graph_to_device, send_target_to_device
+from tools.learning_utils import ConfParser
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--annot_id", default='samples', type=str, help="Annotated data ID.")
+    parser.add_argument("-p", "--procs", nargs='+', type=int, default=[1, 2, 4, 8],
+                        help="Numbers of processes to benchmark.")
+    parser.add_argument("-s", "--steps", type=int, default=50, help="Number of timed training steps.")
+    parser.add_argument("-w", "--warmup", type=int, default=5, help="Number of training steps before timing.")
+    parser.add_argument("-bs", "--batch_size", type=int, default=8, help="Batch size of each process.")
+    parser.add_argument("-nw", "--workers", type=int, default=0, help="Number of workers to load data per process.")
+    parser.add_argument("-ini", "--ini", default=None, help="name of an additional .ini of train_embeddings/inis")
+    parser.add_argument("--master_port", type=int, default=29500, help="First of the ports used, one per run.")
+    parser.add_argument("-o", "--output", default=None, help="Path of the JSON results.")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def bench_hparams(annot_id, batch_size=8, workers=0, ini=None):
+    ini_dir = os.path.join(script_dir, '..', 'train_embeddings', 'inis')
+    hparams = ConfParser(default_path=os.path.join(ini_dir, 'default.ini'),
+                         path_to_ini=None if ini is None else os.path.join(ini_dir, f'{ini}.ini'))
+    hparams.add_value('argparse', 'annotated_data', annot_id)
+    hparams.add_value('argparse', 'batch_size', batch_size)
+    hparams.add_value('argparse', 'workers', workers)
+    return hparams
+
+
+def bench_worker(rank, world_size, hparams, steps, warmup, master_port, results):
+    """
+    Time steps training steps in one of world_size processes, rank 0 puts the totals in the results queue
+    """
+    setup(rank, world_size, master_port=master_port, threads=max(1, os.cpu_count() // world_size))
+    device = torch.device('cpu')
+    annotated_path = os.path.join(script_dir, '..', 'data', 'annotated', hparams.get('argparse', 'annotated_data'))
+    loader = loader_from_hparams(annotated_path=annotated_path, hparams=hparams, rank=rank, world_size=world_size)
+    hparams.add_value('argparse', 'num_edge_types', loader.num_edge_types)
+    train_loader, _, _ = loader.get_data()
+    if len(train_loader) == 0:
+        raise ValueError(f'there are not enough points compared to the BS for {world_size} processes')
+
+    model = DistributedDataParallel(model_from_hparams(hparams=hparams, verbose=False))
+    optimizer = make_optimizer(model, hparams.get('argparse', 'optim'), hparams.get('argparse', 'lr'))
+    model.train()
+
+    step, graphs, nodes = 0, 0, 0
+    start = perf_counter()
+    while step < warmup + steps:
+        for graph, K, inds, graph_sizes in train_loader:
+            if step == warmup:
+                dist.barrier()
+                start = perf_counter()
+                graphs, nodes = 0, 0
+            K = send_target_to_device(K, device)
+            graph = send_graph_to_device(graph, device)
+            out = model(graph)
+            loss = model.module.rec_loss(embeddings=out,
+                                         target_K=K,
+                                         graph=graph,
+                                         graph_indices=inds,
+                                         graph_sizes=graph_sizes)
+            loss.backward()
+            optimizer.step()
+            model.zero_grad()
+
+            graphs += len(graph_sizes)
+            nodes += int(sum(graph_sizes))
+            step += 1
+            if step == warmup + steps:
+                break
+    dist.barrier()
+    elapsed = perf_counter() - start
+    if hasattr(train_loader, 'close'):
+        train_loader.close()
+
+    totals = torch.tensor([graphs, nodes], dtype=torch.float64)
+    dist.all_reduce(totals)
+    if rank == 0:
+        results.put({'time': elapsed,
+                     'step_time': elapsed / steps,
+                     'graphs': int(totals[0]),
+                     'graphs_per_s': totals[0].item() / elapsed,
+                     'nodes_per_s': totals[1].item() / elapsed})
+    cleanup()
+
+
+def run_benchmark(hparams, procs=(1, 2, 4, 8), steps=50, warmup=5, master_port=29500):
+    """
+    :param hparams: a ConfParser of the training run to benchmark
+    :param procs: the numbers of processes to run it with
+    :return: a JSON serializable dict with the throughput of each number of processes
+    """
+    context = mp.get_context('spawn')
+    results = {}
+    for i, world_size in enumerate(procs):
+        queue = context.SimpleQueue()
+        mp.spawn(bench_worker, args=(world_size, hparams, steps, warmup, master_port + i, queue), nprocs=world_size)
+        results[world_size] = queue.get()
+        results[world_size]['speedup'] = results[world_size]['graphs_per_s'] / results[procs[0]]['graphs_per_s']
+        results[world_size]['efficiency'] = results[world_size]['speedup'] * procs[0] / world_size
+        print(f">>> {world_size} processes: {results[world_size]['graphs_per_s']:.1f} graphs/s, "
+              f"{1000 * results[world_size]['step_time']:.1f}ms per step, "
+              f"speedup {results[world_size]['speedup']:.2f}, efficiency {results[world_size]['efficiency']:.2f}")
+    return {'config': {'annotated_data': hparams.get('argparse', 'annotated_data'),
+                       'batch_size': hparams.get('argparse', 'batch_size'),
+                       'sim_function': hparams.get('argparse', 'sim_function'),
+                       'steps': steps,
+                       'warmup': warmup,
+                       'cpu_count': os.cpu_count(),
+                       'platform': platform.platform(),
+                       'torch': torch.__version__},
+            'results': results}
+
+
+if __name__ == '__main__':
+    args = cline()
+    bench = run_benchmark(bench_hparams(args.annot_id, batch_size=args.batch_size, workers=args.workers, ini=args.ini),
+                          procs=args.procs,
+                          steps=args.steps,
+                          warmup=args.warmup,
+                          master_port=args.master_port)
+    if args.output is not None:
+        json.dump(bench, open(args.output, 'w'), indent=2)
+        print(f">>> dumped results in {args.output}")
@@ -0,0 +1,112 @@
+"""
+Timing benchmark of the networkx to DGL conversion.
+
+Compares the former conversion (a torch tensor per edge set as a networkx attribute, then DGLGraph.from_networkx)
+with tools.graph_utils.nx_to_dgl on the graphs of an annotated dataset, and checks that both give the same edges:
+
+python tools/dgl_bench.py -a samples -n 500
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import json
+import pickle
+from time import perf_counter
+
+import numpy as np
+import networkx as nx
+import torch
+import dgl
+
+from tools.graph_utils import nx_to_dgl
+from tools.node_sim import EDGE_MAP
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--annot_id", default='samples', type=str, help="Annotated data ID.")
+    parser.add_argument("-n", "--num_graphs", type=int, default=500, help="Number of graphs to convert.")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Number of times each measure is repeated.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the choice of graphs.")
+    parser.add_argument("-o", "--output", default=None, help="Path of the JSON results.")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def from_networkx(graph, edge_map):
+    """
+    The conversion nx_to_dgl replaces.
+    """
+    graph = nx.to_undirected(graph)
+    one_hot = {edge: torch.tensor(edge_map[label]) for edge, label in
+               (nx.get_edge_attributes(graph, 'label')).items()}
+    nx.set_edge_attributes(graph, name='one_hot', values=one_hot)
+
+    g_dgl = dgl.DGLGraph()
+    g_dgl.from_networkx(nx_graph=graph, edge_attrs=['one_hot'])
+    return g_dgl
+
+
+def edge_set(g_dgl):
+    src, dst = g_dgl.all_edges()
+    return sorted(zip(src.tolist(), dst.tolist(), g_dgl.edata['one_hot'].tolist()))
+
+
+def time_conversion(convert, graphs, edge_map, repeats=3):
+    """
+    :return: the timings of the conversion of all graphs, per graph
+    """
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        for graph in graphs:
+            convert(graph, edge_map)
+        times.append((perf_counter() - start) / len(graphs))
+    return times
+
+
+def run_benchmark(annot_path, num_graphs=500, repeats=3, seed=0, edge_map=EDGE_MAP):
+    """
+    :param annot_path: directory of annotated graphs
+    :param num_graphs: number of randomly drawn graphs to convert
+    :return: a JSON serializable dict with the timings of both conversions
+    """
+    rng = np.random.RandomState(seed)
+    graphlist = sorted(os.listdir(annot_path))
+    graphlist = rng.choice(graphlist, size=min(num_graphs, len(graphlist)), replace=False)
+    graphs = [pickle.load(open(os.path.join(annot_path, g), 'rb'))['graph'] for g in graphlist]
+    n_nodes = [len(graph) for graph in graphs]
+    print(f">>> {len(graphs)} graphs of {np.mean(n_nodes):.1f} nodes on average.")
+
+    for graph in graphs:
+        assert edge_set(from_networkx(graph, edge_map)) == edge_set(nx_to_dgl(graph, edge_map)[0]), \
+            "The conversions do not give the same graph"
+
+    results = {}
+    for name, convert in [('from_networkx', from_networkx),
+                          ('nx_to_dgl', lambda graph, edge_map: nx_to_dgl(graph, edge_map))]:
+        times = time_conversion(convert, graphs, edge_map, repeats=repeats)
+        results[name] = {'time': float(np.median(times)), 'times': times}
+        print(f">>> {name}: {1000 * np.median(times):.3f}ms per graph")
+    speedup = results['from_networkx']['time'] / results['nx_to_dgl']['time']
+    print(f">>> nx_to_dgl is {speedup:.1f}x faster")
+    return {'config': {'annot_path': annot_path, 'num_graphs': len(graphs), 'repeats': repeats, 'seed': seed,
+                       'mean_nodes': float(np.mean(n_nodes))},
+            'results': results,
+            'speedup': speedup}
+
+
+if __name__ == '__main__':
+    args = cline()
+    bench = run_benchmark(os.path.join(script_dir, '..', 'data', 'annotated', args.annot_id),
+                          num_graphs=args.num_graphs,
+                          repeats=args.repeats,
+                          seed=args.seed)
+    if args.output is not None:
+        json.dump(bench, open(args.output, 'w'), indent=2)
+        print(f">>> dumped results in {args.output}")
@@ -252,24 +252,42 @@ def reindex_nodes_raw(graph_dir, dump=None):
     return graphs
 
 
-def nx_to_dgl(graph, edge_map, embed_dim):
+def nx_to_dgl(graph, edge_map):
     """
-        Networkx graph to DGL.
+        Networkx graph to DGL, with the types of edge_map as integers in edata['one_hot'].
+        Like DGLGraph.from_networkx, the graph is made undirected, both directions of each
+        edge are added and nodes are numbered in sorted order, but the edge arrays are
+        built in a single pass and passed to DGL directly.
+        The number of incoming edges of each type of each node is kept in ndata['rel_degrees'],
+        the first layer of the embedder only depends on it.
+
+        :param graph: networkx graph with a 'label' on each edge
+        :param edge_map: edge label to edge type
+        :returns g_dgl, nodes: the DGLGraph and its nodes in DGL order
     """
 
     import torch
     import dgl
 
-    graph, _, ring = pickle.load(open(graph, 'rb'))
-    one_hot = {edge: edge_map[label] for edge, label in (nx.get_edge_attributes(graph, 'label')).items()}
-    nx.set_edge_attributes(graph, name='one_hot', values=one_hot)
-    one_hot = {edge: torch.tensor(edge_map[label]) for edge, label in (nx.get_edge_attributes(graph, 'label')).items()}
-    g_dgl = dgl.DGLGraph()
-    g_dgl.from_networkx(nx_graph=graph, edge_attrs=['one_hot'])
-    n_nodes = len(g_dgl.nodes())
-    g_dgl.ndata['h'] = torch.ones((n_nodes, embed_dim))
+    graph = nx.to_undirected(graph)
+    nodes = sorted(graph.nodes())
+    node_ids = {node: i for i, node in enumerate(nodes)}
+    edges = np.array([(node_ids[u], node_ids[v], edge_map[label]) for u, v, label in graph.edges(data='label')],
+                     dtype=np.int64).reshape(-1, 3)
+    # self loops only go one way
+    back = edges[edges[:, 0] != edges[:, 1]]
+    src = np.concatenate([edges[:, 0], back[:, 1]])
+    dst = np.concatenate([edges[:, 1], back[:, 0]])
+    etypes = np.concatenate([edges[:, 2], back[:, 2]])
 
-    return g_dgl
+    g_dgl = dgl.DGLGraph()
+    g_dgl.add_nodes(len(nodes))
+    g_dgl.add_edges(torch.from_numpy(src), torch.from_numpy(dst))
+    g_dgl.edata['one_hot'] = torch.from_numpy(etypes)
+    rel_degrees = np.zeros((len(nodes), max(edge_map.values()) + 1), dtype=np.float32)
+    np.add.at(rel_degrees, (dst, etypes), 1)
+    g_dgl.ndata['rel_degrees'] = torch.from_numpy(rel_degrees)
+    return g_dgl, nodes
 
 
 def dgl_to_nx(graph, edge_map):
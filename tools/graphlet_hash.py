@@ -31,6 +31,7 @@ from struct import *
 from tools.graph_utils import bfs_expand
 # from tools.rna_ged import ged
 from tools.rna_ged_nx import ged
+from prepare_data.shards import Shards
 
 iso_matrix = pickle.load(open(os.path.join(script_dir, '../data/iso_mat.p'), 'rb'))
 sub_matrix = np.ones_like(iso_matrix) - iso_matrix
@@ -135,19 +136,30 @@ def build_hash_table(graph_dir, hasher, graphlets=True,
                      max_graphs=0,
                      graphlet_size=1,
                      mode='count',
-                     annot=False):
+                     annot=False,
+                     shards=None):
+    """
+        :param shards: directory of the graph_dir files packed by prepare_data/shards.py,
+        to stream the graphs from instead of opening each file
+    """
     hash_table = {}
-    graphlist = os.listdir(graph_dir)
+    if shards is not None:
+        shards = Shards(shards)
+        graphlist = list(shards.names)
+    else:
+        graphlist = os.listdir(graph_dir)
     if max_graphs:
         graphlist = graphlist[:max_graphs]
     random.seed(0)
     random.shuffle(graphlist)
     start = time.time()
-    for g in tqdm(graphlist):
+    if shards is not None:
+        graphs = shards.stream(graphlist)
+    else:
+        graphs = ((g, pickle.load(open(os.path.join(graph_dir, g), 'rb'))) for g in graphlist)
+    for g, G in tqdm(graphs, total=len(graphlist)):
         if annot:
-            G = pickle.load(open(os.path.join(graph_dir, g), 'rb'))['graph']
-        else:
-            G = pickle.load(open(os.path.join(graph_dir, g), 'rb'))
+            G = G['graph']
 
 
         if graphlets:
@@ -170,6 +182,124 @@ def build_hash_table(graph_dir, hasher, graphlets=True,
     return hash_table
 
 
+class LazyHashTable:
+    """
+        Graphlet hash table that is only unpickled the first time a graphlet is accessed.
+        With a warm shared GED cache, processes never need the graphs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.table = None
+
+    def load(self):
+        if self.table is None:
+            print(f">>> loading hash table from {self.path}")
+            _, self.table = pickle.load(open(self.path, 'rb'))
+        return self.table
+
+    def __getitem__(self, h):
+        return self.load()[h]
+
+    def __contains__(self, h):
+        return h in self.load()
+
+    def __len__(self):
+        return len(self.load())
+
+    def keys(self):
+        return self.load().keys()
+
+    def items(self):
+        return self.load().items()
+
+    def __getstate__(self):
+        # Do not send the graphs to other processes
+        return {'path': self.path, 'table': None}
+
+
+def hash_ids_from_table(hash_path):
+    """
+        Integer id of each graphlet hash, cached next to the hash table so that it is
+        only computed once.
+        :param hash_path: path to the pickled (hasher, hash_table)
+        :return: {hash: id}
+    """
+    ids_path = os.path.splitext(hash_path)[0] + '_ids.p'
+    if os.path.exists(ids_path) and os.path.getmtime(ids_path) >= os.path.getmtime(hash_path):
+        return pickle.load(open(ids_path, 'rb'))
+    _, hash_table = pickle.load(open(hash_path, 'rb'))
+    hash_ids = {h: i for i, h in enumerate(sorted(hash_table.keys()))}
+    pickle.dump(hash_ids, open(ids_path, 'wb'))
+    return hash_ids
+
+
+class SharedGEDTable:
+    """
+        GED cache shared by all processes using the same file (DataLoader workers, later runs).
+        Values live in a file backed float64 memory map indexed by graphlet ids, so that cached values are the ones
+        ged() returned, and a uint8 memory map next to it marks the pairs already computed.
+        Both are dense (n_graphlets, n_graphlets) arrays, 9 bytes per pair : on a filesystem with sparse files, only
+        the pages holding computed pairs take disk space, otherwise the whole size is allocated, so the size is
+        bounded by max_size.
+        Inserts are plain symmetric writes without locks, the value before its mark : concurrent writers of a cell
+        write the same value, and a reader that misses a fresh write only recomputes it.
+    """
+
+    def __init__(self, hash_ids, path, max_size=2 ** 36):
+        """
+        :param hash_ids: {graphlet hash: id}
+        :param path: path of the values, the marks are in path with a _done suffix
+        :param max_size: maximum size in bytes of the two files together
+        """
+        self.hash_ids = hash_ids
+        self.path = path
+        self.done_path = os.path.splitext(path)[0] + '_done.npy'
+        n = len(hash_ids)
+        if not os.path.exists(path) or not os.path.exists(self.done_path):
+            if 9 * n * n > max_size:
+                raise ValueError(f"A GED cache of {n} graphlets takes {9 * n * n / 2 ** 30:.1f}GB, "
+                                 f"more than {max_size / 2 ** 30:.1f}GB")
+            np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(n, n)).flush()
+            np.lib.format.open_memmap(self.done_path, mode='w+', dtype=np.uint8, shape=(n, n)).flush()
+            if os.stat(path).st_blocks * 512 >= os.path.getsize(path) > 2 ** 20:
+                print(f">>> the GED cache {path} is not a sparse file, it takes {9 * n * n / 2 ** 20:.0f}MB on disk")
+        self.open()
+
+    def open(self):
+        self.values = np.load(self.path, mmap_mode='r+')
+        self.done = np.load(self.done_path, mmap_mode='r+')
+        if self.values.dtype != np.float64 or self.values.shape != (len(self.hash_ids),) * 2:
+            raise ValueError(f"{self.path} is not a GED cache of this hash table, delete it to start a new one")
+
+    def get(self, h_G, h_H):
+        i, j = self.hash_ids[h_G], self.hash_ids[h_H]
+        if not self.done[i, j]:
+            raise KeyError((h_G, h_H))
+        return float(self.values[i, j])
+
+    def set(self, h_G, h_H, value):
+        i, j = self.hash_ids[h_G], self.hash_ids[h_H]
+        self.values[i, j] = value
+        self.values[j, i] = value
+        self.done[i, j] = 1
+        self.done[j, i] = 1
+
+    def filled(self):
+        """
+            Fraction of the pairs that are already computed.
+        """
+        return np.count_nonzero(self.done) / self.done.size
+
+    def __getstate__(self):
+        # Reopen the memory maps instead of pickling their content
+        return {'hash_ids': self.hash_ids, 'path': self.path, 'done_path': self.done_path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+
 def GED_hashtable_hashed(h_G, h_H, GED_table, graphlet_table, normed=True,
                          max_edges=7,
                          beta=.50,
@@ -182,14 +312,20 @@ def GED_hashtable_hashed(h_G, h_H, GED_table, graphlet_table, normed=True,
         index of the graph in the bucket.
     """
 
-    try:
-        return GED_table[h_G][h_H]
-    except:
-        pass
-    try:
-        return GED_table[h_H][h_G]
-    except:
-        pass
+    if isinstance(GED_table, SharedGEDTable):
+        try:
+            return GED_table.get(h_G, h_H)
+        except KeyError:
+            pass
+    else:
+        try:
+            return GED_table[h_G][h_H]
+        except:
+            pass
+        try:
+            return GED_table[h_H][h_G]
+        except:
+            pass
 
     if not graphlet_table is None:
         G = graphlet_table[h_G]['graph']
@@ -208,7 +344,9 @@ def GED_hashtable_hashed(h_G, h_H, GED_table, graphlet_table, normed=True,
     # This is added by vincent, to use to be closer from the rest of the framework riso
     if similarity:
         similarity = np.exp(-beta * distance)
-        if not GED_table is None:
+        if isinstance(GED_table, SharedGEDTable):
+            GED_table.set(h_G, h_H, similarity)
+        elif not GED_table is None:
             GED_table[h_G][h_H] = similarity
         return similarity
 
@@ -218,7 +356,9 @@ def GED_hashtable_hashed(h_G, h_H, GED_table, graphlet_table, normed=True,
 
     # rna_draw_pair([G, H],
     # estimated_value=[0, d])
-    if not GED_table is None:
+    if isinstance(GED_table, SharedGEDTable):
+        GED_table.set(h_G, h_H, distance)
+    elif not GED_table is None:
         GED_table[h_G][h_H] = distance
     return distance
 
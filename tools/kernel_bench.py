@@ -0,0 +1,262 @@
+"""
+Timing benchmark of the node similarity functions.
+
+For each SimFunctionNode method, we time the batch level K computation (k_block_list) and single comparisons (compare)
+on ring sets of controlled size, either synthetic or drawn from an annotated dataset, with cold and warm caches.
+Results are dumped as JSON so that a later run can be compared against them to catch slowdowns:
+
+python tools/kernel_bench.py -m R_1 R_iso hungarian -s 100 500 -o bench.json
+python tools/kernel_bench.py -m R_1 R_iso hungarian -s 100 500 -o new.json --baseline bench.json
+"""
+import sys
+import os
+import argparse
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+import json
+import pickle
+import platform
+from collections import defaultdict
+from time import perf_counter
+
+import numpy as np
+
+from tools.node_sim import SimFunctionNode, k_block_list, EDGE_MAP
+
+# Frequencies of the labels in synthetic rings, the backbone dominates as in real data.
+SYNTHETIC_LABELS = ['B53'] * 8 + ['CWW'] * 4 + sorted(set(EDGE_MAP) - {'B53', 'CWW'})
+
+
+def cline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--methods", nargs='+', default=['R_1', 'R_iso', 'hungarian'],
+                        help="SimFunctionNode methods to benchmark.")
+    parser.add_argument("-s", "--sizes", nargs='+', type=int, default=[100, 500],
+                        help="Number of rings in each benchmarked set.")
+    parser.add_argument("-a", "--annot_id", default=None, type=str,
+                        help="Annotated data ID to draw real rings from, only synthetic rings are used if not given.")
+    parser.add_argument("--hash_init", default='whole_v3', type=str, help="Graphlet hash table for graphlet kernels.")
+    parser.add_argument("-kd", "--kernel_depth", type=int, default=3, help="Number of hops to use in kernel.")
+    parser.add_argument("--decay", type=float, default=0.8, help="decay for the kernel")
+    parser.add_argument("--idf", default=False, action='store_true', help="To use or not idf")
+    parser.add_argument('-norm', '--normalization', type=str, default='sqrt',
+                        help='Normalization function (Supported Options None, sqrt, log)')
+    parser.add_argument("-p", "--pairs", type=int, default=200, help="Number of single comparisons to time.")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Number of times each measure is repeated.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the ring sets and pairs.")
+    parser.add_argument("-o", "--output", default=None, help="Path of the JSON results.")
+    parser.add_argument("-b", "--baseline", default=None, help="JSON results of a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=1.2,
+                        help="Flag measures slower than tolerance times the baseline.")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def level_from_method(method):
+    return 'graphlet' if method in ['R_graphlets', 'graphlet'] else 'edge'
+
+
+def synthetic_rings(n, depth, level='edge', hashes=None, max_ring=5, graph_size=20, seed=0):
+    """
+    Random rings with the same structure as annotated ones, grouped in graphs like a training batch.
+    :param n: number of rings
+    :param depth: number of hops of the rings
+    :param level: 'edge' for edge label rings, 'graphlet' for graphlet hash rings
+    :param hashes: the graphlet hashes to draw from, for the graphlet level
+    :param max_ring: maximum number of items at each hop
+    :param graph_size: number of rings per graph
+    :param seed:
+    :return: a list of {node: ring} dicts
+    """
+    rng = np.random.RandomState(seed)
+    graphs = []
+    for i in range(n):
+        if i % graph_size == 0:
+            graphs.append({})
+        if level == 'edge':
+            ring = [[None]] + [rng.choice(SYNTHETIC_LABELS, size=rng.randint(max_ring + 1)).tolist()
+                               for _ in range(depth)]
+        else:
+            ring = [rng.choice(hashes, size=1).tolist()] + [rng.choice(hashes, size=rng.randint(max_ring + 1)).tolist()
+                                                            for _ in range(depth - 1)]
+        graphs[-1][(len(graphs), i)] = ring
+    return graphs
+
+
+def real_rings(annot_path, n, level='edge', seed=0):
+    """
+    Rings of randomly drawn annotated graphs, truncated to exactly n rings.
+    :param annot_path: directory of annotated graphs
+    :param n: number of rings
+    :param level: 'edge' or 'graphlet'
+    :param seed:
+    :return: a list of {node: ring} dicts
+    """
+    rng = np.random.RandomState(seed)
+    graphlist = sorted(os.listdir(annot_path))
+    graphs = []
+    total = 0
+    for g in rng.permutation(graphlist):
+        rings = pickle.load(open(os.path.join(annot_path, g), 'rb'))['rings'][level]
+        rings = dict(list(rings.items())[:n - total])
+        graphs.append(rings)
+        total += len(rings)
+        if total == n:
+            return graphs
+    raise ValueError(f"{annot_path} only has {total} rings, less than {n}")
+
+
+def reset_caches(node_sim):
+    """
+    Drop what a SimFunctionNode learnt from previous comparisons, so that the next measure is a cold one.
+    The shared GED cache lives on disk and is kept.
+    """
+    if isinstance(node_sim.GED_table, defaultdict):
+        node_sim.GED_table.clear()
+    if node_sim.assignments is not None:
+        node_sim.assignments.lru.clear()
+
+
+def time_batch(node_sim, graphs, repeats=3):
+    """
+    Time the K computation of a whole ring set.
+    :return: the cold and warm timings
+    """
+    timings = {'cold': [], 'warm': []}
+    for _ in range(repeats):
+        reset_caches(node_sim)
+        for cache in ['cold', 'warm']:
+            start = perf_counter()
+            k_block_list(graphs, node_sim)
+            timings[cache].append(perf_counter() - start)
+    return timings
+
+
+def time_pairs(node_sim, graphs, n_pairs=200, repeats=3, seed=0):
+    """
+    Time single comparisons between random pairs of rings of a set.
+    :return: the cold and warm timings, per comparison
+    """
+    rings = [ring for graph in graphs for ring in graph.values()]
+    rng = np.random.RandomState(seed)
+    pairs = rng.randint(len(rings), size=(n_pairs, 2))
+    timings = {'cold': [], 'warm': []}
+    for _ in range(repeats):
+        reset_caches(node_sim)
+        for cache in ['cold', 'warm']:
+            start = perf_counter()
+            for i, j in pairs:
+                node_sim.compare(rings[i], rings[j])
+            timings[cache].append((perf_counter() - start) / n_pairs)
+    return timings
+
+
+def run_benchmark(methods, sizes, annot_path=None, hash_init='whole_v3', kernel_depth=3, decay=0.8, idf=False,
+                  normalization='sqrt', pairs=200, repeats=3, seed=0):
+    """
+    Benchmark each method on each ring set.
+    :param methods: SimFunctionNode methods
+    :param sizes: numbers of rings in the ring sets
+    :param annot_path: directory of annotated graphs, if None only synthetic ring sets are used
+    :return: a JSON serializable dict with the configuration and one result per measure
+    """
+    config = {'methods': methods,
+              'sizes': sizes,
+              'annot_path': annot_path,
+              'hash_init': hash_init,
+              'kernel_depth': kernel_depth,
+              'decay': decay,
+              'idf': idf,
+              'normalization': normalization,
+              'pairs': pairs,
+              'repeats': repeats,
+              'seed': seed,
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.machine(),
+              'processor': platform.processor()}
+    results = []
+    for method in methods:
+        node_sim = SimFunctionNode(method=method,
+                                   depth=kernel_depth,
+                                   decay=decay,
+                                   idf=idf,
+                                   normalization=normalization,
+                                   hash_init=hash_init)
+        level = level_from_method(method)
+        hashes = sorted(node_sim.hash_table.keys()) if level == 'graphlet' else None
+        ring_sets = [('synthetic', size, synthetic_rings(size, kernel_depth, level=level, hashes=hashes, seed=seed))
+                     for size in sizes]
+        if annot_path is not None:
+            ring_sets += [('real', size, real_rings(annot_path, size, level=level, seed=seed)) for size in sizes]
+
+        for rings, size, graphs in ring_sets:
+            print(f">>> {method} on {size} {rings} rings")
+            measures = [('batch', time_batch(node_sim, graphs, repeats=repeats)),
+                        ('pair', time_pairs(node_sim, graphs, n_pairs=pairs, repeats=repeats, seed=seed))]
+            for measure, timings in measures:
+                for cache, times in timings.items():
+                    results.append({'method': method,
+                                    'rings': rings,
+                                    'size': size,
+                                    'measure': measure,
+                                    'cache': cache,
+                                    'time': float(np.median(times)),
+                                    'times': times})
+                    print(f">>> {measure} {cache}: {np.median(times):.6f}s")
+    return {'config': config, 'results': results}
+
+
+def result_key(result):
+    return result['method'], result['rings'], result['size'], result['measure'], result['cache']
+
+
+def compare_to_baseline(bench, baseline, tolerance=1.2):
+    """
+    Compare the results of two runs measure by measure.
+    :param bench: results of run_benchmark
+    :param baseline: results of a previous run_benchmark
+    :param tolerance: measures slower than tolerance times the baseline are flagged
+    :return: the list of flagged measures, with their slowdown ratio
+    """
+    baseline_times = {result_key(result): result['time'] for result in baseline['results']}
+    regressions = []
+    for result in bench['results']:
+        try:
+            ratio = result['time'] / baseline_times[result_key(result)]
+        except KeyError:
+            continue
+        flag = ratio > tolerance
+        if flag:
+            regressions.append(dict(result, ratio=ratio))
+        method, rings, size, measure, cache = result_key(result)
+        print(f">>> {'SLOWER' if flag else 'ok':6} {method} {rings} {size} {measure} {cache}: "
+              f"{ratio:.2f}x baseline")
+    return regressions
+
+
+if __name__ == '__main__':
+    args = cline()
+    annot_path = None if args.annot_id is None else os.path.join(script_dir, '..', 'data', 'annotated', args.annot_id)
+    bench = run_benchmark(methods=args.methods,
+                          sizes=args.sizes,
+                          annot_path=annot_path,
+                          hash_init=args.hash_init,
+                          kernel_depth=args.kernel_depth,
+                          decay=args.decay,
+                          idf=args.idf,
+                          normalization=args.normalization,
+                          pairs=args.pairs,
+                          repeats=args.repeats,
+                          seed=args.seed)
+    if args.output is not None:
+        json.dump(bench, open(args.output, 'w'), indent=2)
+        print(f">>> dumped results in {args.output}")
+    if args.baseline is not None:
+        regressions = compare_to_baseline(bench, json.load(open(args.baseline)), tolerance=args.tolerance)
+        if regressions:
+            print(f">>> {len(regressions)} measures are more than {args.tolerance}x slower than the baseline")
+            sys.exit(1)
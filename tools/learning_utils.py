@@ -19,7 +19,7 @@ if __name__ == "__main__":
 from train_embeddings.loader import Loader, loader_from_hparams
 from train_embeddings.model import Model, model_from_hparams
 from train_embeddings.learn import send_graph_to_device
-from tools.graph_utils import fetch_graph, get_nc_nodes_index
+from tools.graph_utils import get_nc_nodes_index, nx_to_dgl
 
 
 def remove(name):
@@ -151,19 +151,12 @@ def inference_on_graph(model,
         Do inference on one networkx graph.
     """
     graph = nx.to_undirected(graph)
-    one_hot = {edge: torch.tensor(edge_map[label]) for edge, label in
-               (nx.get_edge_attributes(graph, 'label')).items()}
-    nx.set_edge_attributes(graph, name='one_hot', values=one_hot)
-
-    g_dgl = dgl.DGLGraph()
-    g_dgl.from_networkx(nx_graph=graph, edge_attrs=['one_hot'])
+    g_dgl, g_nodes = nx_to_dgl(graph, edge_map)
     g_dgl = send_graph_to_device(g_dgl, device)
     model = model.to(device)
     with torch.no_grad():
         embs = model(g_dgl)
         embs.cpu().numpy()
-    g_nodes = list(sorted(graph.nodes()))
-
     keep_indices = range(len(graph.nodes()))
 
     if nc_only:
@@ -246,7 +239,8 @@ def inference_on_list(run,
                       max_graphs=None,
                       get_sim_mat=False,
                       nc_only=False,
-                      device='cuda' if torch.cuda.is_available() else 'cpu'
+                      device='cuda' if torch.cuda.is_available() else 'cpu',
+                      shards=None
                       ):
     """
     Same as before but one needs to provide a list of graphs name files in the annot path (of the form id_chunk_annot.p)
@@ -256,6 +250,7 @@ def inference_on_list(run,
     :param get_sim_mat:
     :param split_mode:
     :param device:
+    :param shards: directory of packed shards (prepare_data/shards.py) to stream the graphs from instead
     :return:
     """
 
@@ -263,7 +258,8 @@ def inference_on_list(run,
     model = load_model(run)
     inference_loader = loader_from_hparams(annotated_path=graphs_path,
                                            hparams=hparams,
-                                           list_inference=graph_list
+                                           list_inference=graph_list,
+                                           shards=shards
                                            )
     loader = inference_loader.get_data()
     model_outputs = predict(model,
@@ -326,7 +322,6 @@ def predict(model,
     """
 
     all_graphs = loader.dataset.all_graphs
-    graph_dir = loader.dataset.path
     Z = []
     Ks = []
     g_inds = []
@@ -351,8 +346,7 @@ def predict(model,
                 keep_indices = list(range(n_nodes))
 
                 # list of node ids from original graph
-                g_path = os.path.join(graph_dir, all_graphs[graph_index])
-                G = fetch_graph(g_path)
+                G = loader.dataset.fetch_graph(all_graphs[graph_index])
 
                 assert n_nodes == len(G.nodes())
                 if nc_only:
@@ -412,7 +406,6 @@ def predict_gen(model,
     :return:
     """
     all_graphs = loader.dataset.all_graphs
-    graph_dir = loader.dataset.path
 
     model = model.to(device)
     Ks = []
@@ -434,8 +427,7 @@ def predict_gen(model,
                 g_inds.extend(rep)
 
                 # list of node ids from original graph
-                g_path = os.path.join(graph_dir, all_graphs[graph_index])
-                G = fetch_graph(g_path)
+                G = loader.dataset.fetch_graph(all_graphs[graph_index])
                 g_nodes = sorted(G.nodes())
                 node_ids.extend([g_nodes[i] for i in range(n_nodes)])
             if max_graphs is not None and i > max_graphs - 1:
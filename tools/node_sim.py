@@ -2,13 +2,17 @@
 Functions for comparing node similarity.
 """
 import os, sys
+import logging
 import pickle
+import multiprocessing as mlt
 from collections import defaultdict, Counter, OrderedDict
 from itertools import combinations
 import numpy as np
 import networkx as nx
-import matplotlib.pyplot as plt
 from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+from scipy import sparse
+from tqdm import tqdm
 import pickle
 import itertools
 
@@ -24,6 +28,8 @@ from tools.graphlet_hash import *
 
 # GLOBAL VARIABLES
 
+logger = logging.getLogger(__name__)
+
 iso_matrix = pickle.load(open(os.path.join(script_dir, '../data/iso_mat.p'), 'rb'))
 # iso_matrix_ged = iso_matrix
 iso_matrix = iso_matrix[1:, 1:]
@@ -41,6 +47,175 @@ IDF = {'TSS': 1.3508944643423815, 'TWW': 2.2521850545837103, 'CWW': 0.7302387734
 
 indel_vector = [1 if e == 'B53' else 2 if e == 'CWW' else 3 for e in sorted(EDGE_MAP.keys())]
 
+# Codes of edge_map that are at least this isosteric are in the same class for the LSH of k_sparse_list
+ISO_CLASS_THRESHOLD = 0.6
+
+
+def iso_classes(threshold=ISO_CLASS_THRESHOLD):
+    """
+    Group the non backbone codes of edge_map by isostericity, linking the codes whose entry of iso_matrix is at least
+    threshold.
+    :param threshold: the isostericity above which two codes are in the same class
+    :return: the class of each code, the backbone (code 0) being a class of its own
+    """
+    from scipy.sparse.csgraph import connected_components
+
+    _, classes = connected_components(sparse.csr_matrix(iso_matrix >= threshold), directed=False)
+    return np.concatenate([[0], classes + 1])
+
+
+# itertools.permutations(range(n), k) as arrays, for max_assignment_brute
+PERMUTATIONS = {}
+
+
+def max_assignment_brute(cost):
+    """
+    Maximal assignment by enumerating all injective maps of the columns of cost into its rows.
+    This is exact and faster than linear_sum_assignment for the small matrices we get.
+    :param cost: a (n, k) array with n >= k
+    :return: the value of the best assignment
+    """
+    n, k = cost.shape
+    try:
+        perms = PERMUTATIONS[n, k]
+    except KeyError:
+        perms = PERMUTATIONS[n, k] = np.array(list(itertools.permutations(range(n), k)), dtype=np.int64)
+    return cost[perms, np.arange(k)].sum(axis=1).max()
+
+
+def max_assignment_stack(costs):
+    """
+    Maximal assignment of a stack of square cost matrices of the same size, by enumerating all permutations at once.
+    Only meant for small matrices (n <= 6 gives 720 permutations).
+    :param costs: a (batch, n, n) array
+    :return: the value of the best assignment of each matrix
+    """
+    n = costs.shape[1]
+    perms = PERMUTATIONS.get((n, n))
+    if perms is None:
+        perms = PERMUTATIONS[n, n] = np.array(list(itertools.permutations(range(n), n)), dtype=np.int64)
+    best = np.zeros(len(costs))
+    # Bound the size of the (chunk, n!, n) gather
+    chunk = max(1, 2 ** 22 // (len(perms) * n))
+    for start in range(0, len(costs), chunk):
+        values = costs[start:start + chunk][:, perms, np.arange(n)].sum(axis=2)
+        best[start:start + chunk] = values.max(axis=1)
+    return best
+
+
+def solve_assignment_batch(costs, max_brute=6):
+    """
+    Maximal assignment values of many small rectangular cost matrices.
+    Matrices are transposed to have at least as many columns as rows, grouped by number of columns and padded to
+    squares : padded rows cost 0 and padded columns cost -inf for real rows, so that real rows are always assigned
+    to real columns. Each group is solved with max_assignment_stack, larger matrices with linear_sum_assignment.
+    :param costs: a list of 2D arrays
+    :param max_brute: the largest size solved by enumeration
+    :return: an array with the value of each assignment
+    """
+    values = np.zeros(len(costs))
+    groups = defaultdict(list)
+    for i, cost in enumerate(costs):
+        if cost.shape[0] > cost.shape[1]:
+            cost = cost.T
+        if cost.shape[1] > max_brute:
+            row_ind, col_ind = linear_sum_assignment(-cost)
+            values[i] = cost[row_ind, col_ind].sum()
+        else:
+            groups[cost.shape[1]].append((i, cost))
+    for n, group in groups.items():
+        stack = np.zeros((len(group), n, n))
+        for b, (_, cost) in enumerate(group):
+            stack[b, :cost.shape[0], cost.shape[1]:] = -np.inf
+            stack[b, :cost.shape[0], :cost.shape[1]] = cost
+        values[[i for i, _ in group]] = max_assignment_stack(stack)
+    return values
+
+
+class AssignmentTable():
+    """
+    Memoization of the R_iso non backbone assignments, keyed by canonical multisets of labels.
+    Lookups go to a precomputed table first, then to a bounded LRU filled in process.
+    When the kernel runs in worker processes, share() makes them add up their hit and miss counts in shared memory.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.table = {}
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.shared = None
+        self.counted = True
+
+    def __len__(self):
+        return len(self.table) + len(self.lru)
+
+    def get(self, key):
+        try:
+            value = self.table[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        try:
+            value = self.lru[key]
+            self.lru.move_to_end(key)
+            self.hits += 1
+            return value
+        except KeyError:
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        self.lru[key] = value
+        if len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+    def share(self):
+        """
+        Count the hits and misses of the processes forked from this one, that call flush after each batch.
+        Processes that are spawned cannot inherit the shared counts, the counts are then unknown.
+        """
+        if mlt.get_start_method() == 'fork':
+            self.shared = mlt.Array('q', 2)
+        else:
+            self.counted = False
+
+    def flush(self):
+        """
+        Add the counts of this process to the shared counts
+        """
+        if self.shared is not None and (self.hits or self.misses):
+            with self.shared.get_lock():
+                self.shared[0] += self.hits
+                self.shared[1] += self.misses
+            self.hits, self.misses = 0, 0
+
+    def counts(self):
+        if self.shared is None:
+            return self.hits, self.misses
+        with self.shared.get_lock():
+            return self.hits + self.shared[0], self.misses + self.shared[1]
+
+    def hit_rate(self):
+        hits, misses = self.counts()
+        return hits / (hits + misses) if hits + misses else 0.
+
+    def stats(self):
+        """
+        :return: the hit and miss counts and the sizes of the tables, None if the counts are unknown (see share)
+        """
+        if not self.counted:
+            return None
+        hits, misses = self.counts()
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.,
+                'table_size': len(self.table),
+                # the LRUs of the workers are not shared
+                'lru_size': len(self.lru) if self.shared is None else None}
+
 
 def simfunc_from_hparams(hparams):
     """
@@ -55,6 +230,9 @@ def simfunc_from_hparams(hparams):
                                    decay=hparams.get('argparse', 'decay'),
                                    normalization=hparams.get('argparse', 'normalization'),
                                    edge_map=hparams.get('edges', 'edge_map'),
+                                   assignment_table=hparams.get('argparse', 'assignment_table'),
+                                   ged_cache=hparams.get('argparse', 'ged_cache'),
+                                   ged_matrix=hparams.get('argparse', 'ged_matrix'),
                                    )
     return node_simfunc
 
@@ -72,7 +250,19 @@ class SimFunctionNode():
                  normalization=None,
                  hash_init='whole_v3',
                  edge_map=EDGE_MAP,
-                 cache=True):
+                 cache=True,
+                 assignment_cache=100000,
+                 assignment_table=None,
+                 ged_cache=None,
+                 ged_matrix=False):
+        """
+        :param ged_cache: None for a GED cache local to this object. True or a path to share the GED values of the
+        graphlet kernels through a memory mapped file (default path : data/hashing/<hash_init>_ged_cache.npy)
+        :param ged_matrix: if True, read graphlet similarities from the matrix built by prepare_data/ged_matrix.py
+        instead of computing GEDs
+        :param assignment_cache: size of the in process LRU of R_iso assignments, 0 to disable memoization
+        :param assignment_table: path to a precomputed assignment table to load (see precompute_assignments)
+        """
 
         POSSIBLE_METHODS = ['R_1', 'R_iso', 'R_graphlets', 'R_ged', 'hungarian', 'graphlet']
         assert method in POSSIBLE_METHODS
@@ -93,11 +283,24 @@ class SimFunctionNode():
             self.GED_table = None
             self.hash_table = None
 
+        self.ged_matrix = None
         if cache and self.method in ['R_ged', 'R_graphlets', 'graphlet']:
             init_path = os.path.join(script_dir, '..', 'data', 'hashing', hash_init + '.p')
-            print(f">>> loading hash table from {init_path}")
-            self.hasher, self.hash_table = \
-                pickle.load(open(init_path, 'rb'))
+            if ged_matrix:
+                from prepare_data.ged_matrix import load_ged_matrix
+                print(f">>> loading GED matrix for {init_path}")
+                self.ged_matrix, self.hash_ids = load_ged_matrix(init_path)
+            elif ged_cache:
+                # The graphs are only needed for GED values that nobody computed yet
+                if ged_cache is True:
+                    ged_cache = os.path.join(script_dir, '..', 'data', 'hashing', hash_init + '_ged_cache.npy')
+                self.GED_table = SharedGEDTable(hash_ids_from_table(init_path), ged_cache)
+                self.hash_table = LazyHashTable(init_path)
+                print(f">>> using shared GED cache {ged_cache}")
+            else:
+                print(f">>> loading hash table from {init_path}")
+                self.hasher, self.hash_table = \
+                    pickle.load(open(init_path, 'rb'))
 
         if idf:
             global IDF
@@ -105,6 +308,30 @@ class SimFunctionNode():
         else:
             self.idf = None
 
+        # For R_iso, labels with the same isostericity class and the same IDF give the same assignments
+        # so we use the class as a key when it is possible, which makes the memoization much more effective.
+        self.label_keys = {}
+        for label, code in self.edge_map.items():
+            same_class = [other for other, other_code in self.edge_map.items() if other_code == code]
+            if self.idf is None or len({self.idf.get(other) for other in same_class}) == 1:
+                self.label_keys[label] = code
+            else:
+                self.label_keys[label] = label
+
+        # Labels that compare well share their tokens in the LSH of k_sparse_list (see lsh_tokens)
+        if self.method == 'R_1':
+            self.lsh_keys = self.label_keys
+        else:
+            classes = iso_classes()
+            self.lsh_keys = {label: classes[code] for label, code in self.edge_map.items()}
+
+        if self.method == 'R_iso' and assignment_cache:
+            self.assignments = AssignmentTable(maxsize=assignment_cache)
+            if assignment_table is not None:
+                self.load_assignments(assignment_table)
+        else:
+            self.assignments = None
+
         if self.method in ['R_1', 'R_iso', 'R_graphlets']:
             # depth+1 and -1 term at the end account for skipping the 0th hop in the rings.
             # we increase the size of the geometric sum by 1 and subtract 1 to remove the 0th term.
@@ -145,6 +372,52 @@ class SimFunctionNode():
                 res += self.decay ** k * value
         return res / self.norm_factor
 
+    def ring_signature(self, rings):
+        """
+        Hashable signature of the part of the rings used by compare : the sorted labels of each of the first
+        depth rings. All methods only depend on the multiset of labels at each depth, so two rings with the same
+        signature have a similarity of 1.
+        :param rings: a ring list
+        :return: a tuple of tuples
+        """
+        if self.method in ['R_graphlets', 'graphlet']:
+            hops = range(0, self.depth)
+        else:
+            hops = range(1, self.depth + 1)
+        return tuple(tuple(sorted(rings[k])) for k in hops)
+
+    def lsh_tokens(self, signature):
+        """
+        Tokens of a ring signature for the MinHash of k_sparse_list, chosen so that rings with a high similarity share
+        most of their tokens : labels are replaced by their key in label_keys for R_1 and by their isostericity class
+        for R_iso and hungarian, backbone counts are binned and an empty non backbone list is a token of its own.
+        hungarian matches labels across depths, so its tokens pool the depths. The tokens of the first depths are
+        repeated to weight them like compare does.
+        :param signature: a ring signature (see ring_signature)
+        :return: a list of distinct tokens
+        """
+        if self.method in ['R_graphlets', 'graphlet']:
+            tokens = [(hop, label) for hop, labels in enumerate(signature) for label in labels]
+        else:
+            if self.method == 'hungarian':
+                signature = [[label for labels in signature for label in labels]]
+            tokens = []
+            for hop, labels in enumerate(signature):
+                backbone = labels.count('B53')
+                # one token per power of two below the count, so that close counts share most of their tokens
+                tokens += [(hop, 'B53', b) for b in range(backbone.bit_length() + 1)]
+                non_backbone = [(hop, self.lsh_keys[label]) for label in labels if label != 'B53']
+                tokens += non_backbone if non_backbone else [(hop, None)]
+        # Repeated tokens are numbered to turn the multiset into a set. Tokens are also repeated
+        # decay ** -depth times, so that the Jaccard similarity weights the depths like compare does.
+        occurrences = Counter()
+        numbered = []
+        for token in tokens:
+            copies = int(round(self.decay ** (token[0] + 1 - len(signature))))
+            numbered += [token + (occurrences[token], copy) for copy in range(copies)]
+            occurrences[token] += 1
+        return numbered
+
     def normalize(self, unnormalized, length):
         """
         We want our normalization to be more lenient to longer matches
@@ -254,6 +527,128 @@ class SimFunctionNode():
             hist = feat_1 | feat_2
             return sum(diff.values()) / sum(hist.values())
 
+    def encode_ring(self, ring):
+        """
+        Encode a list of labels, or of (label, hop) tuples, as arrays to build cost matrices with numpy.
+        :param ring: list of labels or (label, hop) tuples
+        :return: row indices in iso_matrix, hops (None for plain labels) and IDF weights (None without IDF)
+        """
+        if len(ring) and isinstance(ring[0], tuple):
+            labels, hops = zip(*ring)
+            hops = np.array(hops)
+        else:
+            labels, hops = ring, None
+        codes = np.array([self.edge_map[label] - 1 for label in labels], dtype=np.int64)
+        weights = np.array([self.idf[label] for label in labels]) if self.idf is not None else None
+        return codes, hops, weights
+
+    def cost_matrix(self, ring1, ring2, bb=False, pos=False):
+        """
+        Vectorized version of the matrix of get_cost_nodes between the elements of two rings
+        :param ring1: list of labels or (label, hop) tuples
+        :param ring2: ''
+        :param bb : Check if what is being compared is backbone (no isostericity then)
+        :param pos : Check if this is used within a ring (no indices then)
+        :return: a (len(ring1), len(ring2)) array
+        """
+        codes1, hops1, weights1 = self.encode_ring(ring1)
+        codes2, hops2, weights2 = self.encode_ring(ring2)
+        if bb:
+            cost = np.exp(-np.abs(hops1[:, None] - hops2[None, :]))
+        elif pos is False:
+            cost = iso_matrix[codes1[:, None], codes2[None, :]]
+        else:
+            cost = np.exp(-np.abs(hops1[:, None] - hops2[None, :])) + iso_matrix[codes1[:, None], codes2[None, :]]
+        if self.idf is not None:
+            cost = cost * np.outer(weights1, weights2)
+        return cost
+
+    def rings_to_counts(self, rings, labels=None):
+        """
+        Turn a list of edge rings into per-depth edge label counts, so that R_1 can be computed for a whole batch at
+        once.
+        Labels that are not in the IDF table are dropped when using IDF, as they are ignored by R_1 in that case.
+        :param rings: a list of edge rings [[None], [first ring], [second ring],...]
+        :param labels: a fixed label vocabulary to count, by default the IDF labels or the labels found in the rings
+        :return: an array of counts of shape (n_rings, depth, n_labels) and the weight of each label
+        """
+        if labels is not None:
+            pass
+        elif self.idf:
+            labels = sorted(self.idf.keys())
+        else:
+            labels = sorted({label for ring in rings for k in range(1, self.depth + 1) for label in ring[k]})
+        label_index = {label: i for i, label in enumerate(labels)}
+
+        counts = np.zeros((len(rings), self.depth, len(labels)))
+        for i, ring in enumerate(rings):
+            for k in range(1, self.depth + 1):
+                for label in ring[k]:
+                    try:
+                        counts[i, k - 1, label_index[label]] += 1
+                    except KeyError:
+                        pass
+
+        if self.idf:
+            weights = np.array([self.idf.get(label, 0.) for label in labels])
+        else:
+            weights = np.ones(len(labels))
+        return counts, weights
+
+    def R_1_block(self, rings):
+        """
+        Vectorized version of compare with the R_1 method, over all pairs of a list of rings.
+
+        For each depth, we use sum(min(a, b)) = (sum(a) + sum(b) - |a - b|_1) / 2 and
+        sum(max(a, b)) = (sum(a) + sum(b) + |a - b|_1) / 2 so that the whole block comes from one cdist call.
+        Weighting the counts beforehand gives the IDF version.
+        :param rings: a list of edge rings
+        :return: the (n_rings, n_rings) similarity matrix
+        """
+        counts, weights = self.rings_to_counts(rings)
+        return self.R_1_counts_block(counts, counts, weights)
+
+    def R_1_counts_block(self, counts1, counts2, weights):
+        """
+        R_1_block between two sets of rings turned into counts by rings_to_counts (with the same labels), so that a
+        large block can be computed by rows.
+        :param counts1: (n1, depth, n_labels) counts
+        :param counts2: (n2, depth, n_labels) counts
+        :param weights: the weight of each label
+        :return: the (n1, n2) similarity matrix
+        """
+        block = np.zeros((len(counts1), len(counts2)))
+        for k in range(self.depth):
+            feats1, feats2 = counts1[:, k] * weights, counts2[:, k] * weights
+            totals = feats1.sum(axis=1)[:, None] + feats2.sum(axis=1)[None, :]
+            l1 = cdist(feats1, feats2, metric='cityblock')
+            # sometimes both rings are empty, which gives a similarity of 1
+            empty = totals == 0
+            totals[empty] = 1
+            value = (totals - l1) / (totals + l1)
+            value[empty] = 1
+            block += self.decay ** (k + 1) * value
+        return block / self.norm_factor
+
+    def R_1_pairs(self, rings, pairs):
+        """
+        Vectorized version of compare with the R_1 method, over given pairs of a list of rings.
+        :param rings: a list of edge rings
+        :param pairs: (n_pairs, 2) array of indices in rings
+        :return: the (n_pairs,) similarities
+        """
+        counts, weights = self.rings_to_counts(rings)
+        feats = counts * weights
+        first, second = feats[pairs[:, 0]], feats[pairs[:, 1]]
+        mins = np.minimum(first, second).sum(axis=2)
+        maxs = np.maximum(first, second).sum(axis=2)
+        # sometimes both rings are empty, which gives a similarity of 1
+        empty = maxs == 0
+        maxs[empty] = 1
+        value = mins / maxs
+        value[empty] = 1
+        return value @ (self.decay ** np.arange(1, self.depth + 1)) / self.norm_factor
+
     def R_iso(self, list1, list2):
         """
         Compute R function over lists of features:
@@ -288,6 +683,193 @@ class SimFunctionNode():
         nc_list1 = [i for i in list1 if i != 'B53']
         nc_list2 = [i for i in list2 if i != 'B53']
 
+        if self.assignments is None:
+            sim_non_bb = self.R_iso_nc(nc_list1, nc_list2)
+        else:
+            key = self.assignment_key(nc_list1, nc_list2)
+            sim_non_bb = self.assignments.get(key)
+            if sim_non_bb is None:
+                sim_non_bb = self.R_iso_nc(nc_list1, nc_list2)
+                self.assignments.put(key, sim_non_bb)
+
+        return (sim_non_bb + sim_bb) / 2
+
+    def R_iso_block(self, rings):
+        """
+        R_iso over all pairs of a list of rings.
+        :param rings: a list of edge rings
+        :return: the (n_rings, n_rings) similarity matrix
+        """
+        n = len(rings)
+        rows, cols = np.triu_indices(n, 1)
+        block = np.zeros((n, n))
+        block[rows, cols] = self.R_iso_pairs(rings, np.stack([rows, cols], axis=1))
+        block += block.T
+        block[np.diag_indices(n)] = 1
+        return block
+
+    def R_iso_pairs(self, rings, pairs):
+        """
+        R_iso over given pairs of a list of rings. The backbone term is vectorized and all the non backbone
+        assignment problems are solved together.
+        :param rings: a list of edge rings
+        :param pairs: (n_pairs, 2) array of indices in rings
+        :return: the (n_pairs,) similarities
+        """
+        rows, cols = pairs[:, 0], pairs[:, 1]
+        values = np.zeros(len(pairs))
+        for k in range(1, self.depth + 1):
+            bb = np.array([ring[k].count('B53') for ring in rings])
+            loc_min, loc_max = np.minimum(bb[rows], bb[cols]), np.maximum(bb[rows], bb[cols])
+            sim_bb = np.ones(len(rows))
+            nonzero = loc_max > 0
+            sim_bb[nonzero] = (loc_min[nonzero] / loc_max[nonzero]) ** 1.5
+
+            nc_lists = [[label for label in ring[k] if label != 'B53'] for ring in rings]
+            sim_non_bb = self.R_iso_nc_batch([(nc_lists[i], nc_lists[j]) for i, j in zip(rows, cols)])
+            values += self.decay ** k * (sim_non_bb + sim_bb) / 2
+        values /= self.norm_factor
+        values[rows == cols] = 1
+        return values
+
+    def R_iso_nc_batch(self, pairs):
+        """
+        R_iso_nc for a list of pairs of non backbone lists : identical problems are grouped, looked up in the
+        memoization table, and the remaining ones are solved with one solve_assignment_batch call.
+        :param pairs: a list of (nc_list1, nc_list2)
+        :return: an array of scores in [0,1]
+        """
+        values = np.zeros(len(pairs))
+        todo = defaultdict(list)
+        for p, (nc_list1, nc_list2) in enumerate(pairs):
+            if len(nc_list1) == 0 and len(nc_list2) == 0:
+                values[p] = 1
+            elif len(nc_list1) == 0 or len(nc_list2) == 0:
+                values[p] = 0
+            else:
+                todo[self.assignment_key(nc_list1, nc_list2)].append(p)
+
+        keys, representatives = [], []
+        for key, positions in todo.items():
+            value = self.assignments.get(key) if self.assignments is not None else None
+            if value is None:
+                keys.append(key)
+                representatives.append(pairs[positions[0]])
+            else:
+                values[positions] = value
+        if not keys:
+            return values
+
+        unnormalized = solve_assignment_batch([self.cost_matrix(ring1, ring2) for ring1, ring2 in representatives])
+        lengths = np.array([self.get_length(ring1, ring2) for ring1, ring2 in representatives])
+        sims = self.normalize(unnormalized, lengths)
+        for key, sim in zip(keys, sims):
+            values[todo[key]] = sim
+            if self.assignments is not None:
+                self.assignments.put(key, sim)
+        return values
+
+    def hungarian_block(self, rings):
+        """
+        hungarian over all pairs of a list of rings.
+        :param rings: a list of edge rings
+        :return: the (n_rings, n_rings) similarity matrix
+        """
+        n = len(rings)
+        rows, cols = np.triu_indices(n, 1)
+        block = np.zeros((n, n))
+        block[rows, cols] = self.hungarian_pairs(rings, np.stack([rows, cols], axis=1))
+        block += block.T
+        block[np.diag_indices(n)] = 1
+        return block
+
+    def hungarian_pairs(self, rings, pairs):
+        """
+        hungarian over given pairs of a list of rings, solving all the assignment problems together.
+        :param rings: a list of edge rings
+        :param pairs: (n_pairs, 2) array of indices in rings
+        :return: the (n_pairs,) similarities
+        """
+        rows, cols = pairs[:, 0], pairs[:, 1]
+        can_lists, noncan_lists = [], []
+        for ring in rings:
+            can, noncan = [], []
+            for k in range(1, self.depth + 1):
+                for value in ring[k]:
+                    if value == 'B53':
+                        can.append((value, k))
+                    else:
+                        noncan.append((value, k))
+            # sorted, so that identical problems share a key
+            can_lists.append(sorted(can))
+            noncan_lists.append(sorted(noncan))
+
+        def compare_lists_batch(lists, bb):
+            values = np.zeros(len(rows))
+            todo = defaultdict(list)
+            for p, (i, j) in enumerate(zip(rows, cols)):
+                ring1, ring2 = lists[i], lists[j]
+                if len(ring1) == 0 and len(ring2) == 0:
+                    values[p] = 1
+                elif len(ring1) == 0 or len(ring2) == 0:
+                    values[p] = 0
+                else:
+                    key = (tuple(ring1), tuple(ring2))
+                    todo[min(key, key[::-1])].append(p)
+            problems = list(todo)
+            unnormalized = solve_assignment_batch([self.cost_matrix(list(ring1), list(ring2), bb=bb, pos=not bb)
+                                                   for ring1, ring2 in problems])
+            # If the cost also includes distance information, we need to divide by two
+            factor_two = 1 if bb else 2
+            lengths = np.array([self.get_length([node[0] for node in ring1], [node[0] for node in ring2])
+                                for ring1, ring2 in problems])
+            sims = self.normalize(unnormalized / factor_two, lengths)
+            for key, sim in zip(problems, sims):
+                values[todo[key]] = sim
+            return values
+
+        values = (compare_lists_batch(can_lists, bb=True) + compare_lists_batch(noncan_lists, bb=False)) / 2
+        values[rows == cols] = 1
+        return values
+
+    def compare_pairs(self, rings, pairs, vectorized=True):
+        """
+        compare over given pairs of a list of rings.
+        :param rings: a list of rings
+        :param pairs: (n_pairs, 2) array of indices in rings
+        :param vectorized: if True, use the batched implementation when there is one (R_1, R_iso, hungarian)
+        :return: the (n_pairs,) similarities
+        """
+        if vectorized and self.method == 'R_1':
+            return self.R_1_pairs(rings, pairs)
+        if vectorized and self.method == 'R_iso':
+            return self.R_iso_pairs(rings, pairs)
+        if vectorized and self.method == 'hungarian':
+            return self.hungarian_pairs(rings, pairs)
+        return np.array([1. if i == j else self.compare(rings[i], rings[j]) for i, j in pairs])
+
+    def assignment_key(self, nc_list1, nc_list2):
+        """
+        Canonical key of an R_iso assignment problem : the optimal assignment only depends on the multisets of labels,
+        and the problem is symmetric, so we key on the sorted pair of sorted label classes.
+        :param nc_list1: list of non backbone labels
+        :param nc_list2: ''
+        :return: a hashable key
+        """
+        key1 = tuple(sorted(self.label_keys[label] for label in nc_list1))
+        key2 = tuple(sorted(self.label_keys[label] for label in nc_list2))
+        if key2 < key1:
+            return key2, key1
+        return key1, key2
+
+    def R_iso_nc(self, nc_list1, nc_list2):
+        """
+        Optimal assignment of the non backbone labels of two rings, used by R_iso
+        :param nc_list1: list of non backbone labels
+        :param nc_list2: ''
+        :return: a score in [0,1]
+        """
+
         def compare_smooth(ring1, ring2):
             """
             Compare two lists of non backbone
@@ -300,10 +882,7 @@ class SimFunctionNode():
             if len(ring1) == 0 or len(ring2) == 0:
                 return 0
 
-            # This makes loading go from 0.17 to 2.6
-            # cost = np.array(self.get_cost_matrix(ring1, ring2))
-            cost = np.array([[self.get_cost_nodes(node_i, node_j) for node_j in ring2] for node_i in ring1])
-            cost = -cost
+            cost = -self.cost_matrix(ring1, ring2)
             row_ind, col_ind = linear_sum_assignment(cost)
             unnormalized = - np.array(cost[row_ind, col_ind]).sum()
 
@@ -325,10 +904,7 @@ class SimFunctionNode():
             # Get the longest first to permute it to get the exact solution
             if len(ring2) > len(ring1):
                 ring1, ring2 = ring2, ring1
-            perms = set(itertools.permutations(ring1))
-            all_costs = [sum([self.get_cost_nodes(perm[i], node_j) for i, node_j in enumerate(ring2)]) for
-                         perm in perms]
-            unnormalized = max(all_costs)
+            unnormalized = max_assignment_brute(self.cost_matrix(ring1, ring2))
 
             length = self.get_length(ring1, ring2)
             return self.normalize(unnormalized, length)
@@ -346,7 +922,61 @@ class SimFunctionNode():
         # time_res_brute[len(nc_list1), len(nc_list2)] += time_brute
         # time_res_smooth[len(nc_list1), len(nc_list2)] += time_smooth
 
-        return (sim_non_bb + sim_bb) / 2
+        return sim_non_bb
+
+    def precompute_assignments(self, max_size=3):
+        """
+        Fill the assignment table with all pairs of non backbone multisets of size up to max_size.
+        The brute force limit of R_iso is 5, but the number of pairs grows very fast with the size
+        (about 1e5 pairs for 3 and 2e7 for 5 with the default edge map).
+        :param max_size: the largest multiset size to precompute
+        :return: the number of entries in the table
+        """
+        assert self.assignments is not None, "Precomputing assignments requires an assignment cache."
+        # One representative label for each key
+        representatives = {}
+        for label in sorted(self.label_keys):
+            if label != 'B53':
+                representatives.setdefault(self.label_keys[label], label)
+        alphabet = sorted(representatives)
+        multisets = [ms for size in range(max_size + 1)
+                     for ms in itertools.combinations_with_replacement(alphabet, size)]
+        print(f">>> precomputing assignments for {len(multisets)} multisets")
+        for i, ms1 in enumerate(tqdm(multisets)):
+            nc_list1 = [representatives[key] for key in ms1]
+            for ms2 in multisets[i:]:
+                nc_list2 = [representatives[key] for key in ms2]
+                key = self.assignment_key(nc_list1, nc_list2)
+                if key not in self.assignments.table:
+                    self.assignments.table[key] = self.R_iso_nc(nc_list1, nc_list2)
+        return len(self.assignments.table)
+
+    def assignment_config(self):
+        """
+        The parameters an assignment table depends on, so that we do not load a table built for another setting.
+        """
+        return {'idf': self.idf, 'normalization': self.normalization, 'label_keys': self.label_keys}
+
+    def save_assignments(self, dump_path):
+        """
+        Dump the assignment table (precomputed and cached entries) along with its configuration
+        :param dump_path:
+        :return:
+        """
+        table = dict(self.assignments.lru)
+        table.update(self.assignments.table)
+        pickle.dump({'config': self.assignment_config(), 'table': table}, open(dump_path, 'wb'))
+
+    def load_assignments(self, load_path):
+        """
+        Load a table dumped with save_assignments
+        :param load_path:
+        :return:
+        """
+        dumped = pickle.load(open(load_path, 'rb'))
+        if dumped['config'] != self.assignment_config():
+            raise ValueError(f"The assignment table {load_path} was built with a different configuration.")
+        self.assignments.table.update(dumped['table'])
 
     def R_graphlets(self, list1, list2):
 
@@ -372,8 +1002,7 @@ class SimFunctionNode():
 
             # Try the similarity version the bonus we get is that we use the normalization also used for riso
             # And therefore we avoid a double exponential
-            cost = - np.array(
-                [[self.graphlet_cost_nodes(node_i, node_j, similarity=True) for node_j in ring2] for node_i in ring1])
+            cost = - self.graphlet_cost_matrix(ring1, ring2, similarity=True)
             row_ind, col_ind = linear_sum_assignment(cost)
             unnormalized = - np.array(cost[row_ind, col_ind]).sum()
 
@@ -397,11 +1026,7 @@ class SimFunctionNode():
 
             if len(ring2) > len(ring1):
                 ring1, ring2 = ring2, ring1
-            perms = set(itertools.permutations(ring1))
-            all_costs = [
-                sum([self.graphlet_cost_nodes(perm[i], node_j, similarity=True) for i, node_j in enumerate(ring2)]) for
-                perm in perms]
-            unnormalized = max(all_costs)
+            unnormalized = max_assignment_brute(self.graphlet_cost_matrix(ring1, ring2, similarity=True))
 
             length = self.get_length(ring1, ring2, graphlets=True)
             return self.normalize(unnormalized, length)
@@ -443,9 +1068,8 @@ class SimFunctionNode():
                 return 1
             if len(ring1) == 0 or len(ring2) == 0:
                 return 0
-            cm = [[self.get_cost_nodes(node_i, node_j, bb=bb, pos=pos) for node_j in ring2] for node_i in ring1]
             # Dont forget the minus for minimization
-            cost = -np.array(cm)
+            cost = -self.cost_matrix(ring1, ring2, bb=bb, pos=pos)
             row_ind, col_ind = linear_sum_assignment(cost)
             unnormalized = - np.array(cost[row_ind, col_ind]).sum()
             # If the cost also includes distance information, we need to divide by two
@@ -481,9 +1105,7 @@ class SimFunctionNode():
         ringlist1 = rings_to_lists_g(rings1, depth=self.depth)
         ringlist2 = rings_to_lists_g(rings2, depth=self.depth)
 
-        cost = - np.array(
-            [[self.graphlet_cost_nodes(node_i, node_j, pos=True, similarity=True) for node_j in ringlist2]
-             for node_i in ringlist1])
+        cost = - self.graphlet_cost_matrix(ringlist1, ringlist2, pos=True, similarity=True)
         row_ind, col_ind = linear_sum_assignment(cost)
         unnormalized = - np.array(cost[row_ind, col_ind]).sum()
 
@@ -516,12 +1138,161 @@ class SimFunctionNode():
         if pos:
             g_1, p_1 = node1
             g_2, p_2 = node2
-            ged = GED_hashtable_hashed(g_1, g_2, self.GED_table, self.hash_table, normed=True, similarity=similarity)
+            ged = self.graphlet_ged(g_1, g_2, similarity=similarity)
             delta = SimFunctionNode.delta_indices_sim(p_1, p_2, distance=not similarity)
             return ged + delta
         else:
-            return GED_hashtable_hashed(node1, node2, self.GED_table, self.hash_table, normed=True,
-                                        similarity=similarity)
+            return self.graphlet_ged(node1, node2, similarity=similarity)
+
+    def graphlet_cost_matrix(self, ring1, ring2, pos=False, similarity=False):
+        """
+        Matrix of graphlet_cost_nodes between the elements of two rings.
+        With a precomputed GED matrix this is a single gather, otherwise each distinct pair of graphlets is looked up
+        once.
+        :param ring1: list of graphlets or (graphlet, hop) tuples if pos
+        :param ring2: ''
+        :return: a (len(ring1), len(ring2)) array
+        """
+        if pos:
+            graphlets1, hops1 = zip(*ring1)
+            graphlets2, hops2 = zip(*ring2)
+        else:
+            graphlets1, graphlets2 = ring1, ring2
+
+        if self.ged_matrix is not None:
+            ids1 = np.array([self.hash_ids[h] for h in graphlets1])
+            ids2 = np.array([self.hash_ids[h] for h in graphlets2])
+            cost = self.ged_matrix[ids1[:, None], ids2[None, :]].astype(np.float64)
+            if not similarity:
+                cost = 1 - cost
+        else:
+            # graphlets are hashes, or nx graphs when there is no hash table
+            index1, index2 = {}, {}
+            inverse1 = np.array([index1.setdefault(h, len(index1)) for h in graphlets1])
+            inverse2 = np.array([index2.setdefault(h, len(index2)) for h in graphlets2])
+            cost = np.array([[self.graphlet_ged(h_G, h_H, similarity=similarity) for h_H in index2]
+                             for h_G in index1])
+            cost = cost[inverse1[:, None], inverse2[None, :]]
+
+        if pos:
+            delta = np.exp(-np.abs(np.array(hops1)[:, None] - np.array(hops2)[None, :]))
+            cost = cost + (1 - delta if not similarity else delta)
+        return cost
+
+    def graphlet_ged(self, h_G, h_H, similarity=False):
+        """
+        Normed GED or GED similarity between two graphlet hashes, from the precomputed matrix if we have one.
+        """
+        if self.ged_matrix is not None:
+            value = float(self.ged_matrix[self.hash_ids[h_G], self.hash_ids[h_H]])
+            return value if similarity else 1 - value
+        return GED_hashtable_hashed(h_G, h_H, self.GED_table, self.hash_table, normed=True, similarity=similarity)
+
+
+class R1Sketch():
+    """
+    Explicit feature map for the R_1 kernel, so that K ~ phi @ phi.T
+
+    At each depth, R_1 is the weighted Jaccard similarity sum(min) / sum(max) of the (IDF weighted) label counts.
+    Consistent weighted sampling (Ioffe, 2010) draws one (label, level) sample per ring such that two rings get the same
+    sample with a probability that is exactly this similarity. Each of the sketch_size samples of each depth is hashed
+    to a signed bucket of its own block of bucket_width columns, scaled so that dot products estimate the decayed and
+    normalized sum. Distinct samples only collide with probability 1 / bucket_width, with a random sign.
+    Empty rings all get the same sample, which gives a similarity of 1 between them and 0 with any other ring, as R_1.
+    """
+
+    def __init__(self, node_sim, sketch_size=64, bucket_width=16, seed=0):
+        """
+        :param node_sim: a SimFunctionNode with the R_1 method
+        :param sketch_size: number of samples per depth, the error decreases as 1 / sqrt(sketch_size)
+        :param bucket_width: number of buckets per sample, the features have depth * sketch_size * bucket_width
+        dimensions
+        :param seed: the sampling only depends on it, two sketches with the same seed give comparable features
+        """
+        assert node_sim.method == 'R_1', "The sketch approximates the R_1 kernel only."
+        self.node_sim = node_sim
+        self.depth = node_sim.depth
+        self.sketch_size = sketch_size
+        self.bucket_width = bucket_width
+        self.dim = self.depth * sketch_size * bucket_width
+        # Fixed vocabulary so that features are comparable across batches
+        self.labels = sorted(node_sim.idf) if node_sim.idf else sorted(node_sim.edge_map)
+
+        rng = np.random.RandomState(seed)
+        shape = (self.depth, sketch_size, len(self.labels))
+        self.r = rng.gamma(2, 1, shape)
+        self.log_c = np.log(rng.gamma(2, 1, shape))
+        self.beta = rng.uniform(0, 1, shape)
+        self.hash_mult = rng.randint(1, 2 ** 31, size=4).astype(np.uint64) * 2 + 1
+        depth_weights = node_sim.decay ** np.arange(1, self.depth + 1) / node_sim.norm_factor
+        self.scales = np.sqrt(depth_weights / sketch_size)
+
+    def samples(self, feats, k):
+        """
+        Consistent weighted samples of one depth.
+        :param feats: (n_rings, n_labels) non negative weights
+        :param k: the depth index
+        :return: the sampled label index and level, both (n_rings, sketch_size), label -1 for empty rings
+        """
+        r, log_c, beta = self.r[k], self.log_c[k], self.beta[k]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_feats = np.log(feats)[:, None, :]
+            t = np.floor(log_feats / r + beta)
+            # ln(a) = ln(c) - ln(y) - r with ln(y) = r * (t - beta)
+            log_a = log_c - r * (t - beta + 1)
+        log_a[np.broadcast_to(feats[:, None, :] == 0, log_a.shape)] = np.inf
+        sampled = log_a.argmin(axis=2)
+        levels = np.take_along_axis(t, sampled[..., None], axis=2)[..., 0]
+
+        empty = feats.sum(axis=1) == 0
+        sampled[empty] = -1
+        levels[empty] = 0
+        return sampled, levels.astype(np.int64)
+
+    def transform(self, rings):
+        """
+        :param rings: a list of edge rings
+        :return: the (n_rings, dim) feature matrix
+        """
+        counts, weights = self.node_sim.rings_to_counts(rings, labels=self.labels)
+        phi = np.zeros((len(rings), self.dim), dtype=np.float32)
+        rows = np.arange(len(rings))[:, None]
+        sample_ids = np.arange(self.sketch_size, dtype=np.uint64)[None, :]
+        m = self.hash_mult
+        for k in range(self.depth):
+            sampled, levels = self.samples(counts[:, k] * weights, k)
+            # unsigned arithmetic wraps around, which is what we want for hashing
+            key = np.uint64(k + 1) * m[0] + sample_ids * m[1] + \
+                  (sampled + 2).astype(np.uint64) * m[2] + (levels + 2 ** 20).astype(np.uint64) * m[3]
+            key ^= key >> np.uint64(31)
+            key *= m[0]
+            key ^= key >> np.uint64(29)
+            buckets = (key % np.uint64(self.bucket_width)).astype(np.int64)
+            signs = ((key >> np.uint64(63)).astype(np.float64) * 2 - 1)
+            columns = (k * self.sketch_size + np.arange(self.sketch_size)) * self.bucket_width + buckets
+            phi[rows, columns] = signs * self.scales[k]
+        return phi
+
+    def K(self, rings):
+        phi = self.transform(rings)
+        return phi @ phi.T
+
+
+def build_assignment_table(dump_path, idf=False, normalization=None, max_size=3, edge_map=EDGE_MAP):
+    """
+    Precompute and dump the R_iso assignment table for a given configuration, to be loaded with
+    SimFunctionNode(..., assignment_table=dump_path)
+    :param dump_path:
+    :param idf:
+    :param normalization:
+    :param max_size: the largest multiset size to precompute
+    :return:
+    """
+    node_sim = SimFunctionNode('R_iso', depth=1, idf=idf, normalization=normalization, edge_map=edge_map)
+    size = node_sim.precompute_assignments(max_size=max_size)
+    node_sim.save_assignments(dump_path)
+    print(f">>> dumped {size} assignments in {dump_path}")
+    return size
 
 
 def graph_edge_freqs(graphs, stop=0):
@@ -560,19 +1331,22 @@ def pdist_list(rings, node_sim):
     return sims
 
 
-def k_block_list(rings, node_sim):
+def k_block(nodes, node_sim, vectorized=True):
     """
-    Defines the block creation using a list of rings at the graph level (should also ultimately include trees)
-    Creates a SIMILARITY matrix.
-    :param rings: a list of rings, dictionnaries {node : (nodelist, edgelist)}
+    Similarity matrix between all pairs of a flat list of rings.
+    :param nodes: a list of rings
     :param node_sim: the pairwise node comparison function
+    :param vectorized: if True, use the batched implementation when there is one (R_1, R_iso, hungarian)
     :return:
     """
+    if vectorized and node_sim.method == 'R_1':
+        return node_sim.R_1_block(nodes)
+    if vectorized and node_sim.method == 'R_iso':
+        return node_sim.R_iso_block(nodes)
+    if vectorized and node_sim.method == 'hungarian':
+        return node_sim.hungarian_block(nodes)
 
-    rings_values = [list(ring.values()) for ring in rings]
-    nodes = list(itertools.chain.from_iterable(rings_values))
     block = np.zeros((len(nodes), len(nodes)))
-    b = node_sim.compare(nodes[0], nodes[0])
     assert node_sim.compare(nodes[0], nodes[0]) > 0.99, "Identical rings giving non 1 similarity."
     sims = [node_sim.compare(n1, n2)
             for i, (n1, n2) in enumerate(itertools.combinations(nodes, 2))]
@@ -584,74 +1358,269 @@ def k_block_list(rings, node_sim):
     return block
 
 
-def simfunc_time(simfuncs, graph_path, batches=1, batch_size=5,
-                 names=None):
+def unique_rings(nodes, node_sim):
+    """
+    Group a list of rings by signature.
+    :param nodes: a list of rings
+    :param node_sim: the pairwise node comparison function
+    :return: the list of unique rings and the index of each input ring in it
+    """
+    signature_index = {}
+    unique = []
+    inverse = np.zeros(len(nodes), dtype=np.int64)
+    for i, ring in enumerate(nodes):
+        signature = node_sim.ring_signature(ring)
+        try:
+            inverse[i] = signature_index[signature]
+        except KeyError:
+            inverse[i] = signature_index[signature] = len(unique)
+            unique.append(ring)
+    return unique, inverse
+
+
+def k_block_list(rings, node_sim, vectorized=True, dedup=True):
+    """
+    Defines the block creation using a list of rings at the graph level (should also ultimately include trees)
+    Creates a SIMILARITY matrix.
+    :param rings: a list of rings, dictionnaries {node : (nodelist, edgelist)}
+    :param node_sim: the pairwise node comparison function
+    :param vectorized: if True, use the batched implementation when there is one (R_1, R_iso, hungarian)
+    :param dedup: if True, only compare rings with distinct signatures and scatter the result back
+    :return:
+    """
+
+    rings_values = [list(ring.values()) for ring in rings]
+    nodes = list(itertools.chain.from_iterable(rings_values))
+    if not dedup:
+        return k_block(nodes, node_sim, vectorized=vectorized)
+
+    unique, inverse = unique_rings(nodes, node_sim)
+    logger.info(f"K block: {len(unique)} unique rings for {len(nodes)} nodes, "
+                f"dedup ratio {len(nodes) / len(unique):.2f}")
+    block = k_block(unique, node_sim, vectorized=vectorized)
+    return block[inverse[:, None], inverse[None, :]]
+
+
+def k_pairs(nodes, pairs, node_sim, vectorized=True):
     """
-        Do time benchmark on a simfunc.
+    Similarities of given pairs of a flat list of rings, to train on a sample of K.
+    Each distinct pair of ring signatures is only compared once.
+    :param nodes: a list of rings
+    :param pairs: (n_pairs, 2) array of indices in nodes
+    :param node_sim: the pairwise node comparison function
+    :param vectorized: if True, use the batched implementation when there is one (R_1, R_iso, hungarian)
+    :return: the (n_pairs,) similarities
+    """
+    unique, inverse = unique_rings(nodes, node_sim)
+    signature_pairs = np.sort(inverse[pairs], axis=1)
+    unique_pairs, pair_inverse = np.unique(signature_pairs, axis=0, return_inverse=True)
+    sims = node_sim.compare_pairs(unique, unique_pairs, vectorized=vectorized)
+    return sims[pair_inverse.reshape(-1)]
+
+
+def minhash_signatures(token_lists, n_hashes, seed=0):
+    """
+    MinHash of sets of tokens.
+    :param token_lists: a list of lists of distinct hashable tokens (see SimFunctionNode.lsh_tokens)
+    :param n_hashes: number of hash functions
+    :param seed:
+    :return: the (n_lists, n_hashes) minhashes
+    """
+    token_ids = {}
+    ids = []
+    for tokens in token_lists:
+        # all empty lists are identical
+        ids.append([token_ids.setdefault(token, len(token_ids)) for token in tokens] or
+                   [token_ids.setdefault(None, len(token_ids))])
+
+    prime = 2 ** 31 - 1
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, prime, size=(1, n_hashes), dtype=np.int64)
+    b = rng.randint(0, prime, size=(1, n_hashes), dtype=np.int64)
+    token_hashes = (a * np.arange(len(token_ids), dtype=np.int64)[:, None] + b) % prime
+
+    lengths = np.array([len(tokens) for tokens in ids])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return np.minimum.reduceat(token_hashes[np.concatenate(ids)], starts, axis=0)
+
+
+def lsh_candidates(token_lists, n_bands=16, band_size=4, seed=0):
+    """
+    Pairs of token sets that share a LSH bucket in at least one band. Two sets with a Jaccard similarity s are
+    candidates with probability 1 - (1 - s ** band_size) ** n_bands.
+    :param token_lists: a list of lists of distinct tokens
+    :param n_bands: number of bands, more bands find more pairs
+    :param band_size: number of minhashes per band, larger bands find less dissimilar pairs
+    :param seed:
+    :return: (n_pairs, 2) array of indices i < j
+    """
+    minhashes = minhash_signatures(token_lists, n_bands * band_size, seed=seed)
+    candidates = []
+    for band in range(n_bands):
+        _, buckets = np.unique(minhashes[:, band * band_size:(band + 1) * band_size], axis=0, return_inverse=True)
+        buckets = buckets.reshape(-1)
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.flatnonzero(np.diff(buckets[order])) + 1
+        for members in np.split(order, bounds):
+            if len(members) > 1:
+                i, j = np.triu_indices(len(members), 1)
+                candidates.append(np.stack([members[i], members[j]], axis=1))
+    if not candidates:
+        return np.zeros((0, 2), dtype=np.int64)
+    candidates = np.sort(np.concatenate(candidates), axis=1)
+    return np.unique(candidates, axis=0)
+
+
+def k_sparse_list(rings, node_sim, n_bands=16, band_size=4, seed=0, vectorized=True):
+    """
+    Sparse version of k_block_list : only the pairs of nodes whose signatures share a LSH bucket are compared,
+    all the other entries of K are left to a floor value by the caller.
+    :param rings: a list of rings, dictionnaries {node : (nodelist, edgelist)}
+    :param node_sim: the pairwise node comparison function
+    :param n_bands: number of LSH bands
+    :param band_size: number of minhashes per band
+    :param seed:
+    :param vectorized: if True, use the batched implementation when there is one (R_1, R_iso, hungarian)
+    :return: the (n_entries, 2) indices of the computed entries of K, both ways and with the diagonal, and their values
+    """
+    nodes = [ring for graph_rings in rings for ring in graph_rings.values()]
+    unique, inverse = unique_rings(nodes, node_sim)
+    candidates = lsh_candidates([node_sim.lsh_tokens(node_sim.ring_signature(ring)) for ring in unique],
+                                n_bands=n_bands, band_size=band_size, seed=seed)
+    sims = node_sim.compare_pairs(unique, candidates, vectorized=vectorized)
+    logger.info(f"Sparse K: {len(candidates)} candidate pairs for {len(unique)} unique rings")
+
+    # Entries are shifted by one so that zero similarities are kept as explicit entries
+    n_unique = len(unique)
+    block = sparse.coo_matrix((np.concatenate([sims, sims, np.ones(n_unique)]) + 1,
+                               (np.concatenate([candidates[:, 0], candidates[:, 1], np.arange(n_unique)]),
+                                np.concatenate([candidates[:, 1], candidates[:, 0], np.arange(n_unique)]))),
+                              shape=(n_unique, n_unique)).tocsr()
+    membership = sparse.csr_matrix((np.ones(len(nodes)), (np.arange(len(nodes)), inverse)),
+                                   shape=(len(nodes), n_unique))
+    K = (membership @ block @ membership.T).tocoo()
+    return np.stack([K.row, K.col], axis=1).astype(np.int64), K.data - 1
+
+
+def lsh_recall(graph_path, node_sim, n_bands=16, band_size=4, thresholds=(0.5, 0.7, 0.9), batches=5, batch_size=16,
+               seed=0):
+    """
+    Measure how many of the high similarity pairs of the dense K are found by k_sparse_list, on random batches of
+    annotated graphs.
+    :param graph_path: directory of annotated graphs
+    :param node_sim: the pairwise node comparison function
+    :param n_bands: number of LSH bands
+    :param band_size: number of minhashes per band
+    :param thresholds: recall is measured on the off diagonal pairs above each of these similarities
+    :return: a list of rows with the recall, the fraction of computed entries and the timings of each batch
+    """
+    rng = np.random.RandomState(seed)
+    graphlist = sorted(os.listdir(graph_path))
+    level = 'graphlet' if node_sim.method in ['R_graphlets', 'graphlet'] else 'edge'
+    ring_batches = []
+    for b in range(batches):
+        ring_batches.append([pickle.load(open(os.path.join(graph_path, g), 'rb'))['rings'][level]
+                             for g in rng.choice(graphlist, size=min(batch_size, len(graphlist)), replace=False)])
+    return lsh_recall_rings(ring_batches, node_sim, n_bands=n_bands, band_size=band_size, thresholds=thresholds,
+                            seed=seed)
+
+
+def lsh_recall_rings(ring_batches, node_sim, n_bands=16, band_size=4, thresholds=(0.5, 0.7, 0.9), seed=0):
+    """
+    lsh_recall on batches of rings that are already loaded.
+    :param ring_batches: a list of batches, lists of rings of graphs {node : (nodelist, edgelist)}
+    :return: a list of rows with, for each threshold, the number of pairs above it and the fraction of them found
     """
-    from random import shuffle
     from time import perf_counter
 
-    import pandas as pd
+    rows = []
+    for b, rings in enumerate(ring_batches):
+        start = perf_counter()
+        dense = k_block_list(rings, node_sim)
+        dense_time = perf_counter() - start
+        start = perf_counter()
+        pairs, _ = k_sparse_list(rings, node_sim, n_bands=n_bands, band_size=band_size, seed=seed)
+        sparse_time = perf_counter() - start
+
+        found = np.zeros(dense.shape, dtype=bool)
+        found[pairs[:, 0], pairs[:, 1]] = True
+        off_diagonal = ~np.eye(len(dense), dtype=bool)
+        row = {'batch_num': b,
+               'nodes': len(dense),
+               'density': found.mean(),
+               'dense_time': dense_time,
+               'sparse_time': sparse_time}
+        for threshold in thresholds:
+            similar = (dense >= threshold) & off_diagonal
+            row[f'pairs_{threshold}'] = int(similar.sum())
+            row[f'found_{threshold}'] = int(found[similar].sum())
+            row[f'recall_{threshold}'] = found[similar].mean() if similar.any() else 1.
+        rows.append(row)
+
+    recalls = []
+    for threshold in thresholds:
+        similar = sum(row[f'pairs_{threshold}'] for row in rows)
+        recall = sum(row[f'found_{threshold}'] for row in rows) / similar if similar else 1.
+        recalls.append(f"recall >= {threshold} {recall:.3f} ({similar} pairs)")
+    print(f">>> {n_bands} bands of {band_size}: "
+          f"density {np.mean([row['density'] for row in rows]):.3f}, " + ", ".join(recalls)
+          + f", time {np.mean([row['sparse_time'] for row in rows]):.4f}s "
+            f"vs dense {np.mean([row['dense_time'] for row in rows]):.4f}s")
+    return rows
+
+
+def r1_sketch_benchmark(graph_path, node_sim, sketch_sizes=(16, 64, 256), batches=5, batch_size=16, seed=0):
+    """
+    Compare the R1Sketch approximation to the exact R_1 kernel on random batches of annotated graphs.
+    :param graph_path: directory of annotated graphs
+    :param node_sim: a SimFunctionNode with the R_1 method
+    :param sketch_sizes: the sketch sizes to try
+    :param batches: number of batches
+    :param batch_size: number of graphs per batch
+    :return: a list of rows with the errors and timings of each batch and sketch size
+    """
+    from time import perf_counter
 
+    rng = np.random.RandomState(seed)
+    graphlist = sorted(os.listdir(graph_path))
+    sketches = {size: R1Sketch(node_sim, sketch_size=size, seed=seed) for size in sketch_sizes}
     rows = []
-    graphlist = os.listdir(graph_path)
-    for ind, simfunc in enumerate(simfuncs):
-        print(f">>> DOING KERNEL {simfunc.method}")
-        level = 'graphlet' if simfunc.method == 'graphlet' else 'edge'
-        batch_times = []
-        for b in range(batches):
-            shuffle(graphlist)
-            loading_times = []
-            ringlist = []
-            print(f">>> batch {b}")
-            for i in range(batch_size):
-                start = perf_counter()
-                G = pickle.load(open(os.path.join(graph_path, graphlist[i]), 'rb'))
-                loading_times.append(perf_counter() - start)
-                graph = G['graph']
-                for node in graph.nodes():
-                    ringlist.append(G['rings'][level][node])
-
-            print(f">>> tot batch loading, {sum(loading_times)}")
-            print(f">>> avg time per loading, {np.mean(loading_times)}")
-            print(f">>> max loading, {max(loading_times)}")
-            print(f">>> min loading, {min(loading_times)}")
-
-            times = []
-            for i, r1 in enumerate(ringlist):
-                for j, r2 in enumerate(ringlist[i:]):
-                    start = perf_counter()
-                    k = simfunc.compare(r1, r2)
-                    t = perf_counter() - start
-                    times.append(t)
-            print(f">>> batch size {batch_size}")
-            print(f">>> total batch time {sum(times)}")
-            print(f">>> avg time per comparison, {np.mean(times)}")
-            print(f">>> max comparison, {max(times)}")
-            print(f">>> min comparison, {min(times)}")
-            # batch_times.append((sum(times) + sum(loading_times)) / len(times))
-            batch_time = sum(times) + sum(loading_times)
-            rows.append({'batch_time': batch_time,
-                         'kernel': simfunc.method,
-                         'comparisons': len(times),
-                         'batch_num': b
-                         })
-            batch_times.append(batch_time)
-        if not names is None:
-            label = names[ind]
-        else:
-            label = simfunc.method
-        plt.plot(batch_times, label=label)
-        plt.xlabel("Batch")
-        plt.ylabel("Time (s)")
-    plt.legend()
-    plt.savefig("../figs/time_2.pdf", format="pdf")
-    # plt.show()
-
-    df = pd.DataFrame.from_dict(rows)
-    df.to_csv('kernel_times_2.csv')
-    pass
+    for b in range(batches):
+        nodes = []
+        for g in rng.choice(graphlist, size=min(batch_size, len(graphlist)), replace=False):
+            data = pickle.load(open(os.path.join(graph_path, g), 'rb'))
+            nodes.extend(data['rings']['edge'].values())
+
+        start = perf_counter()
+        exact = node_sim.R_1_block(nodes)
+        exact_time = perf_counter() - start
+        for size, sketch in sketches.items():
+            start = perf_counter()
+            phi = sketch.transform(nodes)
+            features_time = perf_counter() - start
+            K = phi @ phi.T
+            sketch_time = perf_counter() - start
+            error = np.abs(K - exact)
+            rows.append({'batch_num': b,
+                         'nodes': len(nodes),
+                         'sketch_size': size,
+                         'mean_error': error.mean(),
+                         'max_error': error.max(),
+                         'relative_frobenius': np.linalg.norm(K - exact) / np.linalg.norm(exact),
+                         'exact_time': exact_time,
+                         'features_time': features_time,
+                         'sketch_time': sketch_time})
+
+    for size in sketch_sizes:
+        size_rows = [row for row in rows if row['sketch_size'] == size]
+        print(f">>> sketch size {size}: "
+              f"mean error {np.mean([row['mean_error'] for row in size_rows]):.4f}, "
+              f"max error {max(row['max_error'] for row in size_rows):.4f}, "
+              f"relative frobenius {np.mean([row['relative_frobenius'] for row in size_rows]):.4f}, "
+              f"time {np.mean([row['sketch_time'] for row in size_rows]):.4f}s "
+              f"(features {np.mean([row['features_time'] for row in size_rows]):.4f}s) "
+              f"vs exact {np.mean([row['exact_time'] for row in size_rows]):.4f}s")
+    return rows
 
 
 if __name__ == "__main__":
@@ -689,6 +1658,3 @@ if __name__ == "__main__":
 
     # ring1 = list(rings1.values())[0]
     # print(simfunc_iso.compare(ring1, ring1))
-
-    # simfunc_time([simfunc_graphlet], graph_path, batches=100)
-    # simfunc_time([simfunc_r1, simfunc_graphlet, simfunc_iso, simfunc_hung], graph_path, batches=10)
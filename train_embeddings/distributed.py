@@ -0,0 +1,125 @@
+"""
+Data parallel training on CPUs.
+
+python train_embeddings/main.py train --procs P [--nodes N --node_rank i --master_addr A --master_port p] ...
+
+starts P processes on each of the N machines, i being the index of this machine and A:p the address of the process of
+rank 0. Every process loads the data, builds the model and trains it on its share of the batches (see
+loader.ShardedBatchSampler). Gradients are averaged over all processes at each step by DistributedDataParallel with
+the gloo backend, so the copies of the model stay the same. Only the process of rank 0 logs and saves checkpoints.
+"""
+import os
+import sys
+import pickle
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+if __name__ == "__main__":
+    sys.path.append(os.path.join(script_dir, '..'))
+
+from train_embeddings.loader import loader_from_hparams
+from train_embeddings.model import model_from_hparams
+from train_embeddings.learn import train_model
+from tools.learning_utils import mkdirs_learning
+
+
+def setup(rank, world_size, master_addr='127.0.0.1', master_port=29500, threads=None):
+    """
+    Join the process group
+    :param threads: number of threads of torch in this process, so that the processes of a machine share its cores
+    """
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = str(master_port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+
+def cleanup():
+    dist.destroy_process_group()
+
+
+def make_optimizer(model, optim_name='adam', lr=0.001):
+    if optim_name == 'sgd':
+        return optim.SGD(model.parameters(), lr=lr)
+    if optim_name == 'adam':
+        return optim.Adam(model.parameters(), lr=lr)
+    raise ValueError(f"Unsupported optimizer {optim_name}")
+
+
+def train_worker(local_rank, args, hparams):
+    """
+    Training in one process, the arguments are the ones of main.py
+    :param local_rank: index of the process on this machine
+    """
+    world_size = args.procs * args.nodes
+    rank = args.node_rank * args.procs + local_rank
+    setup(rank, world_size, args.master_addr, args.master_port, threads=max(1, os.cpu_count() // args.procs))
+
+    annotated_path = os.path.join(script_dir, '../data/annotated', args.annotated_data)
+    loader = loader_from_hparams(annotated_path=annotated_path, hparams=hparams, rank=rank, world_size=world_size)
+    hparams.add_value('argparse', 'num_edge_types', loader.num_edge_types)
+    train_loader, test_loader, _ = loader.get_data()
+
+    if len(train_loader) == 0 or len(test_loader) == 0:
+        raise ValueError(f'there are not enough points compared to the BS for {world_size} processes')
+
+    # DistributedDataParallel starts from the parameters of rank 0
+    model = DistributedDataParallel(model_from_hparams(hparams=hparams, verbose=rank == 0))
+    optimizer = make_optimizer(model, args.optim, args.lr)
+
+    writer, save_path, profile_path = None, None, None
+    if rank == 0:
+        from torch.utils.tensorboard import SummaryWriter
+
+        result_folder, save_path = mkdirs_learning(args.name)
+        writer = SummaryWriter(result_folder)
+        profile_path = os.path.join(result_folder, 'steps.jsonl')
+        print(f'Saving result in {args.name}, training on {world_size} processes')
+
+        hparams.dump(dump_path=os.path.join(script_dir, '../results/trained_models', args.name, f'{args.name}.exp'))
+        pickle.dump({
+            'dims': args.embedding_dims,
+            'edge_map': loader.dataset.edge_map,
+            'depth': args.kernel_depth,
+            'sim_function': args.sim_function
+        },
+            open(os.path.join(os.path.dirname(save_path), 'meta.p'), 'wb'))
+
+    train_model(model=model,
+                optimizer=optimizer,
+                train_loader=train_loader,
+                test_loader=test_loader,
+                save_path=save_path,
+                writer=writer,
+                num_epochs=args.num_epochs,
+                wall_time=args.wall_time,
+                rank=rank,
+                world_size=world_size,
+                profile_path=profile_path)
+    for data_loader in (train_loader, test_loader):
+        if hasattr(data_loader, 'close'):
+            data_loader.close()
+    cleanup()
+
+
+def launch(args, hparams):
+    """
+    Start the training processes of this machine and wait for them.
+    They are forked, spawned processes would import main.py.
+    """
+    context = mp.get_context('fork')
+    processes = [context.Process(target=train_worker, args=(local_rank, args, hparams))
+                 for local_rank in range(args.procs)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [local_rank for local_rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Training processes {failed} of this machine failed")
@@ -4,6 +4,7 @@ import os
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import dgl
 
 if __name__ == "__main__":
@@ -11,6 +12,7 @@ if __name__ == "__main__":
     sys.path.append(os.path.join(script_dir, '..'))
 
 from tools.utils import *
+from train_embeddings.profiling import StepProfiler
 
 
 def send_graph_to_device(g, device):
@@ -35,6 +37,15 @@ def send_graph_to_device(g, device):
     return g
 
 
+def send_target_to_device(K, device):
+    """
+    Send the target of a batch to device, K or the (pairs, values) tuple of sampled targets
+    """
+    if isinstance(K, tuple):
+        return tuple(k.to(device) for k in K)
+    return K.to(device)
+
+
 def print_gradients(model):
     """
         Set the gradients to the embedding and the attributor networks.
@@ -57,27 +68,41 @@ def test(model, test_loader, device):
     """
 
     model.eval()
+    module = model.module if hasattr(model, 'module') else model
     recons_loss_tot = 0
     test_size = len(test_loader)
     for batch_idx, (graph, K, inds, graph_sizes) in enumerate(test_loader):
         # Get data on the devices
-        K = K.to(device)
+        K = send_target_to_device(K, device)
         graph = send_graph_to_device(graph, device)
 
         # Do the computations for the forward pass
         with torch.no_grad():
             out = model(graph)
 
-            reconstruction_loss = model.rec_loss(embeddings=out,
-                                                 target_K=K,
-                                                 graph=graph)
+            reconstruction_loss = module.rec_loss(embeddings=out,
+                                                  target_K=K,
+                                                  graph=graph,
+                                                  graph_indices=inds,
+                                                  graph_sizes=graph_sizes)
 
             recons_loss_tot += reconstruction_loss
     return recons_loss_tot / test_size
 
 
+def all_reduce_mean(value, world_size):
+    """
+    Average a float over the processes of distributed training
+    """
+    if world_size == 1:
+        return float(value)
+    value = torch.tensor(float(value), dtype=torch.float64)
+    dist.all_reduce(value)
+    return value.item() / world_size
+
+
 def train_model(model, optimizer, train_loader, test_loader, save_path,
-                writer=None, num_epochs=25, wall_time=None, embed_only=-1):
+                writer=None, num_epochs=25, wall_time=None, embed_only=-1, rank=0, world_size=1, profile_path=None):
     """
     Performs the entire training routine.
     :param model: (torch.nn.Module): the model to train
@@ -89,13 +114,21 @@ def train_model(model, optimizer, train_loader, test_loader, save_path,
     :param num_epochs: int number of epochs
     :param wall_time: The number of hours you want the model to run
     :param embed_only: number of epochs before starting attributor training.
+    :param rank: rank of this process in distributed training, only rank 0 logs and saves checkpoints
+    :param world_size: number of processes in distributed training, model is then a DistributedDataParallel
+    :param profile_path: path of a JSON-lines file for the timings of each step (see train_embeddings/profiling.py)
     :return:
     """
-    device = model.current_device
+    # The model itself, in distributed training
+    module = model.module if hasattr(model, 'module') else model
+    device = module.current_device
     epochs_from_best = 0
     attributions = 0
     early_stop_threshold = 60
 
+    profiler = StepProfiler(jsonl_path=profile_path, writer=writer if rank == 0 else None, device=device,
+                            factorised=module.factorised)
+
     start_time = time.time()
     best_loss = sys.maxsize
     for epoch in range(num_epochs):
@@ -104,29 +137,37 @@ def train_model(model, optimizer, train_loader, test_loader, save_path,
         running_loss = 0.0
         num_batches = len(train_loader)
 
+        profiler.start_step()
         for batch_idx, (graph, K, inds, graph_sizes) in enumerate(train_loader):
-            batch_size = len(K)
+            profiler.lap('data')
 
             # Get data on the devices
-            K = K.to(device)
+            K = send_target_to_device(K, device)
             graph = send_graph_to_device(graph, device)
+            profiler.lap('to_device')
 
             # Do the computations for the forward pass
             out = model(graph)
-
-            loss = model.rec_loss(embeddings=out,
-                                  target_K=K,
-                                  graph=graph)
+            profiler.lap('forward')
+
+            loss = module.rec_loss(embeddings=out,
+                                   target_K=K,
+                                   graph=graph,
+                                   graph_indices=inds,
+                                   graph_sizes=graph_sizes)
+            profiler.lap('rec_loss')
             # Backward
             loss.backward()
+            profiler.lap('backward')
             optimizer.step()
             model.zero_grad()
+            profiler.lap('optimizer')
 
             # Metrics
             loss = loss.item()
             running_loss += loss
 
-            if batch_idx % 20 == 0:
+            if batch_idx % 20 == 0 and rank == 0:
                 time_elapsed = time.time() - start_time
                 print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}  Time: {:.2f}'.format(
                     epoch + 1,
@@ -139,43 +180,65 @@ def train_model(model, optimizer, train_loader, test_loader, save_path,
                 # tensorboard logging
                 step = epoch * num_batches + batch_idx
                 writer.add_scalar("Training loss", loss, step)
+            profiler.lap('logging')
+            profiler.end_step(epoch, graph_sizes, K, loader=train_loader)
 
-        # # Log training metrics
-        train_loss = running_loss / num_batches
-        writer.add_scalar("Training epoch loss", train_loss, epoch)
-
-        # Test phase
-        test_loss = test(model, test_loader, device)
+        profiler.end_epoch(epoch, verbose=rank == 0)
 
-        writer.add_scalar("Test loss during training", test_loss, epoch)
+        # # Log training metrics
+        train_loss = all_reduce_mean(running_loss / num_batches, world_size)
+        if rank == 0:
+            writer.add_scalar("Training epoch loss", train_loss, epoch)
+
+        # With a PrefetchLoader, tell whether training waits for the kernel computations
+        if hasattr(train_loader, 'stats') and rank == 0:
+            stats = train_loader.stats()
+            writer.add_scalar("Kernel wait time", stats['wait_time'], epoch)
+            writer.add_scalar("Kernel queue depth", stats['queue_depth'], epoch)
+            print(f">>> waited {stats['wait_time']:.4f}s per batch for the kernel, "
+                  f"{stats['queue_depth']:.2f} batches ready on average")
+
+        # Test phase, averaged over the processes so that they all take the same decisions below
+        test_loss = all_reduce_mean(test(model, test_loader, device), world_size)
+
+        if rank == 0:
+            writer.add_scalar("Test loss during training", test_loss, epoch)
         #
         # Checkpointing
         if test_loss < best_loss:
             best_loss = test_loss
             epochs_from_best = 0
 
-            model.cpu()
-            print(">> saving checkpoint")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict()
-            }, save_path)
-            model.to(device)
+            if rank == 0:
+                module.cpu()
+                print(">> saving checkpoint")
+                torch.save({
+                    'epoch': epoch,
+                    'model_state_dict': module.state_dict(),
+                    'optimizer_state_dict': optimizer.state_dict()
+                }, save_path)
+                module.to(device)
 
         # Early stopping
         else:
             epochs_from_best += 1
             if epochs_from_best > early_stop_threshold:
-                print('This model was early stopped')
+                if rank == 0:
+                    print('This model was early stopped')
                 break
 
         # Sanity Check
         if wall_time is not None:
-            # Break out of the loop if we might go beyond the wall time
+            # Break out of the loop if we might go beyond the wall time, as soon as one of the processes might
             time_elapsed = time.time() - start_time
-            if time_elapsed * (1 + 1 / (epoch + 1)) > .95 * wall_time * 3600:
+            over_time = time_elapsed * (1 + 1 / (epoch + 1)) > .95 * wall_time * 3600
+            if world_size > 1:
+                over_time = torch.tensor(int(over_time))
+                dist.all_reduce(over_time, op=dist.ReduceOp.MAX)
+                over_time = bool(over_time.item())
+            if over_time:
                 break
+    profiler.close()
     return best_loss
 
 
@@ -1,21 +1,34 @@
 import os
 import sys
 import pickle
+import hashlib
 
 from tqdm import tqdm
 import networkx as nx
 import dgl
 import numpy as np
 import torch
+from scipy import sparse
 
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 if __name__ == "__main__":
     sys.path.append(os.path.join(script_dir, '..'))
 
-from torch.utils.data import Dataset, DataLoader, Subset
-from tools.node_sim import k_block_list, simfunc_from_hparams, EDGE_MAP
-from tools.graph_utils import fetch_graph
+from torch.utils.data import Dataset, DataLoader, Subset, Sampler, BatchSampler, RandomSampler
+from tools.node_sim import k_block_list, k_pairs, k_sparse_list, lsh_recall_rings, unique_rings, simfunc_from_hparams, \
+    R1Sketch, EDGE_MAP
+from tools.graph_utils import fetch_graph, nx_to_dgl
+from prepare_data.signatures import load_sim_table, level_from_simfunc
+from prepare_data.landmarks import load_landmarks, landmarks_path
+from prepare_data.graph_sizes import load_sizes, size_index_path
+from prepare_data.dgl_cache import load_dgl_cache, dgl_cache_path
+from prepare_data.shards import Shards, shards_path
+from prepare_data.ring_store import RingStore, ring_store_path
+from train_embeddings.prefetch import PrefetchLoader
+
+# The LSH of k_sparse_list is checked on the recall of the pairs of nodes at least this similar
+LSH_RECALL_THRESHOLD = 0.7
 
 
 class V1(Dataset):
@@ -26,11 +39,18 @@ class V1(Dataset):
                  depth=3,
                  debug=False,
                  shuffled=False,
+                 sim_table=None,
+                 landmarks=None,
+                 dgl_cache=None,
+                 shards=None,
+                 ring_store=None
                  ):
 
         self.path = annotated_path
+        # With packed shards (prepare_data/shards.py), the files are read from the shards instead of annotated_path
+        self.shards = Shards(shards) if shards is not None else None
         # self.all_graphs = np.array(sorted(os.listdir(annotated_path)), dtype=np.string_)
-        self.all_graphs = sorted(os.listdir(annotated_path))
+        self.all_graphs = self.shards.names if self.shards is not None else sorted(os.listdir(annotated_path))
 
         self.node_simfunc = node_simfunc
 
@@ -44,7 +64,38 @@ class V1(Dataset):
             self.level = None
             self.depth = None
 
+        # With a precomputed signature table, items only carry the signature ids of their nodes
+        if sim_table is not None and node_simfunc is not None:
+            self.sim_table, index = load_sim_table(sim_table, node_sim=node_simfunc)
+            self.graph_ids = index['graph_ids']
+        else:
+            self.sim_table = None
+            self.graph_ids = None
+
+        # Same with landmarks, the table then holds the similarities of each signature to the landmarks
+        if landmarks is not None and node_simfunc is not None:
+            assert sim_table is None, "Use either a similarity table or landmarks"
+            self.landmark_table, index = load_landmarks(landmarks, node_sim=node_simfunc)
+            self.graph_ids = index['graph_ids']
+        else:
+            self.landmark_table = None
+
         self.edge_map = edge_map
+        # Graphs converted once by prepare_data/dgl_cache.py, the annotated files are then only read for the rings
+        if dgl_cache is not None:
+            self.dgl_graphs, _ = load_dgl_cache(dgl_cache, edge_map=edge_map)
+            missing = set(self.all_graphs) - set(self.dgl_graphs)
+            if missing:
+                raise ValueError(f"{len(missing)} graphs of {annotated_path} are not in {dgl_cache}, rebuild it with "
+                                 f"prepare_data/dgl_cache.py")
+        else:
+            self.dgl_graphs = None
+        # Rings decoded from the columnar store of prepare_data/ring_store.py, only for our level and depth
+        if ring_store is not None and self.level is not None and self.graph_ids is None:
+            self.ring_store = RingStore(ring_store, depth=self.depth)
+            assert self.ring_store.level == self.level, f"{ring_store} holds {self.ring_store.level} rings"
+        else:
+            self.ring_store = None
         # This is len() so we have to add the +1
         self.num_edge_types = max(self.edge_map.values()) + 1
         print(f"Found {self.num_edge_types} relations")
@@ -52,33 +103,152 @@ class V1(Dataset):
     def __len__(self):
         return len(self.all_graphs)
 
-    def __getitem__(self, idx):
-        g_path = os.path.join(self.path, self.all_graphs[idx])
+    def load(self, name):
+        """
+        :return: the annotation dict of a '.p' file, the graph of another one
+        """
+        if self.shards is not None:
+            return self.shards.load(name)
+        g_path = os.path.join(self.path, name)
         if g_path.endswith('.p'):
-            data = pickle.load(open(g_path, 'rb'))
-            graph = data['graph']
-        else:
-            graph = nx.read_gpickle(g_path)
-        graph = nx.to_undirected(graph)
-        one_hot = {edge: torch.tensor(self.edge_map[label]) for edge, label in
-                   (nx.get_edge_attributes(graph, 'label')).items()}
-        nx.set_edge_attributes(graph, name='one_hot', values=one_hot)
+            return pickle.load(open(g_path, 'rb'))
+        return nx.read_gpickle(g_path)
 
-        g_dgl = dgl.DGLGraph()
-        g_dgl.from_networkx(nx_graph=graph, edge_attrs=['one_hot'])
+    def fetch_graph(self, name):
+        data = self.load(name)
+        return data['graph'] if name.endswith('.p') else data
+
+    def __getitem__(self, idx):
+        name = self.all_graphs[idx]
+        if self.dgl_graphs is not None:
+            g_dgl = self.dgl_graphs[name]
+            if self.graph_ids is None and self.node_simfunc is not None and self.ring_store is None:
+                data = self.load(name)
+        else:
+            data = self.load(name)
+            graph = data['graph'] if name.endswith('.p') else data
+            g_dgl, _ = nx_to_dgl(graph, self.edge_map)
 
+        if self.graph_ids is not None:
+            return g_dgl, self.graph_ids[self.all_graphs[idx]], [idx]
         if self.node_simfunc is not None:
-            ring = data['rings'][self.level]
+            ring = self.ring_store.rings(name) if self.ring_store is not None else data['rings'][self.level]
             return g_dgl, ring, [idx]
         else:
             return g_dgl, 0, [idx]
 
 
-def collate_wrapper(node_simfunc):
+def nc_neighbourhoods(graph, depth, canonical=(0, 6)):
+    """
+    Find the nodes that have a non canonical edge within their rings.
+    :param graph: a (batched) DGL graph with edge types in 'one_hot'
+    :param depth: the depth of the rings
+    :param canonical: the edge types that are not non canonical (backbone and CWW)
+    :return: a boolean array in the node order of the graph
+    """
+    src, dst = graph.all_edges()
+    src, dst = src.numpy(), dst.numpy()
+    n = graph.number_of_nodes()
+    adj = sparse.coo_matrix((np.ones(len(src)), (src, dst)), shape=(n, n)).tocsr()
+    adj = adj + adj.T
+
+    nc_edges = ~np.isin(graph.edata['one_hot'].numpy(), canonical)
+    nc = np.zeros(n, dtype=bool)
+    nc[src[nc_edges]] = True
+    nc[dst[nc_edges]] = True
+    # An edge is in the last ring of the nodes that are depth - 1 hops away from it
+    for _ in range(depth - 1):
+        nc = nc | (adj @ nc > 0)
+    return nc
+
+
+def sample_pairs(nc, budget, nc_weight=1., rng=np.random):
+    """
+    Sample partners for each node of a batch, to train on a subset of K.
+    :param nc: boolean array of the nodes with a non canonical neighbourhood
+    :param budget: number of partners for each node
+    :param nc_weight: how much more likely non canonical neighbourhoods are to be sampled as partners
+    :param rng: a numpy RandomState
+    :return: a (n_nodes * budget, 2) array of node indices
+    """
+    n = len(nc)
+    probs = np.where(nc, nc_weight, 1.)
+    partners = rng.choice(n, size=(n, budget), p=probs / probs.sum())
+    return np.stack([np.repeat(np.arange(n), budget), partners.reshape(-1)], axis=1)
+
+
+def collate_wrapper(node_simfunc, sim_table=None, sketch=None, factorised=False, pair_budget=0, nc_weight=1.,
+                    canonical=(0, 6), landmark_table=None, lsh_bands=0, lsh_band_size=4, lsh_floor=0.):
     """
         Wrapper for collate function so we can use different node similarities.
+        If a signature similarity table is given, the samples hold signature ids instead of rings
+        and K is read from the table.
+        If a sketch is given, K is approximated as phi phi^T from its features, or phi is returned as is
+        when the loss is factorised.
+        If a pair budget is given, only pair_budget entries of K are computed for each node and the target is
+        the tuple (pairs, values) instead of K.
+        If a landmark table is given, the target is the (n_nodes, n_landmarks) similarities to the landmarks.
+        If lsh_bands is given, only the pairs that share a LSH bucket are compared, and the target is the sparse K
+        (pairs, values, floor), the other entries being equal to floor.
     """
-    if node_simfunc is not None:
+    if sketch is not None and (sim_table is not None or landmark_table is not None):
+        raise ValueError("A kernel sketch is computed from rings, not from a signature table or landmarks")
+    if sketch is not None:
+        def collate_block(samples):
+            graphs, rings, idx = map(list, zip(*samples))
+            batched_graph = dgl.batch(graphs)
+            nodes = [ring for graph_rings in rings for ring in graph_rings.values()]
+            unique, inverse = unique_rings(nodes, node_simfunc)
+            phi = sketch.transform(unique)[inverse]
+            K = phi if factorised else phi @ phi.T
+            idx = np.array(idx)
+            len_graphs = [len(graph) for graph in graphs]
+            return batched_graph, torch.from_numpy(K).detach().float(), torch.from_numpy(idx), len_graphs
+    elif landmark_table is not None:
+        def collate_block(samples):
+            graphs, signature_ids, idx = map(list, zip(*samples))
+            batched_graph = dgl.batch(graphs)
+            K = np.array(landmark_table[np.concatenate(signature_ids)])
+            idx = np.array(idx)
+            len_graphs = [len(graph) for graph in graphs]
+            return batched_graph, torch.from_numpy(K).detach().float(), torch.from_numpy(idx), len_graphs
+    elif pair_budget:
+        def collate_block(samples):
+            graphs, rings, idx = map(list, zip(*samples))
+            batched_graph = dgl.batch(graphs)
+            nc = nc_neighbourhoods(batched_graph, node_simfunc.depth, canonical=canonical)
+            # Draw the seed from torch so that each worker samples different pairs
+            rng = np.random.RandomState(torch.randint(2 ** 31, (1,)).item())
+            pairs = sample_pairs(nc, pair_budget, nc_weight=nc_weight, rng=rng)
+            if sim_table is not None:
+                signature_ids = np.concatenate(rings)
+                values = np.array(sim_table[signature_ids[pairs[:, 0]], signature_ids[pairs[:, 1]]])
+            else:
+                nodes = [ring for graph_rings in rings for ring in graph_rings.values()]
+                values = k_pairs(nodes, pairs, node_simfunc)
+            idx = np.array(idx)
+            len_graphs = [len(graph) for graph in graphs]
+            target = (torch.from_numpy(pairs), torch.from_numpy(values).detach().float())
+            return batched_graph, target, torch.from_numpy(idx), len_graphs
+    elif lsh_bands:
+        def collate_block(samples):
+            graphs, rings, idx = map(list, zip(*samples))
+            batched_graph = dgl.batch(graphs)
+            pairs, values = k_sparse_list(rings, node_simfunc, n_bands=lsh_bands, band_size=lsh_band_size)
+            idx = np.array(idx)
+            len_graphs = [len(graph) for graph in graphs]
+            target = (torch.from_numpy(pairs), torch.from_numpy(values).detach().float(), torch.tensor(lsh_floor))
+            return batched_graph, target, torch.from_numpy(idx), len_graphs
+    elif sim_table is not None:
+        def collate_block(samples):
+            graphs, signature_ids, idx = map(list, zip(*samples))
+            batched_graph = dgl.batch(graphs)
+            signature_ids = np.concatenate(signature_ids)
+            K = np.array(sim_table[signature_ids[:, None], signature_ids[None, :]])
+            idx = np.array(idx)
+            len_graphs = [len(graph) for graph in graphs]
+            return batched_graph, torch.from_numpy(K).detach().float(), torch.from_numpy(idx), len_graphs
+    elif node_simfunc is not None:
         def collate_block(samples):
             # The input `samples` is a list of tuples
             #  (graph, ring, label).
@@ -97,9 +267,192 @@ def collate_wrapper(node_simfunc):
             idx = np.array(idx)
             len_graphs = [len(graph) for graph in graphs]
             return batched_graph, [1 for _ in samples], torch.from_numpy(idx), len_graphs
+
+    if getattr(node_simfunc, 'assignments', None) is not None:
+        # Add the memoization counts of the batch to the shared ones when it is computed by a worker
+        kernel_block = collate_block
+
+        def collate_block(samples):
+            batch = kernel_block(samples)
+            node_simfunc.assignments.flush()
+            return batch
     return collate_block
 
 
+class FixedBatchSampler(Sampler):
+    """
+    Batches whose composition is drawn once, so that their K can be cached across epochs.
+    Only the order of the batches is shuffled at each epoch.
+    """
+
+    def __init__(self, n, batch_size, shuffle=True, seed=0):
+        order = np.random.RandomState(seed).permutation(n)
+        self.batches = [order[i:i + batch_size].tolist() for i in range(0, n, batch_size)]
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        order = np.random.permutation(len(self.batches)) if self.shuffle else range(len(self.batches))
+        return iter([self.batches[i] for i in order])
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class NodeBudgetSampler(Sampler):
+    """
+    Batches of graphs of similar sizes, filled up to a total number of nodes rather than a number of graphs,
+    so that the cost of K (quadratic in the number of nodes) and the memory of the RGCN stay about the same for
+    every batch. Graphs are sorted by size, with a random order between graphs whose sizes fall in the same bucket,
+    and cut into consecutive batches. A graph larger than the budget gets a batch of its own.
+    """
+
+    def __init__(self, sizes, node_budget, bucket_width=10, shuffle=True, fixed=False, seed=0):
+        """
+        :param sizes: number of nodes of each graph
+        :param node_budget: maximum total number of nodes of a batch
+        :param bucket_width: graphs whose sizes differ by less than this can be batched in any order
+        :param shuffle: shuffle the order of the batches
+        :param fixed: draw the composition of the batches once, like FixedBatchSampler, to cache their K
+        :param seed: seed of the fixed composition
+        """
+        self.sizes = np.asarray(sizes)
+        self.node_budget = node_budget
+        self.buckets = self.sizes // bucket_width
+        self.shuffle = shuffle
+        self.batches = self.make_batches(np.random.RandomState(seed)) if fixed else None
+        self.next_batches = None
+
+    def make_batches(self, rng=np.random):
+        order = np.lexsort((rng.permutation(len(self.sizes)), self.buckets))
+        batches = []
+        batch, total = [], 0
+        for i in order:
+            if batch and total + self.sizes[i] > self.node_budget:
+                batches.append(batch)
+                batch, total = [], 0
+            batch.append(int(i))
+            total += self.sizes[i]
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def epoch_batches(self):
+        if self.batches is not None:
+            return self.batches
+        # the number of batches can vary slightly between epochs, draw the next epoch when its length is asked for
+        if self.next_batches is None:
+            self.next_batches = self.make_batches()
+        return self.next_batches
+
+    def __iter__(self):
+        batches = self.epoch_batches()
+        self.next_batches = None
+        order = np.random.permutation(len(batches)) if self.shuffle else range(len(batches))
+        return iter([batches[i] for i in order])
+
+    def __len__(self):
+        return len(self.epoch_batches())
+
+
+class ShardedBatchSampler(Sampler):
+    """
+    The share of one process of the batches of another batch sampler, for distributed training.
+    Every process draws the same batches, with the random state seeded by the epoch, and keeps one in world_size.
+    Trailing batches are dropped so that all processes do the same number of steps.
+    """
+
+    def __init__(self, batch_sampler, rank, world_size, seed=0):
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.batches = None
+
+    def epoch_batches(self):
+        if self.batches is None:
+            np_state, torch_state = np.random.get_state(), torch.get_rng_state()
+            np.random.seed(self.seed + self.epoch)
+            torch.manual_seed(self.seed + self.epoch)
+            batches = list(self.batch_sampler)
+            np.random.set_state(np_state)
+            torch.set_rng_state(torch_state)
+            n_steps = len(batches) // self.world_size
+            self.batches = batches[self.rank:n_steps * self.world_size:self.world_size]
+        return self.batches
+
+    def __iter__(self):
+        batches = self.epoch_batches()
+        self.batches = None
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.epoch_batches())
+
+
+class KCache():
+    """
+    Targets of fixed composition batches, keyed by the dataset indices of their graphs.
+    In memory, or in a directory to share them between DataLoader workers, that are restarted at each epoch.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.table = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, hashlib.md5(str(key).encode()).hexdigest() + '.pt')
+
+    def get(self, key):
+        if self.cache_dir is None:
+            return self.table.get(key)
+        try:
+            return torch.load(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, K):
+        if self.cache_dir is None:
+            self.table[key] = K
+        else:
+            # write then rename, so that a concurrent reader never sees a partial file
+            tmp_path = self.path(key) + f'.{os.getpid()}'
+            torch.save(K, tmp_path)
+            os.replace(tmp_path, self.path(key))
+
+
+def dataset_fingerprint(path):
+    """
+    :param path: directory of annotated graphs, or of shards
+    :return: a hash of the names, sizes and modification times of its files, which changes when graphs are added or
+    annotated again
+    """
+    files = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in os.scandir(path))
+    return hashlib.md5(str(files).encode()).hexdigest()
+
+
+def cached_collate(collate_block, k_cache):
+    """
+    Wrap a collate function so that the target of each batch is only computed the first time we see it.
+    """
+    graph_collate = collate_wrapper(None)
+
+    def collate_cached(samples):
+        key = tuple(idx for _, _, [idx] in samples)
+        K = k_cache.get(key)
+        if K is None:
+            batched_graph, K, idx, len_graphs = collate_block(samples)
+            k_cache.put(key, K)
+        else:
+            batched_graph, _, idx, len_graphs = graph_collate(samples)
+        return batched_graph, K, idx, len_graphs
+
+    return collate_cached
+
+
 class Loader():
     def __init__(self,
                  annotated_path='data/annotated/samples/',
@@ -108,7 +461,27 @@ class Loader():
                  debug=False,
                  shuffled=False,
                  edge_map=EDGE_MAP,
-                 node_simfunc=None):
+                 node_simfunc=None,
+                 sim_table=None,
+                 sketch_size=0,
+                 factorised=False,
+                 pair_budget=0,
+                 nc_weight=1.,
+                 landmarks=None,
+                 lsh_bands=0,
+                 lsh_band_size=4,
+                 lsh_floor=0.,
+                 lsh_min_recall=0.9,
+                 k_cache=None,
+                 prefetch=0,
+                 prefetch_depth=4,
+                 node_budget=0,
+                 size_index=None,
+                 dgl_cache=None,
+                 shards=None,
+                 ring_store=None,
+                 rank=0,
+                 world_size=1):
         """
 
         :param annotated_path:
@@ -118,6 +491,32 @@ class Loader():
         :param shuffled:
         :param node_simfunc: The node comparison object to use for the embeddings. If None is selected,
         will just return graphs
+        :param sim_table: path prefix of a signature similarity table built by prepare_data/signatures.py, to read K
+        from instead of calling the node comparison
+        :param sketch_size: if not 0, approximate the R_1 kernel with a R1Sketch of this size
+        :param factorised: return the sketch features instead of K, for the factorised loss of the model
+        :param pair_budget: if not 0, only compute this many sampled entries of K per node
+        :param nc_weight: how much more likely nodes with a non canonical neighbourhood are to be sampled
+        :param landmarks: path prefix of landmarks built by prepare_data/landmarks.py, to compare nodes to the
+        landmarks only
+        :param lsh_bands: if not 0, only compare the nodes that share a bucket in one of lsh_bands LSH bands
+        :param lsh_band_size: number of minhashes per LSH band
+        :param lsh_floor: value of the entries of K that are not compared
+        :param lsh_min_recall: the LSH is only used if it finds this fraction of the pairs of similarity above
+        LSH_RECALL_THRESHOLD on a few batches of the data (see check_lsh), 0 to always use it
+        :param k_cache: None to compute the targets of each batch at each epoch. Otherwise batch composition is fixed
+        and each target is only computed once, then kept in memory ('memory') or in a directory (any other value)
+        :param prefetch: if not 0, compute the training and test batches ahead of time with this many processes
+        (see train_embeddings/prefetch.py) instead of the DataLoader
+        :param prefetch_depth: maximum number of batches computed ahead of time
+        :param node_budget: if not 0, batch graphs of similar sizes up to this total number of nodes instead of
+        batch_size graphs
+        :param size_index: path of the graph sizes built by prepare_data/graph_sizes.py, for the node budget
+        :param dgl_cache: path prefix of the graphs converted by prepare_data/dgl_cache.py, to load them all at once
+        :param shards: directory of the dataset packed by prepare_data/shards.py, to read it instead of annotated_path
+        :param ring_store: directory of a ring store of prepare_data/ring_store.py, to read the rings from
+        :param rank: rank of this process in distributed training
+        :param world_size: number of processes in distributed training, each one gets a share of the batches
         :param hparams:
         """
         self.batch_size = batch_size
@@ -126,10 +525,65 @@ class Loader():
                           debug=debug,
                           shuffled=shuffled,
                           node_simfunc=node_simfunc,
-                          edge_map=edge_map)
+                          edge_map=edge_map,
+                          sim_table=sim_table,
+                          landmarks=landmarks,
+                          dgl_cache=dgl_cache,
+                          shards=shards,
+                          ring_store=ring_store)
 
         self.node_simfunc = node_simfunc
         self.num_edge_types = self.dataset.num_edge_types
+        self.sketch = R1Sketch(node_simfunc, sketch_size=sketch_size) if sketch_size else None
+        assert self.sketch is not None or not factorised, "The factorised loss needs a kernel sketch"
+        assert self.sketch is None or (sim_table is None and landmarks is None), \
+            "A kernel sketch needs rings, it cannot be combined with a signature table or landmarks"
+        self.factorised = factorised
+        assert not pair_budget or (self.sketch is None and node_simfunc is not None and landmarks is None), \
+            "Sampled pairs need a node similarity and no kernel sketch or landmarks"
+        assert not lsh_bands or (self.sketch is None and node_simfunc is not None and not pair_budget
+                                 and sim_table is None and landmarks is None), \
+            "LSH needs a node similarity and no kernel sketch, sampled pairs or precomputed table"
+        if lsh_bands and lsh_min_recall:
+            lsh_bands = self.check_lsh(lsh_bands, lsh_band_size, lsh_min_recall)
+        self.lsh_bands = lsh_bands
+        self.lsh_band_size = lsh_band_size
+        self.lsh_floor = lsh_floor
+        self.pair_budget = pair_budget
+        self.nc_weight = nc_weight
+        self.canonical = [edge_map['B53'], edge_map['CWW']]
+
+        assert k_cache is None or not pair_budget, "Sampled pairs are drawn again at each batch and cannot be cached"
+        if k_cache == 'memory' and num_workers > 0:
+            print(">>> the in memory K cache is filled in the workers and lost at each epoch, use a directory instead")
+        self.k_cache = k_cache
+        self.prefetch = prefetch
+        self.prefetch_depth = prefetch_depth
+        if prefetch and k_cache == 'memory':
+            raise ValueError("The prefetch processes do not share a memory K cache, use a disk one")
+        self.node_budget = node_budget
+        self.size_index = size_index
+        self.rank = rank
+        self.world_size = world_size
+
+    def check_lsh(self, lsh_bands, lsh_band_size, min_recall, batches=3):
+        """
+        Measure the recall of the LSH of k_sparse_list on random batches of the dataset
+        :return: lsh_bands if the recall of the pairs of similarity above LSH_RECALL_THRESHOLD is at least min_recall,
+        0 otherwise so that the whole K is computed
+        """
+        rng = np.random.RandomState(0)
+        size = min(self.batch_size, len(self.dataset))
+        ring_batches = [[self.dataset[i][1] for i in rng.choice(len(self.dataset), size=size, replace=False)]
+                        for _ in range(batches)]
+        rows = lsh_recall_rings(ring_batches, self.node_simfunc, n_bands=lsh_bands, band_size=lsh_band_size,
+                                thresholds=(LSH_RECALL_THRESHOLD,))
+        similar = sum(row[f'pairs_{LSH_RECALL_THRESHOLD}'] for row in rows)
+        recall = sum(row[f'found_{LSH_RECALL_THRESHOLD}'] for row in rows) / similar if similar else 1.
+        if recall < min_recall:
+            print(f">>> LSH recall {recall:.3f} is below {min_recall}, computing the whole K instead")
+            return 0
+        return lsh_bands
 
     def get_data(self):
         n = len(self.dataset)
@@ -151,14 +605,63 @@ class Loader():
 
         print(f"training items: ", len(train_set))
 
-        collate_block = collate_wrapper(self.node_simfunc)
-
-        train_loader = DataLoader(dataset=train_set, shuffle=True, batch_size=self.batch_size,
-                                  num_workers=self.num_workers, collate_fn=collate_block)
-        # valid_loader = DataLoader(dataset=valid_set, shuffle=True, batch_size=self.batch_size,
-        #                           num_workers=self.num_workers, collate_fn=collate_block)
-        test_loader = DataLoader(dataset=test_set, shuffle=True, batch_size=self.batch_size,
-                                 num_workers=self.num_workers, collate_fn=collate_block)
+        # The kernel runs in other processes, which add up their counts of R_iso memoization
+        if (self.num_workers or self.prefetch) and getattr(self.node_simfunc, 'assignments', None) is not None:
+            self.node_simfunc.assignments.share()
+
+        collate_block = collate_wrapper(self.node_simfunc,
+                                        sim_table=self.dataset.sim_table,
+                                        sketch=self.sketch,
+                                        factorised=self.factorised,
+                                        pair_budget=self.pair_budget,
+                                        nc_weight=self.nc_weight,
+                                        canonical=self.canonical,
+                                        landmark_table=self.dataset.landmark_table,
+                                        lsh_bands=self.lsh_bands,
+                                        lsh_band_size=self.lsh_band_size,
+                                        lsh_floor=self.lsh_floor)
+
+        if self.k_cache is not None or self.prefetch or self.node_budget or self.world_size > 1:
+            fixed = self.k_cache is not None
+            if fixed:
+                k_cache = KCache(None if self.k_cache == 'memory' else self.k_cache)
+                collate_train = collate_test = cached_collate(collate_block, k_cache)
+            else:
+                collate_train = collate_test = collate_block
+            if self.node_budget:
+                sizes = load_sizes(self.dataset.path, self.dataset.all_graphs, self.size_index,
+                                   dgl_graphs=self.dataset.dgl_graphs, ring_store=self.dataset.ring_store,
+                                   shards=self.dataset.shards)
+                train_sampler = NodeBudgetSampler([sizes[i] for i in train_indices], self.node_budget,
+                                                  shuffle=True, fixed=fixed)
+                test_sampler = NodeBudgetSampler([sizes[i] for i in test_indices], self.node_budget,
+                                                 shuffle=False, fixed=fixed)
+            elif fixed:
+                train_sampler = FixedBatchSampler(len(train_set), self.batch_size, shuffle=True)
+                test_sampler = FixedBatchSampler(len(test_set), self.batch_size, shuffle=False)
+            else:
+                train_sampler = BatchSampler(RandomSampler(train_set), self.batch_size, drop_last=False)
+                test_sampler = BatchSampler(RandomSampler(test_set), self.batch_size, drop_last=False)
+            if self.world_size > 1:
+                train_sampler = ShardedBatchSampler(train_sampler, self.rank, self.world_size)
+                test_sampler = ShardedBatchSampler(test_sampler, self.rank, self.world_size)
+            if self.prefetch:
+                train_loader = PrefetchLoader(train_set, train_sampler, collate_train,
+                                              num_workers=self.prefetch, depth=self.prefetch_depth)
+                test_loader = PrefetchLoader(test_set, test_sampler, collate_test,
+                                             num_workers=self.prefetch, depth=self.prefetch_depth)
+            else:
+                train_loader = DataLoader(dataset=train_set, batch_sampler=train_sampler,
+                                          num_workers=self.num_workers, collate_fn=collate_train)
+                test_loader = DataLoader(dataset=test_set, batch_sampler=test_sampler,
+                                         num_workers=self.num_workers, collate_fn=collate_test)
+        else:
+            train_loader = DataLoader(dataset=train_set, shuffle=True, batch_size=self.batch_size,
+                                      num_workers=self.num_workers, collate_fn=collate_block)
+            # valid_loader = DataLoader(dataset=valid_set, shuffle=True, batch_size=self.batch_size,
+            #                           num_workers=self.num_workers, collate_fn=collate_block)
+            test_loader = DataLoader(dataset=test_set, shuffle=True, batch_size=self.batch_size,
+                                     num_workers=self.num_workers, collate_fn=collate_block)
         all_loader = DataLoader(dataset=all_set, shuffle=True, batch_size=self.batch_size,
                                 num_workers=self.num_workers, collate_fn=collate_block)
 
@@ -171,13 +674,18 @@ class InferenceLoader(Loader):
                  annotated_path,
                  batch_size=5,
                  num_workers=20,
-                 edge_map=EDGE_MAP):
+                 edge_map=EDGE_MAP,
+                 shards=None):
         super().__init__(
             annotated_path=annotated_path,
             batch_size=batch_size,
             num_workers=num_workers,
-            edge_map=edge_map
+            edge_map=edge_map,
+            shards=shards
         )
+        # read packed graphs in the order they are stored in
+        if self.dataset.shards is not None:
+            list_to_predict = self.dataset.shards.order(list_to_predict)
         self.dataset.all_graphs = list_to_predict
         self.dataset.path = annotated_path
         print(len(list_to_predict))
@@ -192,23 +700,70 @@ class InferenceLoader(Loader):
         return train_loader
 
 
-def loader_from_hparams(annotated_path, hparams, list_inference=None):
+def loader_from_hparams(annotated_path, hparams, list_inference=None, shards=None, rank=0, world_size=1):
     """
         :params
         :get_sim_mat: switches off computation of rings and K matrix for faster loading.
+        :shards: directory of packed shards to read the graphs from, by default the ones of
+        the annotated data for training runs with shards
+        :rank, world_size: the process and number of processes of distributed training
     """
     if list_inference is None:
+        if shards is None and hparams.get('argparse', 'shards'):
+            shards = shards_path(hparams.get('argparse', 'annotated_data'))
         node_simfunc = simfunc_from_hparams(hparams)
+        sim_table = hparams.get('argparse', 'sim_table')
+        if sim_table is not None:
+            sim_table = os.path.join(script_dir, '..', 'data', 'signatures', sim_table)
+        landmarks = hparams.get('argparse', 'landmarks')
+        if landmarks is not None:
+            landmarks = landmarks_path(landmarks)
+        k_cache = hparams.get('argparse', 'k_cache')
+        if k_cache == 'disk':
+            # The targets depend on all these options and on the files of the dataset, since the cache is keyed by the
+            # dataset indices of the graphs. Runs that share them share the cache.
+            options = ['annotated_data', 'batch_size', 'node_budget', 'sim_function', 'kernel_depth', 'decay', 'idf',
+                       'normalization', 'sim_table', 'sketch_size', 'factorised', 'landmarks', 'lsh_bands',
+                       'lsh_band_size', 'lsh_floor']
+            config = str([hparams.get('argparse', option) for option in options] + [hparams.get('edges', 'edge_map')]
+                         + [dataset_fingerprint(shards if shards is not None else annotated_path)])
+            k_cache = os.path.join(script_dir, '..', 'data', 'k_cache',
+                                   f"{hparams.get('argparse', 'annotated_data')}_"
+                                   f"{hashlib.md5(config.encode()).hexdigest()[:12]}")
         loader = Loader(annotated_path=annotated_path,
                         batch_size=hparams.get('argparse', 'batch_size'),
                         num_workers=hparams.get('argparse', 'workers'),
                         edge_map=hparams.get('edges', 'edge_map'),
-                        node_simfunc=node_simfunc)
+                        node_simfunc=node_simfunc,
+                        sim_table=sim_table,
+                        sketch_size=hparams.get('argparse', 'sketch_size'),
+                        factorised=hparams.get('argparse', 'factorised'),
+                        pair_budget=hparams.get('argparse', 'pair_budget'),
+                        nc_weight=hparams.get('argparse', 'nc_weight'),
+                        landmarks=landmarks,
+                        lsh_bands=hparams.get('argparse', 'lsh_bands'),
+                        lsh_band_size=hparams.get('argparse', 'lsh_band_size'),
+                        lsh_floor=hparams.get('argparse', 'lsh_floor'),
+                        lsh_min_recall=hparams.get('argparse', 'lsh_min_recall'),
+                        k_cache=k_cache,
+                        prefetch=hparams.get('argparse', 'prefetch'),
+                        prefetch_depth=hparams.get('argparse', 'prefetch_depth'),
+                        node_budget=hparams.get('argparse', 'node_budget'),
+                        size_index=size_index_path(hparams.get('argparse', 'annotated_data')),
+                        dgl_cache=dgl_cache_path(hparams.get('argparse', 'annotated_data'))
+                        if hparams.get('argparse', 'dgl_cache') else None,
+                        shards=shards,
+                        ring_store=ring_store_path(hparams.get('argparse', 'annotated_data'),
+                                                   level_from_simfunc(node_simfunc))
+                        if hparams.get('argparse', 'ring_store') and node_simfunc is not None else None,
+                        rank=rank,
+                        world_size=world_size)
         return loader
 
     loader = InferenceLoader(list_to_predict=list_inference,
                              annotated_path=annotated_path,
                              batch_size=hparams.get('argparse', 'batch_size'),
                              num_workers=hparams.get('argparse', 'workers'),
-                             edge_map=hparams.get('edges', 'edge_map'))
+                             edge_map=hparams.get('edges', 'edge_map'),
+                             shards=shards)
     return loader
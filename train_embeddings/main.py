@@ -37,12 +37,28 @@ if function == 'train':
     parser.add_argument("-ini", "--ini", default=None, help="name of the additional .ini to use")
     parser.add_argument("-da", "--annotated_data", default='rna_graphs_nr')
     parser.add_argument("-bs", "--batch_size", type=int, default=2, help="choose the batch size")
+    parser.add_argument("--node_budget", type=int, default=0,
+                        help="If not 0, batch graphs of similar sizes up to this total number of nodes instead")
+    parser.add_argument("--dgl_cache", default=False, action='store_true',
+                        help="Load the graphs converted by prepare_data/dgl_cache.py instead of converting them")
+    parser.add_argument("--shards", default=False, action='store_true',
+                        help="Read the annotated data from the shards packed by prepare_data/shards.py")
+    parser.add_argument("--ring_store", default=False, action='store_true',
+                        help="Read the rings from the store built by prepare_data/ring_store.py")
     parser.add_argument("-nw", "--workers", type=int, default=0, help="Number of workers to load data")
     parser.add_argument("-wt", "--wall_time", type=int, default=None, help="Max time to run the model")
     parser.add_argument("-n", "--name", type=str, default='default_name', help="Name for the logs")
     parser.add_argument("-t", "--timed", help="to use timed learning", action='store_true')
     parser.add_argument("-ep", "--num_epochs", type=int, help="number of epochs to train", default=30)
     parser.add_argument("-dev", "--device", default=0, type=int, help="gpu device to use")
+    parser.add_argument("--procs", type=int, default=1,
+                        help="Number of data parallel training processes on this machine (CPU, gloo)")
+    parser.add_argument("--nodes", type=int, default=1, help="Number of machines of data parallel training")
+    parser.add_argument("--node_rank", type=int, default=0, help="Index of this machine among them")
+    parser.add_argument("--master_addr", default='127.0.0.1', help="Address of the machine of index 0")
+    parser.add_argument("--master_port", type=int, default=29500, help="Free port on the machine of index 0")
+    parser.add_argument("-v", "--verbose", default=False, action='store_true',
+                        help="Log per batch information (e.g. kernel deduplication)")
 
     # Kernel function arguments
     parser.add_argument('-sf', '--sim_function', type=str,
@@ -54,6 +70,33 @@ if function == 'train':
     parser.add_argument('-norm', '--normalization', type=str,
                         help='Normalization function (Supported Options None, sqrt, log)',
                         default='sqrt')
+    parser.add_argument("--sim_table", default=None,
+                        help="Name of a signature similarity table in data/signatures (see prepare_data/signatures.py)")
+    parser.add_argument("--ged_cache", default=None, action='store_true',
+                        help="Share graphlet GED values across workers and runs through a memory mapped cache")
+    parser.add_argument("--ged_matrix", default=False, action='store_true',
+                        help="Read graphlet similarities from the matrix built by prepare_data/ged_matrix.py")
+    parser.add_argument("--assignment_table", default=None,
+                        help="Path to a precomputed R_iso assignment table (see tools.node_sim.build_assignment_table)")
+    parser.add_argument("--sketch_size", type=int, default=0,
+                        help="Approximate the R_1 kernel with a feature map sketch of this size, 0 for the exact kernel")
+    parser.add_argument("--pair_budget", type=int, default=0,
+                        help="Only compute this many sampled entries of K per node, 0 for the whole K")
+    parser.add_argument("--nc_weight", type=float, default=4.,
+                        help="How much more likely nodes with non canonical neighbourhoods are sampled as partners")
+    parser.add_argument("--landmarks", default=None,
+                        help="Name of landmarks in data/signatures to compare nodes to (see prepare_data/landmarks.py)")
+    parser.add_argument("--lsh_bands", type=int, default=0,
+                        help="Only compare nodes that share a bucket in one of this many LSH bands, 0 for the whole K")
+    parser.add_argument("--lsh_band_size", type=int, default=4, help="Number of minhashes per LSH band")
+    parser.add_argument("--lsh_floor", type=float, default=0., help="Value of the entries of K that are not compared")
+    parser.add_argument("--lsh_min_recall", type=float, default=0.9,
+                        help="Compute the whole K if LSH finds less of the similar pairs of the data, 0 to skip check")
+    parser.add_argument("--k_cache", default=None, choices=['memory', 'disk'],
+                        help="Fix the batches once and compute their K only once, kept in memory or on disk")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="Number of processes computing the K of upcoming batches while training, 0 to disable")
+    parser.add_argument("--prefetch_depth", type=int, default=4, help="Maximum number of batches computed ahead")
 
     # Reconstruction arguments
     parser.add_argument('--optim', type=str,
@@ -70,7 +113,11 @@ if function == 'train':
     parser.add_argument('-ed', '--embedding_dims', nargs='+', type=int, help='Dimensions for embeddings.',
                         default=[32, 64])
     parser.add_argument("--weight", help="Whether to weight the K-matrix for NC", action='store_true')
+    parser.add_argument("--loss_block", type=int, default=0,
+                        help="If not 0, compute the loss by blocks of this many rows to save memory on large batches")
     parser.add_argument("--normalize", help="Whether to use cosine instead of dot product", action='store_true')
+    parser.add_argument("--factorised", help="Train on the sketch features without forming K (needs --sketch_size)",
+                        action='store_true')
     parser.add_argument('-co', '--conv_output',
                         default=True,
                         help='Apply graph conv to last later. Default: True',
@@ -82,6 +129,10 @@ if function == 'train':
           '\n'.join(map(str, vars(args).items()))
           )
 
+    import logging
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+
     # Torch imports
     import torch
     import torch.optim as optim
@@ -104,6 +155,13 @@ if function == 'train':
                          path_to_ini=args.ini,
                          argparse=args)
 
+    # Data parallel training, the processes do all the rest
+    if args.procs * args.nodes > 1:
+        from train_embeddings.distributed import launch
+
+        launch(args, hparams)
+        sys.exit()
+
     # Hardware settings
     # torch.multiprocessing.set_sharing_strategy('file_system')
     device = torch.device(f'cuda:{args.device}' if torch.cuda.is_available() else 'cpu')
@@ -152,4 +210,14 @@ if function == 'train':
                 save_path=save_path,
                 writer=writer,
                 num_epochs=args.num_epochs,
-                wall_time=args.wall_time)
+                wall_time=args.wall_time,
+                profile_path=os.path.join(result_folder, 'steps.jsonl'))
+
+    # Stop the prefetch workers
+    for data_loader in (train_loader, test_loader):
+        if hasattr(data_loader, 'close'):
+            data_loader.close()
+
+    # With workers, each one has its own cache, the counts are the ones of all the processes
+    if getattr(loader.node_simfunc, 'assignments', None) is not None and loader.node_simfunc.assignments.stats():
+        print(f">>> R_iso assignment memoization: {loader.node_simfunc.assignments.stats()}")
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from dgl.nn.pytorch.conv import RelGraphConv
 
 import matplotlib.pyplot as plt
@@ -8,6 +9,7 @@ import seaborn as sns
 import numpy as np
 
 import os
+from functools import partial
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -23,12 +25,24 @@ def model_from_hparams(hparams, verbose=True):
     :return:
     """
     num_rels = hparams.get('argparse', 'num_edge_types')
+    landmarks = hparams.get('argparse', 'landmarks')
+    if landmarks is not None:
+        from prepare_data.landmarks import load_landmarks, landmarks_path
+
+        _, index = load_landmarks(landmarks_path(landmarks))
+        landmark_K = index['landmark_K']
+    else:
+        landmark_K = None
     model = Model(dims=hparams.get('argparse', 'embedding_dims'),
                   self_loop=hparams.get('argparse', 'self_loop'),
                   conv_output=hparams.get('argparse', 'conv_output'),
                   num_rels=num_rels,
                   num_bases=-1,
                   similarity=hparams.get('argparse', 'similarity'),
+                  weighted=hparams.get('argparse', 'weight'),
+                  loss_block=hparams.get('argparse', 'loss_block'),
+                  factorised=hparams.get('argparse', 'factorised'),
+                  landmark_K=landmark_K,
                   verbose=verbose)
     return model
 
@@ -102,10 +116,42 @@ class Embedder(nn.Module):
         else:
             return nn.Linear(in_dim, out_dim)
 
+    def relation_degrees(self, g):
+        """
+        :return: the (n_nodes, num_rels) number of incoming edges of each relation, precomputed by
+        tools.graph_utils.nx_to_dgl when available
+        """
+        if 'rel_degrees' in g.ndata:
+            return g.ndata['rel_degrees'].float()
+        _, dst = g.all_edges()
+        degrees = torch.zeros((g.number_of_nodes(), self.num_rels), device=dst.device)
+        return degrees.index_put_((dst, g.edata['one_hot'].long()), torch.ones_like(dst, dtype=torch.float),
+                                  accumulate=True)
+
+    def first_layer(self, g):
+        """
+        The input features are all ones, so the sum of the messages a node gets in the first layer is its
+        number of incoming edges of each relation times the relation weights: no message passing is needed.
+        """
+        layer = self.layers[0]
+        weight = layer.weight
+        if layer.num_bases < layer.num_rels:
+            weight = torch.matmul(layer.w_comp, weight.view(layer.num_bases, -1))
+        h = torch.mm(self.relation_degrees(g), weight.view(layer.num_rels, -1))
+        if layer.bias:
+            h = h + layer.h_bias
+        if layer.self_loop:
+            h = h + layer.loop_weight
+        if layer.activation:
+            h = layer.activation(h)
+        return layer.dropout(h)
+
     def forward(self, g):
         # h = g.in_degrees().view(-1, 1).float().to(self.current_device)
-        h = torch.ones(len(g.nodes())).view(-1, 1).to(self.current_device)
+        h = self.first_layer(g)
         for i, layer in enumerate(self.layers):
+            if i == 0:
+                continue
             # layer(g)
             if not self.conv_output and (i == len(self.layers) - 1):
                 h = layer(h)
@@ -130,6 +176,10 @@ class Model(nn.Module):
                  similarity=True,
                  normalize=False,
                  weighted=False,
+                 factorised=False,
+                 landmark_K=None,
+                 canonical=(0, 6),
+                 loss_block=0,
                  verbose=True):
         """
 
@@ -143,6 +193,11 @@ class Model(nn.Module):
         :param orth: the constant in front of dictionary orthogonality loss
         :param scaled: if we want to scale the loss by attribution norm
         :param similarity: if we want to use cosine similarities instead of distances everywhere
+        :param factorised: if the targets are kernel feature maps phi (see tools.node_sim.R1Sketch) instead of K
+        :param landmark_K: the similarities between landmarks (see prepare_data/landmarks.py), if the targets are
+        the similarities of nodes to landmarks. The landmark embeddings are then learnt along the model.
+        :param canonical: the edge types not up weighted by the weighted loss
+        :param loss_block: if not 0, compute the dense loss by blocks of this many rows (see tiled_loss)
 
         :param attribute: Whether we want the network to use the attribution module
         :param convolute: If we want to use a rgcn also for the attributions
@@ -159,7 +214,12 @@ class Model(nn.Module):
         self.similarity = similarity
         self.normalize = normalize
         self.weighted = weighted
+        self.factorised = factorised
         self.self_loop = self_loop
+        # edge types of backbone and canonical pairs, the other ones are up weighted by the weighted loss
+        self.canonical = canonical
+        self.nc_cache = {}
+        self.loss_block = loss_block
 
         # create rgcn layers for the embedder
         self.embedder = Embedder(dims=dims,
@@ -169,6 +229,12 @@ class Model(nn.Module):
                                  conv_output=conv_output,
                                  verbose=verbose)
 
+        if landmark_K is not None:
+            self.register_buffer('landmark_K', torch.tensor(np.asarray(landmark_K), dtype=torch.float))
+            self.landmark_embeddings = nn.Parameter(torch.randn(len(landmark_K), self.dimension_embedding))
+        else:
+            self.landmark_K = None
+
     def forward(self, g):
         # If hard embed, the embeddings are directy g.ndata['h'], otherwise we compute them and put them here
         self.embedder(g)
@@ -215,12 +281,203 @@ class Model(nn.Module):
             return torch.nn.MSELoss()(output, target)
         return torch.mean(weight * (output - target) ** 2)
 
-    def rec_loss(self, embeddings, target_K, graph=None):
+    def factorised_loss(self, embeddings, phi):
+        """
+        MSE between the predicted similarities and K = phi phi^T without forming the (n, n) matrices in the graph,
+        using ||Z Z^T - P P^T||^2 = ||Z^T Z||^2 - 2 ||Z^T P||^2 + ||P^T P||^2
+        :param embeddings: The node embeddings
+        :param phi: the (n, dim) kernel features
+        :return:
+        """
+        assert self.similarity and not self.weighted, "The factorised loss needs similarities and no weighting"
+        if self.normalize:
+            norms = embeddings.norm(dim=1)[:, None]
+            embeddings = embeddings / torch.max(norms, 1e-8 * torch.ones_like(norms))
+        n = len(embeddings)
+        predicted = torch.sum(torch.mm(embeddings.t(), embeddings) ** 2)
+        cross = torch.sum(torch.mm(embeddings.t(), phi) ** 2)
+        # This term does not depend on the model, we take the cheapest of the two products
+        with torch.no_grad():
+            target = torch.sum(torch.mm(phi, phi.t()) ** 2) if n < phi.shape[1] else \
+                torch.sum(torch.mm(phi.t(), phi) ** 2)
+        return (predicted - 2 * cross + target) / n ** 2
+
+    def pairs_loss(self, embeddings, pairs, values, eps=1e-8):
+        """
+        MSE on sampled pairs of nodes only (see train_embeddings.loader.sample_pairs)
+        :param embeddings: The node embeddings
+        :param pairs: (n_pairs, 2) node indices
+        :param values: the similarities of the pairs
+        :return:
+        """
+        assert not self.weighted, "Sampled pairs are stratified in the loader instead of weighted"
+        first, second = embeddings[pairs[:, 0]], embeddings[pairs[:, 1]]
+        if self.similarity:
+            if self.normalize:
+                first_n, second_n = first.norm(dim=1)[:, None], second.norm(dim=1)[:, None]
+                first = first / torch.max(first_n, eps * torch.ones_like(first_n))
+                second = second / torch.max(second_n, eps * torch.ones_like(second_n))
+            predicted = torch.sum(first * second, dim=1)
+        else:
+            predicted = torch.norm(first - second, dim=1, p=2)
+            values = 1 - values
+        return torch.nn.MSELoss()(predicted, values)
+
+    def sparse_loss(self, embeddings, pairs, values, floor):
+        """
+        MSE against a sparse K whose missing entries are equal to floor (see tools.node_sim.k_sparse_list).
+        With similarities, the sum over all entries has a closed form
+        sum_ij (z_i.z_j - f)^2 = ||Z^T Z||^2 - 2 f ||sum_i z_i||^2 + n^2 f^2
+        and only the computed entries need a correction, so that no (n, n) matrix is built.
+        :param embeddings: The node embeddings
+        :param pairs: (n_entries, 2) indices of the computed entries
+        :param values: their similarities
+        :param floor: the value of the other entries
+        :return:
+        """
+        assert not self.weighted, "Sparse targets do not support weighting"
+        n = len(embeddings)
+        if not self.similarity:
+            target_K = floor * torch.ones((n, n), device=embeddings.device, dtype=values.dtype)
+            target_K[pairs[:, 0], pairs[:, 1]] = values
+            return torch.nn.MSELoss()(self.matrix_dist(embeddings), 1 - target_K)
+
+        if self.normalize:
+            norms = embeddings.norm(dim=1)[:, None]
+            embeddings = embeddings / torch.max(norms, 1e-8 * torch.ones_like(norms))
+        total = torch.sum(torch.mm(embeddings.t(), embeddings) ** 2) \
+                - 2 * floor * torch.sum(embeddings.sum(dim=0) ** 2) + n ** 2 * floor ** 2
+        predicted = torch.sum(embeddings[pairs[:, 0]] * embeddings[pairs[:, 1]], dim=1)
+        correction = torch.sum((predicted - values) ** 2 - (predicted - floor) ** 2)
+        return (total + correction) / n ** 2
+
+    def landmark_loss(self, embeddings, target_K):
+        """
+        MSE between the node to landmark similarities and their prediction from the landmark embeddings.
+        The landmark to landmark similarities are also fitted, to keep the landmark embeddings consistent.
+        :param embeddings: The node embeddings
+        :param target_K: the (n_nodes, n_landmarks) similarities
+        :return:
+        """
+        assert not self.weighted, "Landmark targets do not support weighting"
+        landmarks = self.landmark_embeddings
+        target_K = torch.cat([target_K, self.landmark_K])
+        embeddings = torch.cat([embeddings, landmarks])
+        if self.similarity:
+            if self.normalize:
+                K_predict = self.matrix_cosine(embeddings, landmarks)
+            else:
+                K_predict = torch.mm(embeddings, landmarks.t())
+        else:
+            K_predict = torch.norm(embeddings[:, None] - landmarks, dim=2, p=2)
+            target_K = 1 - target_K
+        return torch.nn.MSELoss()(K_predict, target_K)
+
+    def tiled_loss(self, embeddings, target_K, enhanced=None):
         """
+        The dense loss of rec_loss, summed over blocks of loss_block rows of the (n, n) matrices.
+        Each block is checkpointed: its (loss_block, n) predictions are recomputed in the backward pass instead of
+        being kept, so that memory grows as n * loss_block instead of n^2 (n^2 * d for distances).
         :param embeddings: The node embeddings
         :param target_K: The similarity matrix
+        :param enhanced: the per node factors of the weighted loss, whose normalised outer product is the weight
+        :return:
+        """
+        n = len(embeddings)
+        if self.similarity and self.normalize:
+            norms = embeddings.norm(dim=1)[:, None]
+            embeddings = embeddings / torch.max(norms, 1e-8 * torch.ones_like(norms))
+        # weight / mean(weight) = outer(scale, scale)
+        scale = enhanced / torch.mean(enhanced) if enhanced is not None else None
+
+        def block_loss(start, rows, embeddings, target):
+            if self.similarity:
+                predicted = torch.mm(rows, embeddings.t())
+            else:
+                predicted = torch.cdist(rows, embeddings, compute_mode='donot_use_mm_for_euclid_dist')
+                target = 1 - target
+            error = (predicted - target) ** 2
+            if scale is not None:
+                error = scale[start:start + len(rows), None] * error * scale[None, :]
+            return torch.sum(error)
+
+        checkpointed = torch.is_grad_enabled() and embeddings.requires_grad
+        loss = 0
+        for start in range(0, n, self.loss_block):
+            stop = start + self.loss_block
+            block = partial(block_loss, start)
+            args = (embeddings[start:stop], embeddings, target_K[start:stop])
+            loss = loss + (checkpoint(block, *args) if checkpointed else block(*args))
+        return loss / n ** 2
+
+    def nc_nodes(self, graph, graph_indices=None, graph_sizes=None):
+        """
+        Flag the nodes that a walk of less than len(dims) hops followed by a non canonical edge reaches, for the
+        weighted loss. This is computed on the device of the graph from its edges with sparse products, and cached
+        for each graph since it does not change.
+        :param graph: the batched DGL graph
+        :param graph_indices: the dataset indices of the graphs of the batch, to cache their flags
+        :param graph_sizes: the number of nodes of these graphs
+        :return: a (n_nodes,) tensor of 0 and 1
+        """
+        device = graph.edata['one_hot'].device
+        if graph_indices is not None:
+            graph_indices = [int(idx) for idx in graph_indices.view(-1)]
+            if all(idx in self.nc_cache for idx in graph_indices):
+                return torch.cat([self.nc_cache[idx] for idx in graph_indices]).to(device)
+
+        n = graph.number_of_nodes()
+        src, dst = graph.all_edges()
+        adjacency = torch.sparse_coo_tensor(torch.stack([src, dst]), torch.ones(len(src), device=device), (n, n))
+        # sum over the walks of less than len(dims) hops from every node, the graph is symmetric
+        walks = torch.ones((n, 1), device=device)
+        reach = walks
+        for _ in self.dims[:-1]:
+            walks = torch.sparse.mm(adjacency, walks)
+            reach = reach + walks
+        edge_types = graph.edata['one_hot']
+        non_canonical = (edge_types != self.canonical[0]) & (edge_types != self.canonical[1])
+        enhanced = torch.zeros(n, device=device).index_add_(0, dst[non_canonical], reach[src[non_canonical], 0])
+        enhanced = torch.clamp(enhanced, min=0, max=1)
+
+        if graph_indices is not None:
+            for idx, flags in zip(graph_indices, torch.split(enhanced, [int(size) for size in graph_sizes])):
+                self.nc_cache[idx] = flags
+        return enhanced
+
+    def rec_loss(self, embeddings, target_K, graph=None, graph_indices=None, graph_sizes=None):
+        """
+        :param embeddings: The node embeddings
+        :param target_K: The similarity matrix, its feature map if the model is factorised,
+        a tuple (pairs, values) for sampled pairs or (pairs, values, floor) for a sparse K
+        :param graph: the batched graph, for the weighted loss
+        :param graph_indices: the dataset indices of its graphs, to cache their weighting
+        :param graph_sizes: their number of nodes
         :return:
         """
+        if isinstance(target_K, tuple) and len(target_K) == 2:
+            return self.pairs_loss(embeddings, *target_K)
+
+        if isinstance(target_K, tuple):
+            return self.sparse_loss(embeddings, *target_K)
+
+        if self.landmark_K is not None:
+            return self.landmark_loss(embeddings, target_K)
+
+        if self.factorised:
+            return self.factorised_loss(embeddings, target_K)
+
+        if self.weighted:
+            assert graph is not None
+            enhanced = self.nc_nodes(graph, graph_indices=graph_indices, graph_sizes=graph_sizes)
+            fraction = torch.mean(enhanced)
+            enhanced = ((1 / (fraction + 0.005)) * enhanced) + 1
+        else:
+            enhanced = None
+
+        if self.loss_block:
+            return self.tiled_loss(embeddings, target_K, enhanced)
+
         if self.similarity:
             if self.normalize:
                 K_predict = self.matrix_cosine(embeddings, embeddings)
@@ -232,45 +489,8 @@ class Model(nn.Module):
             target_K = torch.ones(target_K.shape, device=target_K.device) - target_K
 
         if self.weighted:
-            assert graph is not None
-            import networkx as nx
-            nx_graph = graph.to_networkx(edge_attrs=['one_hot'])
-            nx_graph = nx.to_undirected(nx_graph)
-            ordered = sorted(nx_graph.nodes())
-            adj_matrix_full = nx.to_scipy_sparse_matrix(nx_graph, nodelist=ordered)
-
-            # copy the matrix with only the non canonical
-            extracted_edges = [(u, v) for u, v, e in nx_graph.edges.data('one_hot', default='0')
-                               if e not in [0, 6]]
-            extracted_graph = nx.Graph()
-            extracted_graph.add_nodes_from(ordered)
-            extracted_graph.add_edges_from(extracted_edges)
-            extracted_graph = nx.to_undirected(extracted_graph)
-            adj_matrix_small = nx.to_scipy_sparse_matrix(extracted_graph, nodelist=ordered)
-
-            # This is a matrix with non zero entries for non canonical relationships
-            # One must then expand it based on the number of hops
-            adj_matrix_full = np.array(adj_matrix_full.todense())
-            adj_matrix_small = np.array(adj_matrix_small.todense())
-
-            expanded_connectivity = [np.eye(len(adj_matrix_full))]
-            for _ in self.dims[:-1]:
-                expanded_connectivity.append(expanded_connectivity[-1] @ adj_matrix_full)
-            expanded_connectivity = np.sum(expanded_connectivity, axis=0)
-
-            # What we are after is a matrix for which you start with a walk of len < max_len
-            # that starts with node i and that ends with a non canonical with j
-            # ie : all neighborhoods that include a non canonical.
-            # multiplying on the left yields walks that start with a non canonical on the rows
-            # expanded_connectivity_left = np.array(adj_matrix_small @ expanded_connectivity)
-            expanded_connectivity_right = np.array(expanded_connectivity @ adj_matrix_small)
-            enhanced = np.sum(expanded_connectivity_right, axis=0)
-            enhanced = np.clip(enhanced, a_min=0, a_max=1)
-            fraction = np.sum(enhanced) / len(enhanced)
-            enhanced = ((1 / (fraction + 0.005)) * enhanced) + 1
-            weight = np.outer(enhanced, enhanced)
-            weight /= np.mean(weight)
-            weight = torch.from_numpy(weight)
+            weight = torch.ger(enhanced, enhanced)
+            weight = weight / torch.mean(weight)
             return self.weighted_MSE(K_predict, target_K, weight)
 
         reconstruction_loss = torch.nn.MSELoss()(K_predict, target_K)
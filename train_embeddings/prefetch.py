@@ -0,0 +1,174 @@
+"""
+Compute the batches, and in particular their K, ahead of the training loop.
+
+A pool of processes runs the collate function on the upcoming batches and sends them back through a queue
+(torch.multiprocessing moves their tensors to shared memory). At most `depth` batches are in flight, so the pool
+waits for the training loop when it is ahead. The time the training loop spends waiting for a batch and the number of
+ready batches tell whether training is kernel bound. Workers also send the time they spent loading the items and
+running the collate function for each batch, which last_times holds for the batch last yielded.
+
+The pool is started on the first epoch and kept until close() is called. Jobs are tagged with their epoch, so the
+results of an epoch left before its end are dropped. While waiting for a batch, the loader checks that the workers are
+alive, so a worker killed by the system (e.g. out of memory) fails training instead of blocking it.
+"""
+import queue
+import traceback
+from time import perf_counter
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+# Seconds between two checks of the workers while waiting for a batch
+POLL_INTERVAL = 5.
+
+
+def _worker_loop(dataset, collate_fn, index_queue, result_queue, seed):
+    torch.manual_seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    while True:
+        job = index_queue.get()
+        if job is None:
+            break
+        epoch, i, indices = job
+        try:
+            start = perf_counter()
+            samples = [dataset[j] for j in indices]
+            loaded = perf_counter()
+            batch = collate_fn(samples)
+            result_queue.put((epoch, i, batch, {'unpickling': loaded - start, 'kernel': perf_counter() - loaded}))
+        except Exception:
+            error = RuntimeError(f"Batch {i} failed in a prefetch worker:\n{traceback.format_exc()}")
+            result_queue.put((epoch, i, error, None))
+
+
+class PrefetchLoader():
+    """
+    Iterates over batches like a DataLoader, with the collate function run by num_workers processes on the
+    next batches while the current one is trained on.
+    """
+
+    def __init__(self, dataset, batch_sampler, collate_fn, num_workers=2, depth=4):
+        """
+        :param dataset: the dataset (or Subset) to draw from
+        :param batch_sampler: yields the lists of indices in dataset of each batch
+        :param collate_fn: turns a list of items of dataset into a batch
+        :param num_workers: number of processes computing the batches
+        :param depth: maximum number of batches computed ahead of the training loop
+        """
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn
+        self.num_workers = num_workers
+        self.depth = max(depth, num_workers)
+        self.wait_times = []
+        self.queue_depths = []
+        self.last_times = None
+        self.workers = []
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def start(self):
+        """
+        Start the pool of workers, done by the first epoch
+        """
+        self.index_queue, self.result_queue = mp.Queue(), mp.Queue()
+        base_seed = torch.randint(2 ** 31, (1,)).item()
+        self.workers = [mp.Process(target=_worker_loop,
+                                   args=(self.dataset, self.collate_fn, self.index_queue, self.result_queue,
+                                         base_seed + w),
+                                   daemon=True)
+                        for w in range(self.num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def close(self):
+        """
+        Stop the pool of workers
+        """
+        if not getattr(self, 'workers', None):
+            return
+        for _ in self.workers:
+            self.index_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+    def __del__(self):
+        self.close()
+
+    def check_workers(self):
+        dead = [w for w, worker in enumerate(self.workers) if not worker.is_alive()]
+        if dead:
+            exitcodes = [self.workers[w].exitcode for w in dead]
+            self.close()
+            raise RuntimeError(f"Prefetch workers {dead} exited unexpectedly (exit codes {exitcodes})")
+
+    def __iter__(self):
+        if not self.workers:
+            self.start()
+        self.epoch += 1
+        epoch = self.epoch
+        batches = list(self.batch_sampler)
+        self.wait_times = []
+        self.queue_depths = []
+
+        sent = 0
+        for _ in range(min(self.depth, len(batches))):
+            self.index_queue.put((epoch, sent, batches[sent]))
+            sent += 1
+
+        ready = {}
+
+        def receive(timeout=None):
+            job_epoch, j, batch, times = self.result_queue.get(block=timeout is not None, timeout=timeout)
+            if isinstance(batch, Exception):
+                raise batch
+            # Results of a previous epoch that was not iterated to the end
+            if job_epoch == epoch:
+                ready[j] = batch, times
+
+        try:
+            for i in range(len(batches)):
+                # Count the batches that are ready when the training loop asks for one
+                try:
+                    while True:
+                        receive()
+                except queue.Empty:
+                    pass
+                self.queue_depths.append(len(ready))
+
+                start = perf_counter()
+                while i not in ready:
+                    try:
+                        receive(timeout=POLL_INTERVAL)
+                    except queue.Empty:
+                        self.check_workers()
+                self.wait_times.append(perf_counter() - start)
+                batch, self.last_times = ready.pop(i)
+
+                # A batch is consumed, so there is room for one more in flight
+                if sent < len(batches):
+                    self.index_queue.put((epoch, sent, batches[sent]))
+                    sent += 1
+                yield batch
+        finally:
+            # Drop the jobs not started yet if the epoch is left before its end
+            try:
+                while True:
+                    self.index_queue.get_nowait()
+            except queue.Empty:
+                pass
+
+    def stats(self):
+        """
+        :return: the mean waiting time for a batch and the mean number of ready batches over the last epoch
+        """
+        if not self.wait_times:
+            return {'wait_time': 0., 'queue_depth': 0.}
+        return {'wait_time': float(np.mean(self.wait_times)),
+                'queue_depth': float(np.mean(self.queue_depths))}
@@ -0,0 +1,152 @@
+"""
+Timing of the phases of the training steps.
+
+Each step is split into the wait for the batch ('data': unpickling and K computation when they run in the training
+process), sending the graph to the device, the forward pass, the reconstruction loss, the backward pass, the
+optimizer step and the logging of the training loop, so that the time of a step is the sum of its phases. When the
+batches come from a PrefetchLoader, its workers also report the time they spent loading the items ('unpickling') and
+running the collate function ('kernel') for each batch.
+
+Every step is a line of a JSON-lines file, rewritten by each run, with its throughput (graphs, nodes and entries of
+the target kernel per second) and the peak RSS of the process. Means over the last log_every steps go to the
+SummaryWriter. The clock is read a few times per step, and on GPU the device is synchronized at each phase, which the
+call to loss.item() of the training loop already does once per step.
+"""
+import json
+import resource
+from collections import defaultdict
+from time import perf_counter
+
+import numpy as np
+import torch
+
+PHASES = ['data', 'to_device', 'forward', 'rec_loss', 'backward', 'optimizer', 'logging']
+WORKER_PHASES = ['unpickling', 'kernel']
+
+
+def peak_rss():
+    """
+    :return: the peak resident memory of this process, in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def kernel_entries(K, factorised=False):
+    """
+    :param K: the target of a batch, K, the similarities to landmarks, a tuple of sampled entries or the sketch
+    features phi of a factorised loss
+    :param factorised: K is phi, the target is then the implicit (n, n) phi phi^T
+    :return: the number of entries of the kernel in the target
+    """
+    if isinstance(K, tuple):
+        return K[1].numel()
+    if factorised:
+        return K.shape[0] ** 2
+    return K.numel()
+
+
+class StepProfiler():
+    """
+    Times the phases of each step: call lap(phase) at the end of each phase and end_step at the end of the step.
+    """
+
+    def __init__(self, jsonl_path=None, writer=None, device=None, log_every=20, factorised=False):
+        """
+        :param jsonl_path: path of the JSON-lines file of the steps, none is written if None
+        :param writer: a SummaryWriter for the means over log_every steps
+        :param device: the device of the model, synchronized before reading the clock when it is a GPU
+        :param log_every: number of steps between writes to writer
+        :param factorised: the targets are sketch features, see kernel_entries
+        """
+        self.jsonl = None if jsonl_path is None else open(jsonl_path, 'w')
+        self.factorised = factorised
+        self.writer = writer
+        self.sync = device is not None and torch.device(device).type == 'cuda'
+        self.device = device
+        self.log_every = log_every
+        self.global_step = 0
+        self.window = defaultdict(list)
+        self.epoch_totals = defaultdict(float)
+        self.start_step()
+
+    def start_step(self):
+        """
+        Start timing a step, the wait for its batch included
+        """
+        self.times = {}
+        self.step_start = self.last = perf_counter()
+
+    def lap(self, phase):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        now = perf_counter()
+        self.times[phase] = now - self.last
+        self.last = now
+
+    def end_step(self, epoch, graph_sizes, K, loader=None):
+        """
+        Record the step that just ended, at the last lap, and start the next one
+        :param graph_sizes: the number of nodes of each graph of the batch
+        :param K: the target of the batch
+        :param loader: the training loader, for the worker timings of a PrefetchLoader
+        """
+        step_time = self.last - self.step_start
+        graphs, nodes, entries = len(graph_sizes), int(sum(graph_sizes)), kernel_entries(K, self.factorised)
+        record = {'epoch': epoch,
+                  'step': self.global_step,
+                  'time': step_time,
+                  **self.times,
+                  'graphs': graphs,
+                  'nodes': nodes,
+                  'kernel_entries': entries,
+                  'graphs_per_s': graphs / step_time,
+                  'nodes_per_s': nodes / step_time,
+                  'kernel_entries_per_s': entries / step_time,
+                  'peak_rss_mb': peak_rss()}
+        if getattr(loader, 'last_times', None) is not None:
+            record.update(loader.last_times)
+        if self.jsonl is not None:
+            self.jsonl.write(json.dumps(record) + '\n')
+
+        for key in ['time', 'graphs', 'nodes', 'kernel_entries'] + PHASES + WORKER_PHASES:
+            if key in record:
+                self.window[key].append(record[key])
+                self.epoch_totals[key] += record[key]
+        self.global_step += 1
+        if self.global_step % self.log_every == 0:
+            self.log_window()
+        self.start_step()
+
+    def log_window(self):
+        if self.writer is not None and self.window:
+            step = self.global_step
+            for phase in PHASES + WORKER_PHASES:
+                if phase in self.window:
+                    self.writer.add_scalar(f"Step time/{phase}", np.mean(self.window[phase]), step)
+            elapsed = sum(self.window['time'])
+            for key in ['graphs', 'nodes', 'kernel_entries']:
+                self.writer.add_scalar(f"Throughput/{key} per s", sum(self.window[key]) / elapsed, step)
+            self.writer.add_scalar("Peak RSS (MB)", peak_rss(), step)
+        self.window = defaultdict(list)
+
+    def end_epoch(self, epoch, verbose=True):
+        """
+        Log the throughput of the epoch and print the share of each phase in its steps
+        """
+        totals, self.epoch_totals = self.epoch_totals, defaultdict(float)
+        if not totals['time']:
+            return
+        if self.jsonl is not None:
+            self.jsonl.flush()
+        if self.writer is not None:
+            for key in ['graphs', 'nodes', 'kernel_entries']:
+                self.writer.add_scalar(f"Throughput/epoch {key} per s", totals[key] / totals['time'], epoch)
+        if verbose:
+            shares = ', '.join(f"{phase} {100 * totals[phase] / totals['time']:.0f}%" for phase in PHASES)
+            print(f">>> {totals['graphs'] / totals['time']:.1f} graphs/s, {totals['nodes'] / totals['time']:.0f} "
+                  f"nodes/s, {totals['kernel_entries'] / totals['time']:.0f} kernel entries/s, "
+                  f"peak RSS {peak_rss():.0f}MB ({shares})")
+
+    def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()